@@ -0,0 +1 @@
+"""Offline benchmarks for the CAPTURE backend; run modules with `python -m benchmarks.<name>`"""
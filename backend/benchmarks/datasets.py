@@ -0,0 +1,166 @@
+"""Synthetic city-scale CAPTURE data inside the Bannerghatta game area.
+
+Territories are closed running loops: a wobbly ellipse 0.5-4 km round,
+sampled every ~25 m, dropped at a random point inside the bounds. Owners
+follow a long-tailed distribution so a few heavy users hold many loops,
+like real leaderboards. Everything is derived from `seed`, so two runs
+of the same scale insert identical data.
+"""
+import hashlib
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List
+
+import numpy as np
+
+import control_grid
+import coverage
+import leaderboard
+from geometry import territory_areas
+from server import Territory, User, build_territory_doc
+
+# [west, south, east, north]
+BANNERGHATTA_BOUNDS = (77.57, 12.87, 77.63, 12.92)
+
+# Territory counts; users are a tenth of that
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+
+# Share of users with an uploaded profile picture
+PICTURE_RATE = 0.3
+
+COLORS = ["#EF4444", "#3B82F6", "#22C55E", "#A855F7", "#F97316", "#EAB308", "#EC4899", "#06B6D4"]
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+METERS_PER_DEGREE = 111_320.0
+
+
+def user_id(i: int) -> str:
+    return f"bench-user-{i:07d}"
+
+
+def territory_id(i: int) -> str:
+    return f"bench-territory-{i:08d}"
+
+
+def running_loop(rng: np.random.Generator) -> List[List[float]]:
+    """A closed [[lng, lat], ...] loop inside the game area"""
+    west, south, east, north = BANNERGHATTA_BOUNDS
+    perimeter_m = rng.uniform(500, 4000)
+    radius_m = perimeter_m / (2 * math.pi)
+    points = max(12, int(perimeter_m / 25))
+
+    theta = np.linspace(0, 2 * math.pi, points, endpoint=False)
+    # A few low harmonics bend the ellipse into a street-following shape
+    wobble = sum(
+        rng.uniform(0, 0.12) * np.sin(k * theta + rng.uniform(0, 2 * math.pi))
+        for k in (2, 3, 5)
+    )
+    radius = radius_m * (1 + wobble)
+    aspect = rng.uniform(0.6, 1.0)
+    rotation = rng.uniform(0, math.pi)
+    x = radius * np.cos(theta)
+    y = radius * aspect * np.sin(theta)
+    east_m = x * math.cos(rotation) - y * math.sin(rotation)
+    north_m = x * math.sin(rotation) + y * math.cos(rotation)
+
+    margin = (radius_m * 1.4) / METERS_PER_DEGREE
+    lat0 = rng.uniform(south + margin, north - margin)
+    lng0 = rng.uniform(west + margin, east - margin)
+    lng = lng0 + east_m / (METERS_PER_DEGREE * math.cos(math.radians(lat0)))
+    lat = lat0 + north_m / METERS_PER_DEGREE
+
+    ring = np.round(np.column_stack([lng, lat]), 6).tolist()
+    ring.append(ring[0])
+    return ring
+
+
+def owner_indexes(rng: np.random.Generator, user_count: int, count: int) -> np.ndarray:
+    """Long-tailed owner choice: low user numbers own most territories"""
+    return np.minimum((rng.pareto(1.2, count) * user_count / 20).astype(np.int64), user_count - 1)
+
+
+def users(count: int, seed: int = 7) -> List[dict]:
+    """User documents as create_user stores them"""
+    rng = np.random.default_rng(seed)
+    docs = []
+    for i in range(count):
+        user = User(
+            id=user_id(i),
+            email=f"{user_id(i)}@bench.capture.app",
+            display_name=f"Runner {i}",
+            created_at=EPOCH + timedelta(seconds=int(rng.integers(0, 30 * 86400))),
+        ).model_dump()
+        docs.append(user)
+    return docs
+
+
+def territory_batches(count: int, user_count: int, batch_size: int = 1000, seed: int = 7) -> Iterator[List[dict]]:
+    """Territory documents as create_territory stores them, in insert-sized batches"""
+    rng = np.random.default_rng(seed + 1)
+    owners = owner_indexes(rng, user_count, count)
+    batch = []
+    for i in range(count):
+        ring = running_loop(rng)
+        perimeter_km = len(ring) * 0.025
+        territory = Territory(
+            id=territory_id(i),
+            user_id=user_id(int(owners[i])),
+            name=f"Loop {i}",
+            coordinates=ring,
+            color=COLORS[i % len(COLORS)],
+            area=0.0,
+            distance=round(perimeter_km, 3),
+            duration=int(perimeter_km * rng.uniform(300, 480)),
+            created_at=EPOCH + timedelta(seconds=int(rng.integers(0, 180 * 86400))),
+        )
+        batch.append(territory)
+        if len(batch) >= batch_size:
+            yield _with_areas(batch)
+            batch = []
+    if batch:
+        yield _with_areas(batch)
+
+
+def _with_areas(batch: List[Territory]) -> List[dict]:
+    for territory, area in zip(batch, territory_areas([t.coordinates for t in batch])):
+        territory.area = area
+    return [build_territory_doc(t) for t in batch]
+
+
+def profile_pictures(user_count: int, seed: int = 7) -> List[dict]:
+    """Metadata rows pointing at (absent) GridFS blobs; enough for the picture URL route"""
+    rng = np.random.default_rng(seed + 2)
+    docs = []
+    for i in np.flatnonzero(rng.random(user_count) < PICTURE_RATE):
+        digest = hashlib.sha256(f"picture-{i}".encode()).hexdigest()
+        docs.append({
+            "user_id": user_id(int(i)),
+            "original": digest,
+            "thumbnails": {"64": digest[::-1], "256": digest[1:] + digest[0]},
+            "content_type": "image/jpeg",
+            "size": 48_000,
+            "updated_at": EPOCH,
+        })
+    return docs
+
+
+async def seed_database(db, territories: int, seed: int = 7, batch_size: int = 1000) -> dict:
+    """Insert users, territories, leaderboard stats, control cells, coverage and picture rows into an empty database"""
+    user_count = max(1, territories // 10)
+    user_docs = users(user_count, seed)
+    for start in range(0, len(user_docs), batch_size):
+        await db.users.insert_many(user_docs[start:start + batch_size], ordered=False)
+
+    for batch in territory_batches(territories, user_count, batch_size, seed):
+        await db.territories.insert_many(batch, ordered=False)
+        await leaderboard.record_territories_created(db, batch)
+
+    # Heatmap and coverage routes read these rollups, not territories
+    cells = await control_grid.rebuild(db, batch_size)
+    covered = await coverage.rebuild(db, batch_size)
+
+    pictures = profile_pictures(user_count, seed)
+    if pictures:
+        await db.profile_pictures.insert_many(pictures, ordered=False)
+
+    return {"users": user_count, "territories": territories, "profile_pictures": len(pictures),
+            "control_cells": cells["cells"], "coverage_tiles": covered["tiles"]}
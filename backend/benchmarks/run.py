@@ -0,0 +1,310 @@
+"""In-process latency and throughput benchmark for the main API routes.
+
+    python -m benchmarks.run --scale 1k [--backend mongomock|mongod] [--requests 200]
+        [--concurrency 16] [--output results.json] [--compare baseline.json]
+
+The app runs inside this process behind httpx's ASGI transport, with its
+startup hooks, against either a local mongod (`--mongo-url`, database
+`--db-name`, dropped and reseeded on every run) or mongomock. The image
+proxy fetches from a stand-in upstream on localhost. Results go to a JSON
+file; `--compare` prints the change against an earlier one.
+
+Routes served through the response cache are measured twice. The plain
+route name is the cold case: each request asks for a different page and
+the cache is invalidated before it is sent, so it always builds. The
+"(warm)" entry cycles through a few fixed URLs that warmup has already
+cached, so it measures hits.
+
+mongomock runs queries in Python and ignores partial indexes (the territories
+index build is logged as failing), so it is only useful for relative numbers
+at the 1k scale; use mongod for 100k/1m.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import numpy as np
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# Served by the stand-in upstream for the proxy route
+PROXY_IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(16 * 1024)
+
+THEMES = ["dark", "light"]
+UNITS = ["km", "miles"]
+
+PAGE_LIMITS = [25, 50, 100, 250]
+LEADERBOARD_LIMITS = [10, 25, 50, 100]
+# Viewport side for bbox= queries, about 1.5 km
+VIEWPORT_DEGREES = 0.014
+
+# Few enough distinct URLs that warmup caches every one
+WARM_TERRITORY_URLS = ["/api/territories", "/api/territories?limit=100", "/api/territories?limit=250"]
+WARM_LEADERBOARD_URLS = ["/api/leaderboard", "/api/leaderboard?limit=50", "/api/leaderboard?limit=100"]
+
+
+class StandInUpstream(BaseHTTPRequestHandler):
+    """Static image with an ETag, standing in for the brand CDN"""
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"bench"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(PROXY_IMAGE)))
+        self.send_header("ETag", '"bench"')
+        self.end_headers()
+        self.wfile.write(PROXY_IMAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_upstream() -> Tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"127.0.0.1:{server.server_address[1]}"
+
+
+RequestFactory = Callable[[random.Random], Tuple[str, str, Optional[dict]]]
+
+
+def route_requests(user_count: int, territory_count: int, picture_users: List[str],
+                   upstream: str, viewports: bool = False) -> Dict[str, RequestFactory]:
+    """Request builders per benchmarked route, each returning (method, url, json)
+
+    `viewports` adds bbox= pages to the territory list; mongomock has no
+    $geoIntersects, so only mongod runs them.
+    """
+    from benchmarks.datasets import BANNERGHATTA_BOUNDS, COLORS, territory_id, user_id
+
+    def any_user(rng):
+        return user_id(rng.randrange(user_count))
+
+    def territory_page(rng):
+        params = {"after": territory_id(rng.randrange(territory_count)), "limit": rng.choice(PAGE_LIMITS)}
+        if viewports and rng.random() < 0.5:
+            west, south, east, north = BANNERGHATTA_BOUNDS
+            lng = rng.uniform(west, east - VIEWPORT_DEGREES)
+            lat = rng.uniform(south, north - VIEWPORT_DEGREES)
+            params["bbox"] = f"{lng:.5f},{lat:.5f},{lng + VIEWPORT_DEGREES:.5f},{lat + VIEWPORT_DEGREES:.5f}"
+        return "GET", f"/api/territories?{urlencode(params)}", None
+
+    # Cycled rather than sampled, so warmup requests every URL at least once
+    warm_territories = itertools.cycle(WARM_TERRITORY_URLS)
+    warm_leaderboard = itertools.cycle(WARM_LEADERBOARD_URLS)
+
+    return {
+        "GET /api/territories": territory_page,
+        "GET /api/territories (warm)": lambda rng: ("GET", next(warm_territories), None),
+        "GET /api/leaderboard": lambda rng: (
+            "GET", f"/api/leaderboard?limit={rng.choice(LEADERBOARD_LIMITS)}", None,
+        ),
+        "GET /api/leaderboard (warm)": lambda rng: ("GET", next(warm_leaderboard), None),
+        "PUT /api/territories/{id}/claim": lambda rng: (
+            "PUT", f"/api/territories/{territory_id(rng.randrange(territory_count))}/claim",
+            {"new_owner_id": any_user(rng), "new_color": rng.choice(COLORS)},
+        ),
+        "PATCH /api/users/{id}/preferences": lambda rng: (
+            "PATCH", f"/api/users/{any_user(rng)}/preferences",
+            {"theme": rng.choice(THEMES), "unit": rng.choice(UNITS)},
+        ),
+        "GET /api/profile-picture/{id}": lambda rng: (
+            "GET", f"/api/profile-picture/{rng.choice(picture_users)}", None,
+        ),
+        "GET /api/proxy-image": lambda rng: (
+            "GET", f"/api/proxy-image?url=http://{upstream}/brand-{rng.randrange(8)}.png", None,
+        ),
+    }
+
+
+def summarize(latencies: List[float], errors: int, wall_seconds: float) -> dict:
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall_seconds, 1),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+async def measure(http, make_request: RequestFactory, requests: int, concurrency: int,
+                  rng: random.Random, before: Optional[Callable[[], Awaitable]] = None) -> dict:
+    """Send `requests` requests from `concurrency` concurrent workers
+
+    `before` runs ahead of each request, outside the timed span.
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, body = make_request(rng)
+            if before:
+                await before()
+            start = time.perf_counter()
+            response = await http.request(method, url, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args, upstream: str) -> dict:
+    import httpx
+
+    import server
+    from benchmarks.datasets import SCALES, seed_database
+
+    if args.backend == "mongomock":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("--backend mongomock needs the mongomock-motor package")
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server.db = server.client[args.db_name]
+    else:
+        await server.client.drop_database(args.db_name)
+
+    territories = SCALES[args.scale]
+    started = time.perf_counter()
+    dataset = await seed_database(server.db, territories, seed=args.seed)
+    dataset["seed_seconds"] = round(time.perf_counter() - started, 1)
+    print(f"Seeded {dataset}")
+    print(f"{'route':40} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>9}")
+
+    picture_users = [doc["user_id"] async for doc in server.db.profile_pictures.find({}, {"user_id": 1})]
+    factories = route_requests(dataset["users"], territories, picture_users, upstream,
+                               viewports=args.backend == "mongod")
+    # Cold runs of cached routes invalidate what the route is built from before each request
+    cold_sources = {
+        "GET /api/territories": ("territories",),
+        "GET /api/leaderboard": server.LEADERBOARD_SOURCES,
+    }
+
+    await server.app.router.startup()
+    routes = {}
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            for name, make_request in factories.items():
+                rng = random.Random(f"{args.seed}:{name}")
+                sources = cold_sources.get(name)
+                before = (lambda sources=sources: server.response_cache.bump(*sources)) if sources else None
+                await measure(http, make_request, args.warmup, 1, rng, before)
+                routes[name] = await measure(http, make_request, args.requests, args.concurrency, rng, before)
+                print(f"{name:40} {routes[name]['p50_ms']:8.2f} {routes[name]['p95_ms']:8.2f} "
+                      f"{routes[name]['p99_ms']:8.2f} {routes[name]['throughput_rps']:9.1f}")
+    finally:
+        await server.app.router.shutdown()
+
+    return {
+        "meta": {
+            "scale": args.scale,
+            "backend": args.backend,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+        },
+        "dataset": dataset,
+        "routes": routes,
+    }
+
+
+def compare(current: dict, baseline: dict):
+    """Print the change in latency percentiles and throughput per route"""
+    print(f"\nvs {baseline['meta'].get('git_revision')} ({baseline['meta']['scale']}, {baseline['meta']['backend']})")
+    for name, now in current["routes"].items():
+        before = baseline["routes"].get(name)
+        if not before:
+            continue
+        changes = [
+            f"{field.split('_')[0]} {(now[field] - before[field]) / before[field] * 100:+6.1f}%"
+            for field in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")
+            if before[field]
+        ]
+        print(f"{name:40} " + "  ".join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark API routes in-process on synthetic data")
+    parser.add_argument("--scale", choices=["1k", "100k", "1m"], default="1k")
+    parser.add_argument("--backend", choices=["mongomock", "mongod"], default="mongod")
+    parser.add_argument("--mongo-url", default=os.environ.get("BENCH_MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="capture_bench")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path, help="Earlier results file to diff against")
+    args = parser.parse_args(argv)
+
+    if "bench" not in args.db_name:
+        parser.error("--db-name is dropped on every run and must contain 'bench'")
+
+    upstream_server, upstream = start_upstream()
+    # server reads these at import time
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["IMAGE_PROXY_ALLOWED_HOSTS"] = upstream
+    os.environ["IMAGE_PROXY_CACHE_DIR"] = tempfile.mkdtemp(prefix="capture-bench-proxy-")
+
+    try:
+        results = asyncio.run(run(args, upstream))
+    finally:
+        upstream_server.shutdown()
+
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = RESULTS_DIR / f"{args.scale}-{args.backend}-{stamp}.json"
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Sponsored brand zones loaded from a JSON config file.
+
+The file is a list of {id, name, brand, color, coordinates}. Areas and
+bounds are computed once at load, and the API response is serialized once
+into bytes with a strong ETag. `watch()` polls the file so edits go live
+without restarting the process.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from geometry import ring_area, ring_to_array
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the config file's mtime and size
+DEFAULT_CHECK_INTERVAL = 2.0
+
+
+def ring_bounds(coordinates) -> List[float]:
+    """[west, south, east, north] of a [[lng, lat], ...] ring"""
+    points = ring_to_array(coordinates)
+    west, south = points.min(axis=0)
+    east, north = points.max(axis=0)
+    return [float(west), float(south), float(east), float(north)]
+
+
+class BrandZoneStore:
+    """Brand zones from `path`, validated with `model` and kept pre-serialized"""
+
+    def __init__(self, path: Path, model, check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.path = Path(path)
+        self.model = model
+        self.check_interval = check_interval
+        self.zones: List[dict] = []
+        self.body = b"[]"
+        self.etag = '"empty"'
+        self._signature: Optional[Tuple[int, int]] = None
+        self._listeners: List[Callable[[List[dict], List[dict]], None]] = []
+
+    def on_change(self, listener: Callable[[List[dict], List[dict]], None]):
+        """Register listener(old_zones, new_zones), called after every reload"""
+        self._listeners.append(listener)
+
+    def _file_signature(self) -> Tuple[int, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Read and validate the config file; raises on a missing or invalid file"""
+        self._signature = self._file_signature()
+        raw = json.loads(self.path.read_text())
+        zones = []
+        for entry in raw:
+            coordinates = entry["coordinates"]
+            zone = self.model(
+                **entry,
+                area=round(ring_area(coordinates), 8),
+                bounds=ring_bounds(coordinates),
+            )
+            zones.append(zone.model_dump())
+
+        ids = [zone["id"] for zone in zones]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Duplicate brand zone id")
+
+        old = self.zones
+        self.zones = zones
+        self.body = json.dumps(zones, separators=(",", ":")).encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        for listener in self._listeners:
+            listener(old, zones)
+
+    def refresh(self) -> bool:
+        """Reload if the file changed since the last load; True if it did
+
+        A broken edit is logged and the last good zones stay in service until
+        the file changes again.
+        """
+        try:
+            if self._file_signature() == self._signature:
+                return False
+            self.load()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("Keeping previous brand zones; failed to reload %s: %s", self.path, e)
+            return False
+        logger.info("Reloaded %d brand zones from %s", len(self.zones), self.path)
+        return True
+
+    async def watch(self):
+        """Poll for changes until cancelled"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.refresh()
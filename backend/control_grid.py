@@ -0,0 +1,174 @@
+"""Hierarchical square grid over the game area and the `cell_control` table.
+
+Level L splits the Bannerghatta bounds into 2^L x 2^L cells. Territories are
+rasterized once, at BASE_LEVEL, by testing which base cell centers they
+contain, and the cell list is stored on the territory (`grid_cells`) so
+claims and deletes never rasterize again; a cell at a coarser level is the
+sum of its base cells. Each
+`cell_control` document holds, for one (level, x, y), the number of base
+cells each owner covers there:
+
+    {"level": 6, "x": 17, "y": 40, "owners": {"<user key>": 12, ...}}
+
+Creates, claims and deletes `apply` `$inc` deltas to the cells the territory
+touches, so the control map is read straight from this table. Counts are
+integers, so repeated updates never drift. Ground outside the bounds is
+ignored.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from pymongo import UpdateOne
+
+
+# [west, south, east, north]
+BOUNDS = (77.57, 12.87, 77.63, 12.92)
+
+# Base cells are ~6.5 m x 5.4 m
+BASE_LEVEL = 10
+# Finest level served and stored in cell_control: ~52 m x 43 m
+MAX_CONTROL_LEVEL = 7
+
+
+def grid_size(level: int) -> int:
+    return 1 << level
+
+
+def cell_span(level: int) -> Tuple[float, float]:
+    """(lng, lat) size of one cell at `level`"""
+    west, south, east, north = BOUNDS
+    n = grid_size(level)
+    return (east - west) / n, (north - south) / n
+
+
+def cell_bounds(level: int, x: int, y: int) -> List[float]:
+    west, south, _, _ = BOUNDS
+    dx, dy = cell_span(level)
+    return [west + x * dx, south + y * dy, west + (x + 1) * dx, south + (y + 1) * dy]
+
+
+def cell_range(level: int, bbox: Tuple[float, float, float, float]) -> Optional[Tuple[int, int, int, int]]:
+    """Inclusive (x0, y0, x1, y1) cell indexes overlapping bbox, or None outside the grid"""
+    west, south, east, north = BOUNDS
+    b_west, b_south, b_east, b_north = bbox
+    if b_east <= west or b_west >= east or b_north <= south or b_south >= north:
+        return None
+    dx, dy = cell_span(level)
+    last = grid_size(level) - 1
+    x0 = min(last, max(0, int((b_west - west) // dx)))
+    y0 = min(last, max(0, int((b_south - south) // dy)))
+    x1 = min(last, max(0, int((b_east - west) // dx)))
+    y1 = min(last, max(0, int((b_north - south) // dy)))
+    return x0, y0, x1, y1
+
+
+def covered_cells(geometry: Optional[dict]) -> np.ndarray:
+    """(n, 2) array of base-level (x, y) cells whose centers lie inside a GeoJSON geometry"""
+    if not geometry:
+        return np.empty((0, 2), dtype=np.int64)
+    polygon = shape(geometry)
+    cells = cell_range(BASE_LEVEL, polygon.bounds)
+    if cells is None:
+        return np.empty((0, 2), dtype=np.int64)
+
+    x0, y0, x1, y1 = cells
+    west, south, _, _ = BOUNDS
+    dx, dy = cell_span(BASE_LEVEL)
+    xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+    xs, ys = xs.ravel(), ys.ravel()
+    shapely.prepare(polygon)
+    inside = shapely.contains_xy(polygon, west + (xs + 0.5) * dx, south + (ys + 0.5) * dy)
+    return np.column_stack([xs[inside], ys[inside]])
+
+
+def pack_cells(cells: np.ndarray) -> bytes:
+    """Base cells as little-endian uint16 (x, y) pairs; indexes are below 2^BASE_LEVEL"""
+    return cells.astype("<u2").tobytes()
+
+
+def unpack_cells(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype="<u2").reshape(-1, 2).astype(np.int64)
+
+
+def territory_cells(doc: dict) -> np.ndarray:
+    """A territory's base cells: the list stored at ingest, else rasterized from its geometry"""
+    packed = doc.get("grid_cells")
+    if packed is not None:
+        return unpack_cells(bytes(packed))
+    return covered_cells(doc.get("geometry"))
+
+
+def level_counts(cells: np.ndarray, level: int) -> Dict[Tuple[int, int], int]:
+    """Base cells per enclosing cell at `level`"""
+    if len(cells) == 0:
+        return {}
+    parents, counts = np.unique(cells >> (BASE_LEVEL - level), axis=0, return_counts=True)
+    return {(int(x), int(y)): int(n) for (x, y), n in zip(parents, counts)}
+
+
+def owner_key(user_id: str) -> str:
+    """User id escaped for use as a field name under `owners`"""
+    return user_id.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def owner_id(key: str) -> str:
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+def _control_ops(cells: np.ndarray, deltas: Dict[str, int]) -> List[UpdateOne]:
+    """$inc ops applying `deltas` (owner -> +1/-1 multiplier) to every touched cell"""
+    ops = []
+    for level in range(MAX_CONTROL_LEVEL + 1):
+        for (x, y), count in level_counts(cells, level).items():
+            inc = {f"owners.{owner_key(user)}": sign * count for user, sign in deltas.items()}
+            ops.append(UpdateOne({"level": level, "x": x, "y": y}, {"$inc": inc}, upsert=True))
+    return ops
+
+
+async def apply(db, cells: np.ndarray, deltas: Dict[str, int]):
+    """Add (+1) or remove (-1) a territory's rasterized cells for each owner in `deltas`"""
+    ops = _control_ops(cells, deltas)
+    if ops:
+        await db.cell_control.bulk_write(ops, ordered=False)
+
+
+def control_cell(doc: dict) -> Optional[dict]:
+    """API row for a cell_control document: dominant owner and coverage, None if empty"""
+    owners = {key: count for key, count in doc.get("owners", {}).items() if count > 0}
+    if not owners:
+        return None
+    capacity = 1 << (2 * (BASE_LEVEL - doc["level"]))
+    dominant = max(owners, key=owners.get)
+    return {
+        "x": doc["x"],
+        "y": doc["y"],
+        "bounds": cell_bounds(doc["level"], doc["x"], doc["y"]),
+        "owner_id": owner_id(dominant),
+        "owner_coverage": round(owners[dominant] / capacity, 4),
+        # Overlapping territories count once each, so this is capped at 1
+        "coverage": round(min(1.0, sum(owners.values()) / capacity), 4),
+        "contenders": len(owners),
+    }
+
+
+async def rebuild(db, batch_size: int = 1000) -> dict:
+    """Recompute cell_control from every territory"""
+    await db.cell_control.delete_many({})
+    totals: Dict[Tuple[int, int, int], Dict[str, int]] = {}
+    scanned = 0
+    cursor = db.territories.find({}, {"_id": 0, "user_id": 1, "geometry": 1, "grid_cells": 1}).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        cells = territory_cells(doc)
+        key = owner_key(doc["user_id"])
+        for level in range(MAX_CONTROL_LEVEL + 1):
+            for (x, y), count in level_counts(cells, level).items():
+                owners = totals.setdefault((level, x, y), {})
+                owners[key] = owners.get(key, 0) + count
+
+    docs = [{"level": level, "x": x, "y": y, "owners": owners} for (level, x, y), owners in totals.items()]
+    for start in range(0, len(docs), batch_size):
+        await db.cell_control.insert_many(docs[start:start + batch_size], ordered=False)
+    return {"scanned": scanned, "cells": len(docs)}
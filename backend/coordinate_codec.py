@@ -0,0 +1,147 @@
+"""Compact encodings for territory coordinate rings.
+
+Packed storage format (BSON binary, `coordinates_packed` and `lod.*`):
+    byte 0      format version
+    bytes 1..   zigzag varints of (lng, lat) deltas in integer micro-degrees
+
+Wire format: Google encoded polyline (lat, lng order) at 1e5 or 1e6 precision.
+"""
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from geometry import ring_to_array
+
+
+MICRODEGREES = 1_000_000
+PACKED_FORMAT_VERSION = 1
+POLYLINE_PRECISIONS = {"polyline": 5, "polyline6": 6}
+
+
+def to_microdegrees(coordinates: Sequence[Sequence[float]]) -> np.ndarray:
+    """(n, 2) int64 array of [lng, lat] in micro-degrees"""
+    return np.rint(ring_to_array(coordinates) * MICRODEGREES).astype(np.int64)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _unzigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def _chunks(values: np.ndarray, bits: int, continuation: int) -> np.ndarray:
+    """Split unsigned values into little-endian `bits`-wide chunks with a continuation flag"""
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    mask = (1 << bits) - 1
+    max_chunks = max(1, -(-int(values.max()).bit_length() // bits))
+    shifts = (np.arange(max_chunks, dtype=np.uint64) * np.uint64(bits))
+    parts = (values[:, None] >> shifts) & np.uint64(mask)
+
+    # Number of chunks needed per value (at least one, even for zero)
+    remaining = values[:, None] >> shifts
+    counts = np.maximum((remaining > 0).sum(axis=1), 1)
+    keep = np.arange(max_chunks) < counts[:, None]
+    more = np.arange(max_chunks) < (counts - 1)[:, None]
+
+    parts = parts | np.where(more, np.uint64(continuation), np.uint64(0))
+    return parts[keep].astype(np.uint8)
+
+
+def _unchunk(data: np.ndarray, bits: int, continuation: int) -> np.ndarray:
+    """Inverse of `_chunks`"""
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    last = (data & continuation) == 0
+    group = np.cumsum(last) - last
+    starts = np.flatnonzero(np.r_[True, last[:-1]])
+    position = np.arange(len(data)) - starts[group]
+
+    payload = (data & ((1 << bits) - 1)).astype(np.uint64) << (position * bits).astype(np.uint64)
+    values = np.zeros(int(last.sum()), dtype=np.uint64)
+    np.add.at(values, group, payload)
+    return values
+
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    """Map signed ints to unsigned (0, -1, 1, -2 -> 0, 1, 2, 3)"""
+    return _zigzag(np.asarray(values, dtype=np.int64))
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Protobuf-style base-128 varints for unsigned ints"""
+    return _chunks(np.asarray(values, dtype=np.uint64), 7, 0x80).tobytes()
+
+
+def pack_microdegrees(micro: np.ndarray) -> bytes:
+    deltas = np.diff(micro, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    body = _chunks(_zigzag(deltas.ravel()), 7, 0x80)
+    return bytes([PACKED_FORMAT_VERSION]) + body.tobytes()
+
+
+def pack_coordinates(coordinates: Sequence[Sequence[float]]) -> bytes:
+    """Delta + varint encode a [[lng, lat], ...] ring for BSON binary storage"""
+    return pack_microdegrees(to_microdegrees(coordinates))
+
+
+def pack_lod_rings(lod: Dict[str, Sequence[Sequence[float]]]) -> Dict[str, bytes]:
+    """Pack every plain ring in a `lod` mapping; already packed rings are kept"""
+    return {key: ring if isinstance(ring, bytes) else pack_coordinates(ring) for key, ring in lod.items()}
+
+
+def unpack_microdegrees(data: bytes) -> np.ndarray:
+    if not data or data[0] != PACKED_FORMAT_VERSION:
+        raise ValueError("Unsupported packed coordinate format")
+    raw = np.frombuffer(data, dtype=np.uint8, offset=1)
+    deltas = _unzigzag(_unchunk(raw, 7, 0x80)).reshape(-1, 2)
+    return np.cumsum(deltas, axis=0)
+
+
+def unpack_coordinates(data: bytes) -> List[List[float]]:
+    return (unpack_microdegrees(data) / MICRODEGREES).tolist()
+
+
+def encode_polyline(micro: np.ndarray, precision: int = 5) -> str:
+    """Google encoded polyline from [lng, lat] micro-degrees"""
+    if precision != 6:
+        micro = np.rint(micro / 10 ** (6 - precision)).astype(np.int64)
+    lat_lng = micro[:, ::-1]
+    deltas = np.diff(lat_lng, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    chunks = _chunks(_zigzag(deltas.ravel()), 5, 0x20)
+    return (chunks + 63).tobytes().decode("ascii")
+
+
+def decode_polyline(polyline: str, precision: int = 5) -> List[List[float]]:
+    """[[lng, lat], ...] from a Google encoded polyline"""
+    data = np.frombuffer(polyline.encode("ascii"), dtype=np.uint8) - 63
+    deltas = _unzigzag(_unchunk(data, 5, 0x20)).reshape(-1, 2)
+    lat_lng = np.cumsum(deltas, axis=0) / 10 ** precision
+    return lat_lng[:, ::-1].tolist()
+
+
+def doc_microdegrees(doc: dict) -> np.ndarray:
+    """Micro-degree ring for a territory document in either storage form"""
+    packed = doc.get("coordinates_packed")
+    if packed is not None:
+        return unpack_microdegrees(bytes(packed))
+    return to_microdegrees(doc.get("coordinates") or [])
+
+
+def expand_coordinates(doc: dict) -> dict:
+    """Replace `coordinates_packed` with a plain `coordinates` array, in place"""
+    packed = doc.pop("coordinates_packed", None)
+    if packed is not None:
+        doc["coordinates"] = unpack_coordinates(bytes(packed))
+    return doc
+
+
+def encode_coordinates(doc: dict, encoding: str) -> dict:
+    """Replace coordinates with an encoded polyline, in place"""
+    micro = doc_microdegrees(doc)
+    doc.pop("coordinates", None)
+    doc.pop("coordinates_packed", None)
+    doc["polyline"] = encode_polyline(micro, POLYLINE_PRECISIONS[encoding])
+    return doc
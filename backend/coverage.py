@@ -0,0 +1,148 @@
+"""Distinct ground covered per user, kept as a count bitmap over the control grid.
+
+For each user, every base cell of `control_grid` holds the number of that
+user's territories covering it. Cells are grouped into `user_coverage`
+documents, one per (user, level-4 tile of 64 x 64 base cells):
+
+    {"user_id": "...", "tx": 5, "ty": 9, "cells": {"12_40": 2, "13_40": 1, ...}}
+
+Adding a territory increments its cells with one atomic update per tile it
+overlaps. Cells that reach 1 were newly covered, so `covered_cells` in
+`leaderboard_stats` grows only by new ground; on removal, cells that
+reach 0 shrink it. Looping the same park ten times therefore counts it once.
+
+Ground outside the grid has no cells to count, so the part of a territory
+beyond `BOUNDS` is added to `outside_area` at its polygon area instead. A
+user's total area is always covered cells plus `outside_area`, whether or
+not any of their runs touch the grid.
+"""
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pymongo import ReturnDocument, UpdateOne
+from shapely.geometry import box, shape
+
+from control_grid import BASE_LEVEL, BOUNDS, cell_span, territory_cells
+from geometry import ring_area
+
+
+TILE_LEVEL = 4
+TILE_SHIFT = BASE_LEVEL - TILE_LEVEL
+TILE_MASK = (1 << TILE_SHIFT) - 1
+
+
+def _cell_area_km2() -> float:
+    # Cells shrink by <0.1% across the game area; use the one at its center
+    west, south, east, north = BOUNDS
+    dx, dy = cell_span(BASE_LEVEL)
+    lat = (south + north) / 2
+    return ring_area([[0, lat], [dx, lat], [dx, lat + dy], [0, lat + dy], [0, lat]])
+
+
+CELL_AREA_KM2 = _cell_area_km2()
+
+
+def covered_area(covered: int) -> float:
+    """Distinct area in sq km for a number of covered base cells"""
+    return covered * CELL_AREA_KM2
+
+
+def outside_area(geometry: Optional[dict], area: float) -> float:
+    """Share in sq km of a territory of `area` that lies outside the grid"""
+    if not geometry or not area:
+        return 0.0
+    polygon = shape(geometry)
+    if polygon.area == 0:
+        return 0.0
+    inside = polygon.intersection(box(*BOUNDS)).area / polygon.area
+    return area * max(0.0, 1.0 - inside)
+
+
+def territory_outside_area(doc: dict) -> float:
+    """A territory's outside area: the value stored at ingest, else computed from its geometry"""
+    stored = doc.get("outside_area")
+    if stored is not None:
+        return stored
+    return outside_area(doc.get("geometry"), doc.get("area"))
+
+
+def total_area(stats: dict) -> float:
+    """Distinct area in sq km for a leaderboard_stats row"""
+    return covered_area(stats.get("covered_cells", 0)) + stats.get("outside_area", 0.0)
+
+
+def tile_keys(cells: np.ndarray) -> Dict[Tuple[int, int], List[str]]:
+    """Base cells grouped by tile, as the field names used under `cells`"""
+    tiles: Dict[Tuple[int, int], List[str]] = {}
+    for x, y in cells.tolist():
+        tiles.setdefault((x >> TILE_SHIFT, y >> TILE_SHIFT), []).append(f"{x & TILE_MASK}_{y & TILE_MASK}")
+    return tiles
+
+
+async def _update_tile(db, user_id: str, tile: Tuple[int, int], keys: List[str], sign: int) -> int:
+    """Apply +/-1 to a tile's cells; returns the change in the user's covered cells"""
+    doc = await db.user_coverage.find_one_and_update(
+        {"user_id": user_id, "tx": tile[0], "ty": tile[1]},
+        {"$inc": {f"cells.{key}": sign for key in keys}},
+        projection={"_id": 0, **{f"cells.{key}": 1 for key in keys}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    # Each territory adds at most 1 per cell, so these are exactly the cells it flipped
+    flipped = 1 if sign > 0 else 0
+    counts = doc.get("cells", {})
+    return sign * sum(1 for key in keys if counts.get(key) == flipped)
+
+
+async def apply(db, cells: np.ndarray, deltas: Dict[str, int], outside: float = 0.0):
+    """Add (+1) or remove (-1) a territory's cells and `outside_area` for each user in `deltas`"""
+    tiles = tile_keys(cells)
+
+    async def apply_user(user_id: str, sign: int):
+        changes = await asyncio.gather(*(
+            _update_tile(db, user_id, tile, keys, sign) for tile, keys in tiles.items()
+        ))
+        # $inc by 0 still creates the fields, so every row is on the same definition
+        await db.leaderboard_stats.update_one(
+            {"user_id": user_id},
+            {"$inc": {"covered_cells": sum(changes), "outside_area": sign * outside}},
+            upsert=True,
+        )
+
+    # A claim's two owners touch disjoint documents, so neither waits on the other
+    await asyncio.gather(*(apply_user(user_id, sign) for user_id, sign in deltas.items()))
+
+
+async def rebuild(db, batch_size: int = 1000) -> dict:
+    """Recompute user_coverage, covered_cells and outside_area from every territory"""
+    await db.user_coverage.delete_many({})
+    counts: Dict[Tuple[str, int, int], Dict[str, int]] = {}
+    outside: Dict[str, float] = {}
+    scanned = 0
+    projection = {"_id": 0, "user_id": 1, "geometry": 1, "area": 1, "grid_cells": 1, "outside_area": 1}
+    cursor = db.territories.find({}, projection).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        outside[doc["user_id"]] = outside.get(doc["user_id"], 0.0) + territory_outside_area(doc)
+        for (tx, ty), keys in tile_keys(territory_cells(doc)).items():
+            tile = counts.setdefault((doc["user_id"], tx, ty), {})
+            for key in keys:
+                tile[key] = tile.get(key, 0) + 1
+
+    covered: Dict[str, int] = dict.fromkeys(outside, 0)
+    docs = []
+    for (user_id, tx, ty), cells in counts.items():
+        docs.append({"user_id": user_id, "tx": tx, "ty": ty, "cells": cells})
+        covered[user_id] = covered.get(user_id, 0) + len(cells)
+    for start in range(0, len(docs), batch_size):
+        await db.user_coverage.insert_many(docs[start:start + batch_size], ordered=False)
+
+    await db.leaderboard_stats.update_many({}, {"$set": {"covered_cells": 0, "outside_area": 0.0}})
+    if covered:
+        await db.leaderboard_stats.bulk_write([
+            UpdateOne({"user_id": user_id},
+                      {"$set": {"covered_cells": cells, "outside_area": outside[user_id]}}, upsert=True)
+            for user_id, cells in covered.items()
+        ], ordered=False)
+    return {"scanned": scanned, "users": len(covered), "tiles": len(docs)}
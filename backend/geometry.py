@@ -0,0 +1,186 @@
+"""Geodesic geometry helpers for territory polygons."""
+from itertools import chain
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import shapely
+
+
+# Same spherical model as turf.area on the client, so server and client agree
+EARTH_RADIUS_M = 6378137.0
+SQ_M_PER_SQ_KM = 1_000_000.0
+
+
+def ring_to_array(ring: Sequence[Sequence[float]]) -> np.ndarray:
+    """Convert a [[lng, lat], ...] ring to an (n, 2) float array"""
+    n = len(ring)
+    if n == 0:
+        return np.empty((0, 2), dtype=np.float64)
+    flat = np.fromiter(chain.from_iterable(ring), dtype=np.float64, count=2 * n)
+    return flat.reshape(n, 2)
+
+
+def _open_ring(points: np.ndarray) -> np.ndarray:
+    """Drop the closing vertex if the ring repeats its first point"""
+    if len(points) > 1 and points[0, 0] == points[-1, 0] and points[0, 1] == points[-1, 1]:
+        return points[:-1]
+    return points
+
+
+def ring_area(ring: Sequence[Sequence[float]]) -> float:
+    """Geodesic area of a single ring in sq km"""
+    points = _open_ring(ring_to_array(ring))
+    if len(points) < 3:
+        return 0.0
+
+    lng = np.radians(points[:, 0])
+    sin_lat = np.sin(np.radians(points[:, 1]))
+    total = np.dot(np.roll(lng, -1) - np.roll(lng, 1), sin_lat)
+    return abs(float(total)) * EARTH_RADIUS_M ** 2 / 2 / SQ_M_PER_SQ_KM
+
+
+def ring_areas(rings: Sequence[Sequence[Sequence[float]]]) -> np.ndarray:
+    """Geodesic areas (sq km) for many rings in one vectorized pass"""
+    if len(rings) == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    lengths = np.fromiter((len(r) for r in rings), dtype=np.int64, count=len(rings))
+    flat = np.fromiter(
+        chain.from_iterable(chain.from_iterable(rings)),
+        dtype=np.float64,
+        count=2 * int(lengths.sum()),
+    )
+    points = flat.reshape(-1, 2)
+
+    # Drop closing vertices of closed rings so every ring is "open"
+    ends = np.cumsum(lengths) - 1
+    starts = ends - lengths + 1
+    has_points = lengths > 1
+    closed = np.zeros(len(rings), dtype=bool)
+    closed[has_points] = np.all(points[starts[has_points]] == points[ends[has_points]], axis=1)
+    if closed.any():
+        keep = np.ones(len(points), dtype=bool)
+        keep[ends[closed]] = False
+        points = points[keep]
+        lengths = lengths - closed
+
+    areas = np.zeros(len(rings), dtype=np.float64)
+    valid = lengths >= 3
+    if not valid.any():
+        return areas
+
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ring_start = np.repeat(starts, lengths)
+    ring_len = np.repeat(lengths, lengths)
+    local = np.arange(len(points)) - ring_start
+    nxt = ring_start + (local + 1) % ring_len
+    prv = ring_start + (local - 1) % ring_len
+
+    lng = np.radians(points[:, 0])
+    sin_lat = np.sin(np.radians(points[:, 1]))
+    terms = (lng[nxt] - lng[prv]) * sin_lat
+
+    sums = np.add.reduceat(terms, starts[valid])
+    areas[valid] = np.abs(sums) * EARTH_RADIUS_M ** 2 / 2 / SQ_M_PER_SQ_KM
+    return areas
+
+
+def polygon_area(rings: Sequence[Sequence[Sequence[float]]]) -> float:
+    """Geodesic area (sq km) of a polygon given as [outer, *holes]"""
+    if not rings:
+        return 0.0
+    areas = ring_areas(rings)
+    return max(float(areas[0] - areas[1:].sum()), 0.0)
+
+
+def territory_areas(coordinate_lists: List[List[List[float]]]) -> List[float]:
+    """Areas for a batch of territory coordinate lists, rounded for storage"""
+    return [round(float(a), 8) for a in ring_areas(coordinate_lists)]
+
+
+# ========================
+# GeoJSON / 2dsphere helpers
+# ========================
+
+def _polygon_rings(polygon) -> List[List[List[float]]]:
+    """GeoJSON rings (closed [lng, lat] lists) for a shapely Polygon"""
+    rings = [np.asarray(polygon.exterior.coords).tolist()]
+    rings.extend(np.asarray(hole.coords).tolist() for hole in polygon.interiors)
+    return rings
+
+
+def territory_geometry(coordinates: Sequence[Sequence[float]]) -> Optional[dict]:
+    """GeoJSON geometry for a territory ring, repaired so 2dsphere accepts it
+
+    GPS loops often touch or cross themselves; those are split into a
+    MultiPolygon. Returns None when the ring does not enclose any area.
+    """
+    points = _open_ring(ring_to_array(coordinates))
+    if len(points) < 3:
+        return None
+
+    # 2dsphere rejects repeated consecutive vertices
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[keep]
+    if len(points) < 3:
+        return None
+
+    polygon = shapely.Polygon(points)
+    if not polygon.is_valid:
+        polygon = shapely.make_valid(polygon)
+
+    parts = [
+        part for part in shapely.get_parts(shapely.get_parts(polygon))
+        if part.geom_type == "Polygon" and not part.is_empty and part.area > 0
+    ]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return {"type": "Polygon", "coordinates": _polygon_rings(parts[0])}
+    return {"type": "MultiPolygon", "coordinates": [_polygon_rings(p) for p in parts]}
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """Parse a "west,south,east,north" string into a validated bbox"""
+    try:
+        west, south, east, north = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("bbox must be 'west,south,east,north'")
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError("bbox is out of range or inverted")
+    return west, south, east, north
+
+
+def parse_point(value: str) -> Tuple[float, float]:
+    """Parse a "lng,lat" string into a validated point"""
+    try:
+        lng, lat = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("point must be 'lng,lat'")
+    if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+        raise ValueError("point is out of range")
+    return lng, lat
+
+
+def bbox_geometry(west: float, south: float, east: float, north: float) -> dict:
+    """GeoJSON Polygon covering a bbox, for $geoIntersects queries"""
+    return {
+        "type": "Polygon",
+        "coordinates": [[
+            [west, south], [east, south], [east, north], [west, north], [west, south],
+        ]],
+    }
+
+
+def shape_area(geom) -> float:
+    """Geodesic area (sq km) of any shapely geometry; non-polygonal parts count as 0"""
+    total = 0.0
+    for part in shapely.get_parts(geom):
+        if part.geom_type == "Polygon" and not part.is_empty:
+            rings = [np.asarray(part.exterior.coords)]
+            rings.extend(np.asarray(hole.coords) for hole in part.interiors)
+            total += polygon_area(rings)
+        elif part.geom_type in ("MultiPolygon", "GeometryCollection"):
+            total += shape_area(part)
+    return total
@@ -0,0 +1,130 @@
+"""Activity heatmap rasters binned from the `cell_control` table.
+
+Each cell_control document already counts the base cells covered inside one
+grid cell, summed over every owner and every overlapping territory. A heatmap
+is those counts re-binned onto a raster for the viewport with
+`numpy.histogram2d`, weighted by count at each cell's center, so no polygon
+is loaded. The grid level read is the coarsest one whose cells are no larger
+than a pixel, capped at MAX_CONTROL_LEVEL; past that zoom the raster stays at
+that resolution and the client scales it up.
+
+Encoded rasters are served through the server's response cache, depending
+on the `cell_control` version: territory writes bump it once their update
+has landed, so with shared versions every worker drops its rasters too.
+"""
+import io
+import math
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+from control_grid import BOUNDS, MAX_CONTROL_LEVEL, cell_range, cell_span
+
+
+# Web map pixels per tile side; zoom z then spans 360 / (256 * 2^z) degrees per pixel
+TILE_PIXELS = 256
+MAX_RASTER_SIDE = 1024
+
+FORMATS = ("png", "uint16")
+PNG_MEDIA_TYPE = "image/png"
+UINT16_MEDIA_TYPE = "application/octet-stream"
+
+# (position, r, g, b, a) stops over log-scaled intensity; empty pixels are transparent
+_RAMP = np.array([
+    [0.0, 255, 237, 160, 0],
+    [0.3, 254, 178, 76, 170],
+    [0.65, 240, 59, 32, 210],
+    [1.0, 189, 0, 38, 240],
+])
+
+
+class Raster:
+    """Binned counts for a bbox, row 0 at the north edge"""
+
+    def __init__(self, counts: np.ndarray, bounds: Tuple[float, float, float, float], level: int):
+        self.counts = counts
+        self.bounds = bounds
+        self.level = level
+
+    @property
+    def width(self) -> int:
+        return self.counts.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.counts.shape[0]
+
+
+def raster_shape(bounds: Tuple[float, float, float, float], z: int) -> Tuple[int, int, int]:
+    """(width, height, grid level) of the raster for a bbox at map zoom z"""
+    west, south, east, north = bounds
+    finest_dx, finest_dy = cell_span(MAX_CONTROL_LEVEL)
+    # Mercator pixels are square on the ground, so narrower in latitude
+    pixel_dx = 360.0 / (TILE_PIXELS * 2 ** z)
+    pixel_dy = pixel_dx * math.cos(math.radians((south + north) / 2))
+    pixel_dx = max(pixel_dx, finest_dx, (east - west) / MAX_RASTER_SIDE)
+    pixel_dy = max(pixel_dy, finest_dy, (north - south) / MAX_RASTER_SIDE)
+    width = max(1, math.ceil((east - west) / pixel_dx - 1e-9))
+    height = max(1, math.ceil((north - south) / pixel_dy - 1e-9))
+
+    grid_west, _, grid_east, _ = BOUNDS
+    level = math.ceil(math.log2(max(1.0, (grid_east - grid_west) / pixel_dx)) - 1e-9)
+    return width, height, min(MAX_CONTROL_LEVEL, level)
+
+
+def bin_cells(xs: np.ndarray, ys: np.ndarray, weights: np.ndarray, level: int,
+              bounds: Tuple[float, float, float, float], width: int, height: int) -> np.ndarray:
+    """Histogram of weighted cell centers onto a (height, width) raster, north row first"""
+    west, south, east, north = bounds
+    grid_west, grid_south, _, _ = BOUNDS
+    dx, dy = cell_span(level)
+    counts, _, _ = np.histogram2d(
+        grid_south + (ys + 0.5) * dy,
+        grid_west + (xs + 0.5) * dx,
+        bins=(height, width),
+        range=((south, north), (west, east)),
+        weights=weights,
+    )
+    return np.flipud(counts)
+
+
+async def build(db, bounds: Tuple[float, float, float, float], z: int) -> Raster:
+    """Bin cell_control counts inside bbox into a raster for map zoom z"""
+    width, height, level = raster_shape(bounds, z)
+    cells = cell_range(level, bounds)
+    if cells is None:
+        return Raster(np.zeros((height, width)), bounds, level)
+
+    x0, y0, x1, y1 = cells
+    query = {"level": level, "x": {"$gte": x0, "$lte": x1}, "y": {"$gte": y0, "$lte": y1}}
+    xs, ys, weights = [], [], []
+    async for doc in db.cell_control.find(query, {"_id": 0, "x": 1, "y": 1, "owners": 1}):
+        total = sum(count for count in doc.get("owners", {}).values() if count > 0)
+        if total:
+            xs.append(doc["x"])
+            ys.append(doc["y"])
+            weights.append(total)
+
+    counts = bin_cells(np.array(xs), np.array(ys), np.array(weights, dtype=np.float64),
+                       level, bounds, width, height)
+    return Raster(counts, bounds, level)
+
+
+def encode_uint16(raster: Raster) -> bytes:
+    """Little-endian uint16 counts, row-major from the north-west corner, saturating at 65535"""
+    return np.minimum(np.rint(raster.counts), 65535).astype("<u2").tobytes()
+
+
+def encode_png(raster: Raster) -> bytes:
+    """RGBA PNG with a log-scaled heat ramp"""
+    peak = raster.counts.max()
+    intensity = np.log1p(raster.counts) / math.log1p(peak) if peak > 0 else raster.counts
+    rgba = np.stack([np.interp(intensity, _RAMP[:, 0], _RAMP[:, i]) for i in range(1, 5)], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(np.rint(rgba).astype(np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def encode(raster: Raster, fmt: str) -> bytes:
+    return encode_png(raster) if fmt == "png" else encode_uint16(raster)
@@ -0,0 +1,229 @@
+"""Image proxy with a pooled upstream client, on-disk LRU cache and fetch coalescing.
+
+Each cached URL is two files in the cache directory, named by the SHA-256 of
+the URL: `<key>.body` (raw bytes) and `<key>.json` (content type, validators
+and fetch time). Stale entries are revalidated upstream with
+If-None-Match / If-Modified-Since, and served stale if the upstream is down.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FRESH_SECONDS = 3600
+DEFAULT_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class ImageProxyError(Exception):
+    """Upstream fetch failed and nothing usable is cached"""
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """Size-bounded LRU of upstream images on local disk"""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def body_path(self, key: str) -> Path:
+        return self.directory / f"{key}.body"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def temp_path(self, key: str) -> Path:
+        return self.directory / f"{key}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+
+    def load(self):
+        """Index entries left by a previous process, least recently used first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for stale in self.directory.glob("*.tmp"):
+            stale.unlink(missing_ok=True)
+        entries = []
+        for meta_path in self.directory.glob("*.json"):
+            body = meta_path.with_suffix(".body")
+            if not body.exists():
+                meta_path.unlink(missing_ok=True)
+                continue
+            entries.append((meta_path.stat().st_mtime, meta_path.stem, body.stat().st_size))
+        self._sizes.clear()
+        self.total_bytes = 0
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[dict]:
+        """Metadata for a cached URL (marking it recently used), or None"""
+        if key not in self._sizes:
+            return None
+        try:
+            meta = json.loads(self._meta_path(key).read_text())
+        except (OSError, ValueError):
+            self._drop(key)
+            return None
+        self._sizes.move_to_end(key)
+        return meta
+
+    def store(self, key: str, temp: Path, meta: dict):
+        """Move a fully downloaded body into place and record it"""
+        os.replace(temp, self.body_path(key))
+        self._meta_path(key).write_text(json.dumps(meta))
+        self.total_bytes += meta["size"] - self._sizes.pop(key, 0)
+        self._sizes[key] = meta["size"]
+        self._evict()
+
+    def touch(self, key: str, meta: dict):
+        """Persist refreshed metadata after a 304 revalidation"""
+        self._meta_path(key).write_text(json.dumps(meta))
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+
+    def _drop(self, key: str):
+        self.total_bytes -= self._sizes.pop(key, 0)
+        self._meta_path(key).unlink(missing_ok=True)
+        self.body_path(key).unlink(missing_ok=True)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._sizes:
+            self._drop(next(iter(self._sizes)))
+
+
+class ImageProxy:
+    """Fetches allowed upstream images through one pooled client and a disk cache
+
+    Concurrent requests for the same URL share a single upstream fetch; the
+    fetch is shielded so a client that disconnects does not abort it for the
+    others.
+    """
+
+    def __init__(self, cache: ImageCache, fresh_for: int = DEFAULT_FRESH_SECONDS,
+                 max_image_bytes: int = DEFAULT_MAX_IMAGE_BYTES):
+        self.cache = cache
+        self.fresh_for = fresh_for
+        self.max_image_bytes = max_image_bytes
+        self.client: Optional[httpx.AsyncClient] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def start(self, **client_options):
+        self.cache.load()
+        options = {
+            "timeout": 10.0,
+            "limits": httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            **client_options,
+        }
+        self.client = httpx.AsyncClient(**options)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def fetch(self, url: str) -> dict:
+        """Cache metadata for `url` after making sure its body is on disk"""
+        key = url_key(url)
+        meta = self.cache.get(key)
+        if meta and time.time() - meta["fetched_at"] < self.fresh_for:
+            return meta
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._refresh(url, key, meta))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def body_path(self, meta: dict) -> Path:
+        return self.cache.body_path(meta["key"])
+
+    async def open_body(self, url: str, meta: dict) -> Tuple[dict, BinaryIO]:
+        """Open the cached body behind `meta`; the handle stays readable if it is evicted
+
+        Eviction can unlink the body between `fetch` returning and the open;
+        then the URL is fetched once more.
+        """
+        try:
+            return meta, open(self.body_path(meta), "rb")
+        except FileNotFoundError:
+            pass
+        meta = await self.fetch(url)
+        try:
+            return meta, open(self.body_path(meta), "rb")
+        except FileNotFoundError as e:
+            raise ImageProxyError("Cached image was evicted while being served") from e
+
+    async def _refresh(self, url: str, key: str, meta: Optional[dict]) -> dict:
+        headers = {}
+        if meta and meta.get("upstream_etag"):
+            headers["If-None-Match"] = meta["upstream_etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        temp = self.cache.temp_path(key)
+        try:
+            async with self.client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 304 and meta:
+                    meta = {**meta, "fetched_at": time.time()}
+                    self.cache.touch(key, meta)
+                    return meta
+                response.raise_for_status()
+
+                digest = hashlib.sha256()
+                size = 0
+                with open(temp, "wb") as out:
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_image_bytes:
+                            raise ImageProxyError("Upstream image too large")
+                        digest.update(chunk)
+                        out.write(chunk)
+
+                fresh = {
+                    "key": key,
+                    "url": url,
+                    "content_type": response.headers.get("content-type", "image/png"),
+                    "upstream_etag": response.headers.get("etag"),
+                    "last_modified": response.headers.get("last-modified"),
+                    "etag": '"' + digest.hexdigest()[:32] + '"',
+                    "size": size,
+                    "fetched_at": time.time(),
+                }
+                self.cache.store(key, temp, fresh)
+                return fresh
+        except httpx.HTTPError as e:
+            if meta:
+                logger.warning("Serving stale %s after upstream error: %s", url, e)
+                return meta
+            raise ImageProxyError(f"Failed to fetch image: {e}") from e
+        finally:
+            temp.unlink(missing_ok=True)
+
+
+def iter_body(handle: BinaryIO) -> Iterator[bytes]:
+    """Read an open body in chunks, closing it at the end"""
+    with handle:
+        while True:
+            chunk = handle.read(STREAM_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
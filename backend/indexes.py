@@ -0,0 +1,217 @@
+"""Registry of every MongoDB index the backend relies on.
+
+`ensure_indexes` creates them at startup. `explain_query_shapes` runs
+`explain()` on the query shape behind each route and flags collection scans
+(see `python manage.py explain-queries`).
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        # Unique so a first-write upsert (PATCH preferences) cannot create two users
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Enforces one account per email; create_user relies on it instead of find-then-insert
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    "territories": [
+        IndexModel([("geometry", GEOSPHERE)]),
+        # Keyset pagination walks territories in id order; unique so a run is promoted at most once
+        IndexModel([("id", ASCENDING)], unique=True),
+        # ?user_id= listing, sorted by id
+        IndexModel([("user_id", ASCENDING), ("id", ASCENDING)]),
+        # Activity feeds: newest first, id breaks timestamp ties
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Bulk sync idempotency; only territories uploaded with a key are constrained
+        IndexModel(
+            [("user_id", ASCENDING), ("idempotency_key", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}},
+        ),
+    ],
+    "status_checks": [
+        IndexModel([("id", ASCENDING)]),
+    ],
+    "profile_pictures": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        # Blob reference checks before deleting a GridFS file
+        IndexModel([("original", ASCENDING)], sparse=True),
+        IndexModel([("thumbnails.64", ASCENDING)], sparse=True),
+        IndexModel([("thumbnails.256", ASCENDING)], sparse=True),
+    ],
+    # GridFS files for profile pictures, looked up by content digest
+    "profile_images.files": [
+        IndexModel([("metadata.sha256", ASCENDING)]),
+    ],
+    "leaderboard_stats": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("territory_count", DESCENDING)]),
+    ],
+    # Ownership changes, one per territory version
+    "claim_history": [
+        IndexModel([("territory_id", ASCENDING), ("version", ASCENDING)], unique=True),
+    ],
+    "runs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    # Per-user coverage bitmaps; one document per (user, tile)
+    "user_coverage": [
+        IndexModel([("user_id", ASCENDING), ("tx", ASCENDING), ("ty", ASCENDING)], unique=True),
+    ],
+    # Territory writes other workers replay into their overlap index; kept an hour
+    "territory_changes": [
+        IndexModel([("changed_at", ASCENDING)], expireAfterSeconds=3600),
+    ],
+    # Control map cells; one document per (level, x, y)
+    "cell_control": [
+        IndexModel([("level", ASCENDING), ("x", ASCENDING), ("y", ASCENDING)], unique=True),
+    ],
+}
+
+
+async def upgrade_unique_indexes(collection, models: List[IndexModel]) -> bool:
+    """Replace existing non-unique indexes that the registry now declares unique
+
+    Returns True if any index was rebuilt. If duplicates block the unique
+    build, the old index is restored and the duplicates are left to clean up.
+    """
+    existing = await collection.index_information()
+    upgraded = False
+    for model in models:
+        spec = model.document
+        name = spec["name"]
+        if not spec.get("unique") or name not in existing or existing[name].get("unique"):
+            continue
+        await collection.drop_index(name)
+        try:
+            await collection.create_indexes([model])
+            upgraded = True
+        except (DuplicateKeyError, OperationFailure) as e:
+            logger.error("Could not make %s.%s unique (duplicates?): %s", collection.name, name, e)
+            await collection.create_index(existing[name]["key"], name=name)
+    return upgraded
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create all registered indexes; returns index names per collection
+
+    Indexes that became unique are rebuilt in place. A collection whose
+    indexes cannot be built (e.g. duplicate emails blocking the unique index)
+    is logged and skipped so the app still starts.
+    """
+    created = {}
+    for collection, models in INDEXES.items():
+        try:
+            created[collection] = await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            # e.g. IndexOptionsConflict: an index registered as unique exists without it
+            if await upgrade_unique_indexes(db[collection], models):
+                try:
+                    created[collection] = await db[collection].create_indexes(models)
+                    continue
+                except OperationFailure as retry_error:
+                    e = retry_error
+            logger.error("Could not create indexes on %s: %s", collection, e)
+    return created
+
+
+# The query behind each route, with placeholder values. `sort` and `limit`
+# mirror the route so the planner sees the same shape.
+SAMPLE_POINT = {"type": "Point", "coordinates": [77.6006, 12.8988]}
+SAMPLE_BOX = {"type": "Polygon", "coordinates": [[
+    [77.59, 12.89], [77.61, 12.89], [77.61, 12.91], [77.59, 12.91], [77.59, 12.89],
+]]}
+SAMPLE_TIME = datetime(2025, 1, 1, tzinfo=timezone.utc)
+SAMPLE_TIME_CURSOR = {"$or": [
+    {"created_at": {"$lt": SAMPLE_TIME}},
+    {"created_at": SAMPLE_TIME, "id": {"$lt": "territory-id"}},
+]}
+
+QUERY_SHAPES = [
+    {"name": "create_user (email)", "collection": "users", "filter": {"email": "runner@example.com"}},
+    {"name": "get_user", "collection": "users", "filter": {"id": "user-id"}},
+    {"name": "get_status_checks", "collection": "status_checks",
+     "filter": {"id": {"$gt": "cursor"}}, "sort": [("id", 1)], "limit": 100},
+    {"name": "get_territory", "collection": "territories", "filter": {"id": "territory-id"}},
+    {"name": "get_territories", "collection": "territories",
+     "filter": {"id": {"$gt": "cursor"}}, "sort": [("id", 1)], "limit": 100},
+    {"name": "get_territories ?user_id", "collection": "territories",
+     "filter": {"user_id": "user-id"}, "sort": [("id", 1)], "limit": 100},
+    {"name": "get_territories ?bbox", "collection": "territories",
+     "filter": {"geometry": {"$geoIntersects": {"$geometry": SAMPLE_BOX}}}},
+    {"name": "get_territories ?near", "collection": "territories",
+     "filter": {"geometry": {"$nearSphere": {"$geometry": SAMPLE_POINT, "$maxDistance": 1000}}}},
+    {"name": "get_user_activity", "collection": "territories",
+     "filter": {"user_id": "user-id", "created_at": {"$gte": SAMPLE_TIME}},
+     "sort": [("created_at", -1), ("id", -1)], "limit": 50},
+    {"name": "get_user_activity (cursor)", "collection": "territories",
+     "filter": {"$and": [{"user_id": "user-id"}, SAMPLE_TIME_CURSOR]},
+     "sort": [("created_at", -1), ("id", -1)], "limit": 50},
+    {"name": "get_recent_activity", "collection": "territories",
+     "filter": {}, "sort": [("created_at", -1), ("id", -1)], "limit": 50},
+    {"name": "create_territories_bulk (retries)", "collection": "territories",
+     "filter": {"user_id": "user-id", "idempotency_key": "key"}},
+    {"name": "get_profile_picture", "collection": "profile_pictures", "filter": {"user_id": "user-id"}},
+    {"name": "release profile blobs", "collection": "profile_pictures",
+     "filter": {"$or": [{"original": "sha"}, {"thumbnails.64": "sha"}, {"thumbnails.256": "sha"}]}},
+    {"name": "open profile blob", "collection": "profile_images.files",
+     "filter": {"$or": [{"metadata.sha256": "sha"}, {"_id": "sha"}]}},
+    {"name": "get_leaderboard", "collection": "leaderboard_stats",
+     "filter": {"territory_count": {"$gt": 0}}, "sort": [("territory_count", -1)], "limit": 10},
+    {"name": "leaderboard stats update", "collection": "leaderboard_stats", "filter": {"user_id": "user-id"}},
+    {"name": "stream_run", "collection": "runs", "filter": {"id": "run-id"}},
+    {"name": "sync_territory_index", "collection": "territory_changes",
+     "filter": {"changed_at": {"$gte": SAMPLE_TIME}}},
+    {"name": "coverage tile update", "collection": "user_coverage",
+     "filter": {"user_id": "user-id", "tx": 5, "ty": 9}},
+    {"name": "get_control_map, get_heatmap", "collection": "cell_control",
+     "filter": {"level": 5, "x": {"$gte": 4, "$lte": 20}, "y": {"$gte": 4, "$lte": 20}}},
+]
+
+
+def plan_stages(plan: dict) -> List[str]:
+    """All stage names in an explain() plan tree"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def winning_plan(explain: dict) -> dict:
+    planner = explain.get("queryPlanner", {})
+    return planner.get("winningPlan", {})
+
+
+async def explain_query_shapes(db) -> dict:
+    """explain() each registered query shape; report the ones that scan a collection"""
+    shapes = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if "sort" in shape:
+            cursor = cursor.sort(shape["sort"])
+        if "limit" in shape:
+            cursor = cursor.limit(shape["limit"])
+        stages = plan_stages(winning_plan(await cursor.explain()))
+        shapes.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return {
+        "checked": len(shapes),
+        "collscans": [s["name"] for s in shapes if s["collscan"]],
+        "shapes": shapes,
+    }
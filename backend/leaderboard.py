@@ -0,0 +1,128 @@
+"""Materialized per-user leaderboard stats kept in `leaderboard_stats`.
+
+Territory writes apply `$inc` deltas here so leaderboard reads are an indexed
+sort instead of a full aggregation over `territories`.
+"""
+from typing import List
+
+from pymongo import DeleteOne, UpdateOne
+
+
+POINTS_PER_TERRITORY = 100
+STAT_FIELDS = ("territory_count", "total_area", "total_distance", "points")
+
+# Recomputes the stats from scratch; used by rebuild/verify
+STATS_PIPELINE = [
+    {"$group": {
+        "_id": "$user_id",
+        "territory_count": {"$sum": 1},
+        "total_area": {"$sum": "$area"},
+        "total_distance": {"$sum": "$distance"},
+    }},
+]
+
+
+def _delta(territory: dict, sign: int) -> dict:
+    return {
+        "territory_count": sign,
+        "total_area": sign * (territory.get("area") or 0.0),
+        "total_distance": sign * (territory.get("distance") or 0.0),
+        "points": sign * POINTS_PER_TERRITORY,
+    }
+
+
+def _inc_op(user_id: str, territory: dict, sign: int) -> UpdateOne:
+    return UpdateOne({"user_id": user_id}, {"$inc": _delta(territory, sign)}, upsert=True)
+
+
+async def record_territory_created(db, territory: dict):
+    await db.leaderboard_stats.update_one(
+        {"user_id": territory["user_id"]}, {"$inc": _delta(territory, 1)}, upsert=True
+    )
+
+
+async def record_territories_created(db, territories: List[dict]):
+    """Apply a batch of new territories with one $inc per owner"""
+    totals = {}
+    for territory in territories:
+        delta = _delta(territory, 1)
+        user_totals = totals.setdefault(territory["user_id"], dict.fromkeys(delta, 0))
+        for field, value in delta.items():
+            user_totals[field] += value
+    if totals:
+        await db.leaderboard_stats.bulk_write([
+            UpdateOne({"user_id": user_id}, {"$inc": inc}, upsert=True)
+            for user_id, inc in totals.items()
+        ], ordered=False)
+
+
+async def record_territory_deleted(db, territory: dict):
+    await db.leaderboard_stats.update_one(
+        {"user_id": territory["user_id"]}, {"$inc": _delta(territory, -1)}, upsert=True
+    )
+
+
+async def record_territory_claimed(db, territory: dict, previous_owner: str, new_owner: str):
+    """Move a territory's contribution from its previous owner to the new one"""
+    if previous_owner == new_owner:
+        return
+    await db.leaderboard_stats.bulk_write([
+        _inc_op(previous_owner, territory, -1),
+        _inc_op(new_owner, territory, 1),
+    ], ordered=False)
+
+
+def _expected_from_group(row: dict) -> dict:
+    return {
+        "user_id": row["_id"],
+        "territory_count": row["territory_count"],
+        "total_area": row["total_area"],
+        "total_distance": row["total_distance"],
+        "points": row["territory_count"] * POINTS_PER_TERRITORY,
+    }
+
+
+def _differs(actual: dict, expected: dict) -> bool:
+    for field in STAT_FIELDS:
+        a = actual.get(field, 0) or 0
+        e = expected.get(field, 0) or 0
+        # Float sums accumulate rounding error from repeated $inc
+        if abs(a - e) > 1e-6 * max(1.0, abs(e)):
+            return True
+    return False
+
+
+async def verify_stats(db, apply: bool = False) -> dict:
+    """Recompute stats from `territories`, report drift and optionally fix it"""
+    expected = {
+        row["_id"]: _expected_from_group(row)
+        async for row in db.territories.aggregate(STATS_PIPELINE)
+        if row["_id"] is not None
+    }
+    actual = {
+        doc["user_id"]: doc
+        async for doc in db.leaderboard_stats.find({}, {"_id": 0})
+    }
+
+    drift: List[dict] = []
+    ops = []
+    for user_id, exp in expected.items():
+        act = actual.get(user_id)
+        if act is None or _differs(act, exp):
+            drift.append({"user_id": user_id, "expected": exp, "actual": act})
+            # $set rather than replace, so covered_cells (kept by coverage.py) survives
+            ops.append(UpdateOne({"user_id": user_id}, {"$set": exp}, upsert=True))
+    for user_id, act in actual.items():
+        if user_id not in expected and any(act.get(f) for f in STAT_FIELDS):
+            drift.append({"user_id": user_id, "expected": None, "actual": act})
+            ops.append(DeleteOne({"user_id": user_id}))
+
+    if apply and ops:
+        await db.leaderboard_stats.bulk_write(ops, ordered=False)
+
+    return {
+        "users": len(expected),
+        "drifted": len(drift),
+        "fixed": len(ops) if apply else 0,
+        "drift": drift,
+    }
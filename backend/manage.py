@@ -0,0 +1,399 @@
+"""Maintenance commands for the CAPTURE backend.
+
+Usage:
+    python manage.py backfill-areas [--batch-size 1000] [--dry-run]
+    python manage.py migrate-geometry [--batch-size 1000] [--dry-run]
+    python manage.py pack-coordinates [--batch-size 1000] [--dry-run]
+    python manage.py build-lod [--batch-size 1000] [--dry-run] [--all]
+    python manage.py build-cells [--batch-size 1000] [--dry-run]
+    python manage.py verify-leaderboard
+    python manage.py rebuild-leaderboard
+    python manage.py rebuild-control [--batch-size 1000]
+    python manage.py rebuild-coverage [--batch-size 1000]
+    python manage.py migrate-profile-pictures [--dry-run]
+    python manage.py prune-profile-blobs
+    python manage.py migrate-datetimes [--batch-size 1000] [--dry-run]
+    python manage.py explain-queries
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import sys
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+import indexes
+import control_grid
+import coverage
+import leaderboard
+import profile_images
+from coordinate_codec import expand_coordinates, pack_coordinates, pack_lod_rings
+from geometry import territory_areas, territory_geometry
+from simplify import LOD_ZOOMS, build_lod_rings
+from server import client, db
+
+
+logger = logging.getLogger("capture.manage")
+
+
+async def backfill_areas(batch_size: int = 1000, dry_run: bool = False) -> dict:
+    """Recompute the geodesic area of every stored territory"""
+    scanned = 0
+    updated = 0
+
+    async def flush(batch):
+        nonlocal updated
+        areas = territory_areas([doc.get("coordinates") or [] for doc in batch])
+        ops = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"area": area}})
+            for doc, area in zip(batch, areas)
+            if doc.get("area") != area
+        ]
+        if ops and not dry_run:
+            result = await db.territories.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        elif ops:
+            updated += len(ops)
+
+    batch = []
+    cursor = db.territories.find(
+        {}, {"_id": 1, "coordinates": 1, "coordinates_packed": 1, "area": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        batch.append(expand_coordinates(doc))
+        scanned += 1
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    return {"scanned": scanned, "updated": updated, "dry_run": dry_run}
+
+
+async def migrate_geometry(batch_size: int = 1000, dry_run: bool = False) -> dict:
+    """Build the GeoJSON `geometry` field from `coordinates` and index it"""
+    scanned = 0
+    updated = 0
+    skipped = 0
+
+    async def flush(ops):
+        nonlocal updated
+        if ops and not dry_run:
+            result = await db.territories.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        else:
+            updated += len(ops)
+
+    ops = []
+    cursor = db.territories.find(
+        {"geometry": {"$exists": False}}, {"_id": 1, "coordinates": 1, "coordinates_packed": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        expand_coordinates(doc)
+        geometry = territory_geometry(doc.get("coordinates") or [])
+        if geometry is None:
+            skipped += 1
+            continue
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"geometry": geometry}}))
+        if len(ops) >= batch_size:
+            await flush(ops)
+            ops = []
+    await flush(ops)
+
+    if not dry_run:
+        await db.territories.create_index([("geometry", "2dsphere")])
+
+    return {"scanned": scanned, "updated": updated, "skipped": skipped, "dry_run": dry_run}
+
+
+async def pack_territory_coordinates(batch_size: int = 1000, dry_run: bool = False) -> dict:
+    """Convert plain `coordinates` and `lod` ring arrays to packed binary"""
+    scanned = 0
+    updated = 0
+
+    async def flush(ops):
+        nonlocal updated
+        if ops and not dry_run:
+            result = await db.territories.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        else:
+            updated += len(ops)
+
+    ops = []
+    plain = [{"coordinates": {"$type": "array"}}] + [{f"lod.{zoom}": {"$type": "array"}} for zoom in LOD_ZOOMS]
+    cursor = db.territories.find(
+        {"$or": plain}, {"_id": 1, "coordinates": 1, "lod": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        update = {"$set": {}}
+        if isinstance(doc.get("coordinates"), list):
+            update["$set"]["coordinates_packed"] = pack_coordinates(doc["coordinates"])
+            update["$unset"] = {"coordinates": ""}
+        if doc.get("lod"):
+            update["$set"]["lod"] = pack_lod_rings(doc["lod"])
+        ops.append(UpdateOne({"_id": doc["_id"]}, update))
+        if len(ops) >= batch_size:
+            await flush(ops)
+            ops = []
+    await flush(ops)
+
+    return {"scanned": scanned, "updated": updated, "dry_run": dry_run}
+
+
+async def build_lod(batch_size: int = 1000, dry_run: bool = False, rebuild_all: bool = False) -> dict:
+    """Build per-zoom simplified rings for territories that lack them"""
+    scanned = 0
+    updated = 0
+
+    async def flush(ops):
+        nonlocal updated
+        if ops and not dry_run:
+            result = await db.territories.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        else:
+            updated += len(ops)
+
+    ops = []
+    query = {} if rebuild_all else {"lod": {"$exists": False}}
+    cursor = db.territories.find(
+        query, {"_id": 1, "coordinates": 1, "coordinates_packed": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        # Rings of packed territories are stored packed too
+        packed = doc.get("coordinates_packed") is not None
+        lod = build_lod_rings(expand_coordinates(doc).get("coordinates") or [])
+        if not lod:
+            continue
+        if packed:
+            lod = pack_lod_rings(lod)
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"lod": lod}}))
+        if len(ops) >= batch_size:
+            await flush(ops)
+            ops = []
+    await flush(ops)
+
+    return {"scanned": scanned, "updated": updated, "dry_run": dry_run}
+
+
+async def build_cells(batch_size: int = 1000, dry_run: bool = False) -> dict:
+    """Store rasterized grid cells and outside area on territories that lack them"""
+    scanned = 0
+    updated = 0
+
+    async def flush(ops):
+        nonlocal updated
+        if ops and not dry_run:
+            result = await db.territories.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        else:
+            updated += len(ops)
+
+    ops = []
+    query = {"grid_cells": {"$exists": False}, "geometry": {"$exists": True}}
+    cursor = db.territories.find(query, {"_id": 1, "geometry": 1, "area": 1}).batch_size(batch_size)
+    async for doc in cursor:
+        scanned += 1
+        cells = control_grid.covered_cells(doc["geometry"])
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+            "grid_cells": control_grid.pack_cells(cells),
+            "outside_area": coverage.outside_area(doc["geometry"], doc.get("area")),
+        }}))
+        if len(ops) >= batch_size:
+            await flush(ops)
+            ops = []
+    await flush(ops)
+
+    return {"scanned": scanned, "updated": updated, "dry_run": dry_run}
+
+
+async def migrate_profile_pictures(dry_run: bool = False) -> dict:
+    """Move data-URL profile pictures into GridFS with thumbnails"""
+    scanned = 0
+    migrated = 0
+    failed = 0
+
+    cursor = db.profile_pictures.find({"image_data": {"$exists": True}}, {"_id": 1, "image_data": 1, "content_type": 1})
+    async for doc in cursor:
+        scanned += 1
+        try:
+            header, encoded = doc["image_data"].split(",", 1)
+            contents = base64.b64decode(encoded)
+            thumbnails = await asyncio.to_thread(profile_images.make_thumbnails, contents)
+        except ValueError as e:
+            logger.warning("skipping profile picture %s: %s", doc["_id"], e)
+            failed += 1
+            continue
+        migrated += 1
+        if dry_run:
+            continue
+
+        content_type = doc.get("content_type") or header[len("data:"):].split(";")[0]
+        update = {
+            "original": await profile_images.store_blob(db, contents, content_type),
+            "thumbnails": {
+                str(size): await profile_images.store_blob(db, data, profile_images.THUMBNAIL_FORMAT)
+                for size, data in thumbnails.items()
+            },
+            "size": len(contents),
+        }
+        await db.profile_pictures.update_one({"_id": doc["_id"]}, {"$set": update, "$unset": {"image_data": ""}})
+
+    return {"scanned": scanned, "migrated": migrated, "failed": failed, "dry_run": dry_run}
+
+
+# Timestamp fields written as ISO strings before they were stored as BSON dates
+DATETIME_FIELDS = {
+    "users": ["created_at"],
+    "status_checks": ["timestamp"],
+    "territories": ["created_at", "claimed_at"],
+    "claim_history": ["claimed_at"],
+    "profile_pictures": ["updated_at"],
+    "runs": ["started_at", "finished_at"],
+}
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ISO-8601 string to a UTC datetime; naive values are taken as UTC"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+async def migrate_datetimes(batch_size: int = 1000, dry_run: bool = False) -> dict:
+    """Convert ISO-string timestamps to native BSON datetimes"""
+    scanned = 0
+    updated = 0
+    failed = 0
+
+    async def flush(collection, ops):
+        nonlocal updated
+        if ops and not dry_run:
+            result = await db[collection].bulk_write(ops, ordered=False)
+            updated += result.modified_count
+        else:
+            updated += len(ops)
+
+    for collection, fields in DATETIME_FIELDS.items():
+        for field in fields:
+            ops = []
+            cursor = db[collection].find(
+                {field: {"$type": "string"}}, {"_id": 1, field: 1}
+            ).batch_size(batch_size)
+            async for doc in cursor:
+                scanned += 1
+                try:
+                    value = parse_timestamp(doc[field])
+                except ValueError:
+                    logger.warning("skipping %s %s: unparseable %s %r", collection, doc["_id"], field, doc[field])
+                    failed += 1
+                    continue
+                # Guard on the type so a concurrent rewrite of the field is not overwritten
+                ops.append(UpdateOne(
+                    {"_id": doc["_id"], field: {"$type": "string"}}, {"$set": {field: value}}
+                ))
+                if len(ops) >= batch_size:
+                    await flush(collection, ops)
+                    ops = []
+            await flush(collection, ops)
+
+    return {"scanned": scanned, "updated": updated, "failed": failed, "dry_run": dry_run}
+
+
+async def explain_queries() -> dict:
+    """Create the registered indexes, then explain() every route query shape"""
+    await indexes.ensure_indexes(db)
+    return await indexes.explain_query_shapes(db)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CAPTURE backend maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill-areas", help="Recompute territory areas from coordinates")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.add_argument("--dry-run", action="store_true")
+
+    migrate = subparsers.add_parser("migrate-geometry", help="Populate GeoJSON geometry for 2dsphere queries")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--dry-run", action="store_true")
+
+    pack = subparsers.add_parser("pack-coordinates", help="Store territory rings as packed binary")
+    pack.add_argument("--batch-size", type=int, default=1000)
+    pack.add_argument("--dry-run", action="store_true")
+
+    lod = subparsers.add_parser("build-lod", help="Build per-zoom simplified territory rings")
+    lod.add_argument("--batch-size", type=int, default=1000)
+    lod.add_argument("--dry-run", action="store_true")
+    lod.add_argument("--all", action="store_true", help="Rebuild rings that already exist")
+
+    cells = subparsers.add_parser("build-cells", help="Store rasterized grid cells on territories")
+    cells.add_argument("--batch-size", type=int, default=1000)
+    cells.add_argument("--dry-run", action="store_true")
+
+    subparsers.add_parser("verify-leaderboard", help="Report drift between leaderboard_stats and territories")
+    subparsers.add_parser("rebuild-leaderboard", help="Recompute leaderboard_stats from territories")
+
+    control = subparsers.add_parser("rebuild-control", help="Recompute the cell_control map from territories")
+    control.add_argument("--batch-size", type=int, default=1000)
+
+    covered = subparsers.add_parser("rebuild-coverage", help="Recompute per-user distinct coverage from territories")
+    covered.add_argument("--batch-size", type=int, default=1000)
+
+    pictures = subparsers.add_parser("migrate-profile-pictures", help="Move data-URL profile pictures into GridFS")
+    pictures.add_argument("--dry-run", action="store_true")
+
+    subparsers.add_parser("prune-profile-blobs", help="Delete profile image blobs no picture references")
+
+    datetimes = subparsers.add_parser("migrate-datetimes", help="Store ISO-string timestamps as BSON dates")
+    datetimes.add_argument("--batch-size", type=int, default=1000)
+    datetimes.add_argument("--dry-run", action="store_true")
+
+    subparsers.add_parser("explain-queries", help="Fail if any route query shape does a collection scan")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill-areas":
+        result = asyncio.run(backfill_areas(batch_size=args.batch_size, dry_run=args.dry_run))
+    elif args.command == "migrate-geometry":
+        result = asyncio.run(migrate_geometry(batch_size=args.batch_size, dry_run=args.dry_run))
+    elif args.command == "pack-coordinates":
+        result = asyncio.run(pack_territory_coordinates(batch_size=args.batch_size, dry_run=args.dry_run))
+    elif args.command == "build-lod":
+        result = asyncio.run(build_lod(batch_size=args.batch_size, dry_run=args.dry_run, rebuild_all=args.all))
+    elif args.command == "build-cells":
+        result = asyncio.run(build_cells(batch_size=args.batch_size, dry_run=args.dry_run))
+    elif args.command in ("verify-leaderboard", "rebuild-leaderboard"):
+        result = asyncio.run(leaderboard.verify_stats(db, apply=args.command == "rebuild-leaderboard"))
+        for row in result.pop("drift"):
+            logger.warning("drift for %s: expected=%s actual=%s", row["user_id"], row["expected"], row["actual"])
+    elif args.command == "rebuild-control":
+        result = asyncio.run(control_grid.rebuild(db, batch_size=args.batch_size))
+    elif args.command == "rebuild-coverage":
+        result = asyncio.run(coverage.rebuild(db, batch_size=args.batch_size))
+    elif args.command == "migrate-profile-pictures":
+        result = asyncio.run(migrate_profile_pictures(dry_run=args.dry_run))
+    elif args.command == "prune-profile-blobs":
+        result = asyncio.run(profile_images.prune_blobs(db))
+    elif args.command == "migrate-datetimes":
+        result = asyncio.run(migrate_datetimes(batch_size=args.batch_size, dry_run=args.dry_run))
+    elif args.command == "explain-queries":
+        result = asyncio.run(explain_queries())
+        for shape in result.pop("shapes"):
+            log = logger.error if shape["collscan"] else logger.info
+            log("%s (%s): %s", shape["name"], shape["collection"], " <- ".join(shape["stages"]))
+
+    logger.info("%s: %s", args.command, result)
+    client.close()
+    if result.get("collscans"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
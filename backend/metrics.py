@@ -0,0 +1,333 @@
+"""Request, MongoDB and event-loop instrumentation in Prometheus text format.
+
+Kept dependency-free and cheap enough to leave on: a request costs two
+perf_counter() calls and one bucket increment, a Mongo command one dict
+insert/pop. pymongo calls the listeners from Motor's worker threads, so every
+metric takes a lock while it updates.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import monitoring
+
+
+# Seconds; covers cached reads through slow aggregations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), then sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            snapshot = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for labels, value in snapshot:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, labels: tuple, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Registry:
+    """Renders a set of metric groups as one Prometheus exposition"""
+
+    def __init__(self, *groups):
+        self.groups = groups
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for group in self.groups:
+            for metric in group.metrics():
+                lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+# ========================
+# HTTP
+# ========================
+
+class RequestMetrics:
+    """Per-route latency histogram and in-flight gauge"""
+
+    def __init__(self):
+        self.latency = Histogram(
+            "capture_http_request_duration_seconds",
+            "Time from request start to the last response byte",
+            ("method", "route", "status"),
+        )
+        self.in_flight = Gauge("capture_http_requests_in_flight", "Requests currently being served")
+
+    def metrics(self):
+        return [self.latency, self.in_flight]
+
+
+class TimingMiddleware:
+    """ASGI middleware timing every HTTP request by its route template
+
+    Labels use the matched route's path (`/api/territories/{territory_id}`),
+    not the raw URL, so the number of series stays bounded.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+        self._paths: Optional[Dict[object, str]] = None
+
+    def route_path(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._paths is None:
+            router = scope["app"].router
+            self._paths = {route.endpoint: route.path for route in router.routes if hasattr(route, "endpoint")}
+        return self._paths.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = "500"
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        in_flight = self.metrics.in_flight
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            in_flight.inc(amount=-1)
+            self.metrics.latency.observe(
+                (scope["method"], self.route_path(scope), status), time.perf_counter() - start
+            )
+
+
+# ========================
+# MongoDB
+# ========================
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Command latency and documents returned, per collection and command name"""
+
+    def __init__(self):
+        labels = ("collection", "command")
+        self.latency = Histogram("capture_mongo_command_duration_seconds", "MongoDB command round trip", labels)
+        self.documents = Counter("capture_mongo_documents_returned_total", "Documents returned by MongoDB commands", labels)
+        self.failures = Counter("capture_mongo_command_failures_total", "MongoDB commands that returned an error", labels)
+        self._collections: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def metrics(self):
+        return [self.latency, self.documents, self.failures]
+
+    def started(self, event):
+        command = event.command
+        target = command.get(event.command_name)
+        collection = target if isinstance(target, str) else command.get("collection", "")
+        with self._lock:
+            self._collections[(event.request_id, event.connection_id)] = collection
+
+    def _finish(self, event) -> tuple:
+        with self._lock:
+            collection = self._collections.pop((event.request_id, event.connection_id), "")
+        labels = (collection, event.command_name)
+        self.latency.observe(labels, event.duration_micros / 1e6)
+        return labels
+
+    def succeeded(self, event):
+        labels = self._finish(event)
+        reply = event.reply
+        cursor = reply.get("cursor")
+        if cursor:
+            returned = len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+        elif event.command_name == "findAndModify":
+            returned = int(reply.get("value") is not None)
+        else:
+            return
+        if returned:
+            self.documents.inc(labels, returned)
+
+    def failed(self, event):
+        self.failures.inc(self._finish(event))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool size, checkouts and checkout failures per server"""
+
+    def __init__(self):
+        self.open = Gauge("capture_mongo_pool_connections", "Open connections", ("address",))
+        self.checked_out = Gauge("capture_mongo_pool_checked_out", "Connections lent to operations", ("address",))
+        self.max_size = Gauge("capture_mongo_pool_max_size", "Configured maxPoolSize", ("address",))
+        self.waits = Histogram(
+            "capture_mongo_pool_checkout_seconds", "Time waiting to check out a connection", ("address",),
+        )
+        self.checkout_failures = Counter(
+            "capture_mongo_pool_checkout_failures_total", "Checkouts that failed or timed out", ("address", "reason"),
+        )
+        self.cleared = Counter("capture_mongo_pool_cleared_total", "Times the pool was cleared", ("address",))
+        self._waiting: Dict[int, float] = {}
+
+    def metrics(self):
+        return [self.open, self.checked_out, self.max_size, self.waits, self.checkout_failures, self.cleared]
+
+    @staticmethod
+    def _address(event) -> tuple:
+        host, port = event.address
+        return (f"{host}:{port}",)
+
+    def pool_created(self, event):
+        self.max_size.set(self._address(event), event.options.get("maxPoolSize", 100))
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.cleared.inc(self._address(event))
+
+    def pool_closed(self, event):
+        address = self._address(event)
+        self.open.set(address, 0)
+        self.checked_out.set(address, 0)
+
+    def connection_created(self, event):
+        self.open.inc(self._address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open.inc(self._address(event), -1)
+
+    def connection_check_out_started(self, event):
+        self._waiting[threading.get_ident()] = time.perf_counter()
+
+    def _waited(self, event):
+        started = self._waiting.pop(threading.get_ident(), None)
+        if started is not None:
+            self.waits.observe(self._address(event), time.perf_counter() - started)
+
+    def connection_check_out_failed(self, event):
+        self._waited(event)
+        self.checkout_failures.inc(self._address(event) + (str(event.reason),))
+
+    def connection_checked_out(self, event):
+        self._waited(event)
+        self.checked_out.inc(self._address(event))
+
+    def connection_checked_in(self, event):
+        self.checked_out.inc(self._address(event), -1)
+
+
+# ========================
+# Event loop
+# ========================
+
+class EventLoopMonitor:
+    """Measures how late the loop wakes a sleeping task, i.e. time spent blocked"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = Histogram(
+            "capture_event_loop_lag_seconds", "Delay past a scheduled wake-up", buckets=LOOP_LAG_BUCKETS,
+        )
+        self.last_lag = Gauge("capture_event_loop_lag_last_seconds", "Most recent event loop lag")
+        self.tasks = Gauge("capture_event_loop_tasks", "Tasks alive on the event loop")
+
+    def metrics(self):
+        self.tasks.set((), len(asyncio.all_tasks()))
+        return [self.lag, self.last_lag, self.tasks]
+
+    async def run(self):
+        """Sample lag until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag.observe((), lag)
+            self.last_lag.set((), lag)
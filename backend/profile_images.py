@@ -0,0 +1,154 @@
+"""Profile pictures stored as raw bytes in GridFS, content-addressed by SHA-256.
+
+`profile_pictures` documents point at blobs by digest:
+
+    {user_id, content_type, original: <sha256>, thumbnails: {"64": <sha256>, "256": <sha256>}}
+
+Each GridFS file gets its own ObjectId and records the digest in
+`metadata.sha256`, so identical uploads share one blob by looking it up.
+Every store refreshes the blob's `metadata.stored_at`, and a blob is only
+deleted once it is unreferenced and has not been stored for BLOB_GRACE: an
+identical upload racing a release writes its reference well inside that
+window, so the release leaves the blob alone. If the release wins anyway,
+the upload finds no file and writes a new one under a fresh id, and the
+release only deletes chunks of the file id it removed. Blobs released
+inside the window are swept later by `python manage.py prune-profile-blobs`.
+
+Blobs from before per-file ids use the digest as `_id`; `_by_digest`
+matches both.
+"""
+import hashlib
+import io
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+BUCKET_NAME = "profile_images"
+THUMBNAIL_SIZES = (64, 256)
+THUMBNAIL_FORMAT = "image/webp"
+WEBP_QUALITY = 80
+
+# A store protects its blob from release for this long (see module docstring)
+BLOB_GRACE = timedelta(minutes=10)
+
+# Decompression-bomb guard: a 5 MB upload never needs more pixels than this
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnails(data: bytes) -> Dict[int, bytes]:
+    """Square center-cropped WebP thumbnails keyed by edge length
+
+    Raises ValueError if `data` is not a decodable image. CPU-bound; call it
+    from a worker thread.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise ValueError("Image dimensions too large")
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            thumbnails = {}
+            for size in THUMBNAIL_SIZES:
+                thumb = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+                out = io.BytesIO()
+                thumb.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+                thumbnails[size] = out.getvalue()
+            return thumbnails
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError("File is not a valid image") from e
+
+
+def bucket(db) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name=BUCKET_NAME)
+
+
+def _by_digest(sha: str) -> dict:
+    return {"$or": [{"metadata.sha256": sha}, {"_id": sha}]}
+
+
+async def store_blob(db, data: bytes, content_type: str) -> str:
+    """Store bytes once per digest (only refreshed if already present); returns the digest"""
+    sha = digest(data)
+    now = datetime.now(timezone.utc)
+    touched = await db[f"{BUCKET_NAME}.files"].update_many(_by_digest(sha), {"$set": {"metadata.stored_at": now}})
+    if touched.matched_count:
+        return sha
+    # Two concurrent first uploads may both land; either copy serves the digest
+    await bucket(db).upload_from_stream(
+        sha, data, metadata={"sha256": sha, "content_type": content_type, "stored_at": now}
+    )
+    return sha
+
+
+async def open_blob(db, sha: str):
+    """GridOut for a digest, or None if the blob is missing"""
+    # GridFS writes the files document after every chunk, so a match is complete
+    found = await db[f"{BUCKET_NAME}.files"].find_one(_by_digest(sha), {"_id": 1})
+    if not found:
+        return None
+    try:
+        return await bucket(db).open_download_stream(found["_id"])
+    except NoFile:
+        return None
+
+
+async def iter_blob(grid_out) -> AsyncIterator[bytes]:
+    """Stream a GridOut chunk by chunk"""
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            return
+        yield chunk
+
+
+def blob_ids(profile: Optional[dict]) -> Iterable[str]:
+    if not profile:
+        return []
+    ids = [profile.get("original"), *(profile.get("thumbnails") or {}).values()]
+    return [sha for sha in ids if sha]
+
+
+async def release_blobs(db, shas: Iterable[str]) -> int:
+    """Delete blobs no longer referenced by any profile picture; returns the count
+
+    Blobs stored within BLOB_GRACE are kept, since a concurrent identical
+    upload may be about to reference them.
+    """
+    cutoff = datetime.now(timezone.utc) - BLOB_GRACE
+    deleted = 0
+    for sha in set(shas):
+        referenced = {"$or": [{"original": sha}] + [{f"thumbnails.{size}": sha} for size in THUMBNAIL_SIZES]}
+        if await db.profile_pictures.find_one(referenced, {"_id": 1}):
+            continue
+        # The age check and the delete are one operation, so a store landing after
+        # the reference check still saves the blob
+        expired_query = {"$and": [_by_digest(sha), {"$or": [
+            {"metadata.stored_at": {"$lt": cutoff}},
+            # Uploaded before stored_at was tracked
+            {"metadata.stored_at": {"$exists": False}, "uploadDate": {"$lt": cutoff}},
+        ]}]}
+        # Loop: concurrent first uploads can leave more than one file per digest
+        while expired := await db[f"{BUCKET_NAME}.files"].find_one_and_delete(expired_query, {"_id": 1}):
+            # Only this file's chunks; a re-upload of the digest has a different id
+            await db[f"{BUCKET_NAME}.chunks"].delete_many({"files_id": expired["_id"]})
+            deleted += 1
+    return deleted
+
+
+async def prune_blobs(db) -> dict:
+    """Delete every unreferenced blob past BLOB_GRACE, e.g. ones released inside it"""
+    shas = {doc.get("metadata", {}).get("sha256") or doc["_id"]
+            async for doc in db[f"{BUCKET_NAME}.files"].find({}, {"_id": 1, "metadata.sha256": 1})}
+    return {"scanned": len(shas), "deleted": await release_blobs(db, shas)}
+
+
+def blob_etag(sha: str) -> str:
+    return f'"{sha}"'
@@ -0,0 +1,150 @@
+"""Read-through cache of rendered GET responses, invalidated by version counters.
+
+A cached route names the collections (or narrower scopes, like one user's
+document) its response is built from. The current version of each is part
+of the cache key, and write routes bump the versions of what they changed
+once the write has landed. Entries keyed by old versions are never looked
+up again and age out of the LRU, which is bounded by total body bytes.
+
+Concurrent misses for the same key share one build (singleflight), so a
+burst of identical requests after a write costs one query.
+
+Versions live in-process by default (`LocalVersions`). With several uvicorn
+workers, `MongoVersions` keeps them in a collection every worker reads, at
+the cost of one small round trip per cached request, so a write in one
+worker invalidates the others' entries too.
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Sequence, Tuple
+
+from pymongo import UpdateOne
+from starlette.responses import Response
+
+from metrics import Counter, Gauge
+
+
+class LocalVersions:
+    """Version counters held by this process"""
+
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+
+    async def get(self, names: Sequence[str]) -> Tuple[int, ...]:
+        return tuple(self._versions.get(name, 0) for name in names)
+
+    async def bump(self, *names: str):
+        for name in names:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+
+class MongoVersions:
+    """Version counters in a MongoDB collection shared by every worker"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, names: Sequence[str]) -> Tuple[int, ...]:
+        found = {doc["_id"]: doc["version"] async for doc in self.collection.find({"_id": {"$in": list(names)}})}
+        return tuple(found.get(name, 0) for name in names)
+
+    async def bump(self, *names: str):
+        await self.collection.bulk_write([
+            UpdateOne({"_id": name}, {"$inc": {"version": 1}}, upsert=True) for name in names
+        ], ordered=False)
+
+
+class CachedResponse:
+    """A rendered response body with the headers needed to replay it"""
+
+    def __init__(self, status_code: int, body: bytes, media_type: str, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+    @classmethod
+    def from_response(cls, response: Response) -> "CachedResponse":
+        headers = {key: value for key, value in response.headers.items()
+                   if key not in ("content-length", "content-type")}
+        return cls(response.status_code, bytes(response.body), response.media_type, headers)
+
+    def to_response(self, not_modified: bool = False) -> Response:
+        headers = {**self.headers, "ETag": self.etag}
+        if not_modified:
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, status_code=self.status_code, media_type=self.media_type, headers=headers)
+
+
+class ResponseCache:
+    """Byte-bounded LRU of CachedResponse keyed by (route, request, versions)"""
+
+    def __init__(self, versions=None, max_bytes: int = 32 * 1024 * 1024):
+        self.versions = versions or LocalVersions()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[tuple, CachedResponse]" = OrderedDict()
+        self._building: Dict[tuple, asyncio.Task] = {}
+        self.lookups = Counter(
+            "capture_response_cache_lookups_total", "Cached route lookups by result (hit, miss, coalesced)",
+            ("route", "result"),
+        )
+        self.bytes = Gauge("capture_response_cache_bytes", "Response bytes held in the cache")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        self.bytes.set((), self.size)
+        return [self.lookups, self.bytes]
+
+    async def bump(self, *names: str):
+        """Invalidate every response built from `names`; call after the write lands"""
+        await self.versions.bump(*names)
+
+    async def get_or_build(self, route: str, request_key: tuple, depends: Sequence[str],
+                           build: Callable[[], Awaitable[Response]]) -> CachedResponse:
+        """The cached response for a request to `route`, building it on a miss
+
+        `request_key` identifies the request (path and query). Only 200
+        responses are stored; exceptions from `build` reach every request
+        that was waiting on it.
+        """
+        # Read before building: a write during the build bumps past this key
+        key = (route, request_key, await self.versions.get(depends))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.lookups.inc((route, "hit"))
+            return entry
+
+        task = self._building.get(key)
+        if task is None:
+            self.lookups.inc((route, "miss"))
+            task = asyncio.ensure_future(self._build(key, build))
+            self._building[key] = task
+            task.add_done_callback(lambda _: self._building.pop(key, None))
+        else:
+            self.lookups.inc((route, "coalesced"))
+        # A disconnecting client must not cancel the build others are waiting on
+        return await asyncio.shield(task)
+
+    async def _build(self, key: tuple, build: Callable[[], Awaitable[Response]]) -> CachedResponse:
+        response = await build()
+        entry = CachedResponse.from_response(response)
+        if response.status_code == 200:
+            self._put(key, entry)
+        return entry
+
+    def _put(self, key: tuple, entry: CachedResponse):
+        if len(entry.body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key).body)
+        self._entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
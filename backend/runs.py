@@ -0,0 +1,189 @@
+"""In-progress runs streamed point by point over a WebSocket.
+
+A run document in `runs` holds the trace received so far plus running
+metrics, so each batch costs O(batch) regardless of how long the run is:
+
+    {id, user_id, name, color, status: "active" | "finished",
+     points: [[lng, lat], ...], last_seq, metrics: {...}, territory_id}
+"""
+from datetime import datetime, timezone
+from typing import List, Optional, Sequence
+
+import numpy as np
+from pymongo import ReturnDocument
+
+from geometry import EARTH_RADIUS_M
+
+
+ACTIVE = "active"
+FINISHED = "finished"
+
+# A territory needs a ring of at least three distinct points
+MIN_TERRITORY_POINTS = 3
+
+
+def _haversine_km(lng: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """Great-circle length in km of each consecutive segment of a polyline"""
+    lng, lat = np.radians(lng), np.radians(lat)
+    dlng, dlat = np.diff(lng), np.diff(lat)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0))) / 1000
+
+
+class RunMetrics:
+    """Distance, moving time and bounding box updated incrementally per batch
+
+    Only the last point is carried between batches, so each new point costs
+    O(1) no matter how long the run is. After `pause()` the gap to the next
+    point counts towards neither distance nor duration.
+    """
+
+    def __init__(self, point_count: int = 0, distance: float = 0.0, duration_ms: int = 0,
+                 bbox: Optional[List[float]] = None, last: Optional[List[float]] = None,
+                 paused: bool = False):
+        self.point_count = point_count
+        self.distance = distance  # km
+        self.duration_ms = duration_ms
+        self.bbox = bbox  # [west, south, east, north]
+        self.last = last  # [lng, lat, timestamp_ms]
+        self.paused = paused
+
+    @classmethod
+    def from_doc(cls, doc: Optional[dict]) -> "RunMetrics":
+        return cls(**(doc or {}))
+
+    def to_doc(self) -> dict:
+        return {
+            "point_count": self.point_count,
+            "distance": self.distance,
+            "duration_ms": self.duration_ms,
+            "bbox": self.bbox,
+            "last": self.last,
+            "paused": self.paused,
+        }
+
+    def pause(self):
+        self.paused = True
+
+    def extend(self, points: Sequence[Sequence[float]]):
+        """Fold a batch of [lng, lat, timestamp_ms] points into the totals"""
+        batch = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(batch) == 0:
+            return
+        if self.last is not None:
+            batch = np.vstack(([self.last], batch))
+
+        segments = _haversine_km(batch[:, 0], batch[:, 1])
+        elapsed = np.diff(batch[:, 2])
+        if self.last is not None and self.paused:
+            segments[0] = elapsed[0] = 0
+        # Out-of-order timestamps never subtract time
+        self.distance += float(segments.sum())
+        self.duration_ms += int(np.clip(elapsed, 0, None).sum())
+
+        new = batch[1:] if self.last is not None else batch
+        west, south = new[:, :2].min(axis=0)
+        east, north = new[:, :2].max(axis=0)
+        if self.bbox is not None:
+            west, south = min(west, self.bbox[0]), min(south, self.bbox[1])
+            east, north = max(east, self.bbox[2]), max(north, self.bbox[3])
+        self.bbox = [float(west), float(south), float(east), float(north)]
+
+        self.point_count += len(new)
+        self.last = batch[-1].tolist()
+        self.paused = False
+
+    @property
+    def duration(self) -> int:
+        """Moving time in seconds"""
+        return self.duration_ms // 1000
+
+    @property
+    def pace(self) -> Optional[float]:
+        """Minutes per km, or None before any distance is covered"""
+        if self.distance <= 0:
+            return None
+        return self.duration_ms / 60_000 / self.distance
+
+    def summary(self) -> dict:
+        return {
+            "points": self.point_count,
+            "distance": round(self.distance, 5),
+            "duration": self.duration,
+            "pace": round(self.pace, 3) if self.pace is not None else None,
+            "bbox": self.bbox,
+        }
+
+
+def new_run_doc(run_id: str, user_id: str, name: str, color: str) -> dict:
+    return {
+        "id": run_id,
+        "user_id": user_id,
+        "name": name,
+        "color": color,
+        "status": ACTIVE,
+        "points": [],
+        "last_seq": -1,
+        "metrics": RunMetrics().to_doc(),
+        "started_at": datetime.now(timezone.utc),
+    }
+
+
+async def start_run(db, run_id: str, user_id: str, name: str, color: str) -> dict:
+    """Create the run, or return the existing one when a client reconnects"""
+    await db.runs.update_one(
+        {"id": run_id},
+        {"$setOnInsert": new_run_doc(run_id, user_id, name, color)},
+        upsert=True,
+    )
+    return await db.runs.find_one({"id": run_id}, {"_id": 0, "points": 0})
+
+
+async def append_points(db, run_id: str, metrics: RunMetrics, seq: int,
+                        points: List[List[float]]) -> Optional[RunMetrics]:
+    """Append one batch with its updated metrics; None if `seq` was already applied
+
+    Batches resent after a reconnect are dropped by the `last_seq` guard, so
+    retrying is always safe.
+    """
+    updated = RunMetrics.from_doc(metrics.to_doc())
+    updated.extend(points)
+    result = await db.runs.update_one(
+        {"id": run_id, "status": ACTIVE, "last_seq": {"$lt": seq}},
+        {
+            "$push": {"points": {"$each": [[p[0], p[1]] for p in points]}},
+            "$set": {"last_seq": seq, "metrics": updated.to_doc()},
+        },
+    )
+    if result.matched_count == 0:
+        return None
+    return updated
+
+
+async def pause_run(db, run_id: str, metrics: RunMetrics):
+    metrics.pause()
+    await db.runs.update_one({"id": run_id, "status": ACTIVE}, {"$set": {"metrics.paused": True}})
+
+
+def closed_ring(points: List[List[float]]) -> List[List[float]]:
+    if points and points[0] != points[-1]:
+        return points + [points[0]]
+    return points
+
+
+async def claim_finish(db, run_id: str, territory_id: str) -> Optional[dict]:
+    """Atomically mark an active run finished; returns the run with its trace or None
+
+    The territory id is reserved in the same write so a retried finish can
+    tell whether the promotion already happened.
+    """
+    return await db.runs.find_one_and_update(
+        {"id": run_id, "status": ACTIVE},
+        {"$set": {
+            "status": FINISHED,
+            "territory_id": territory_id,
+            "finished_at": datetime.now(timezone.utc),
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
@@ -1,17 +1,43 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import Dict, List, Optional, Tuple
 import uuid
-from datetime import datetime, timezone
-import httpx
+from datetime import datetime, timedelta, timezone
+import tempfile
+from urllib.parse import urlparse
+import json
 import base64
+import orjson
+import asyncio
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from geometry import ring_area, territory_areas, territory_geometry, parse_bbox, parse_point, bbox_geometry
+from spatial_index import TerritoryIndex
+import leaderboard
+import control_grid
+import coverage
+import heatmap
+import indexes
+import runs
+import profile_images
+import metrics
+import response_cache as response_caching
+from image_proxy import ImageCache, ImageProxy, ImageProxyError, iter_body
+from brand_zones import BrandZoneStore
+from runs import RunMetrics
+from coordinate_codec import pack_coordinates, pack_lod_rings, expand_coordinates, encode_coordinates, POLYLINE_PRECISIONS
+from simplify import build_lod_rings, fallback_projection, lod_key_for_zoom, lod_projection, ring_for_zoom, apply_lod
+from tiles import REGION_ZOOM, bounds_regions, tile_bounds, tile_regions, encode_tile, MVT_MEDIA_TYPE, MAX_TILE_ZOOM
+from shapely.geometry import shape
 
 
 ROOT_DIR = Path(__file__).parent
@@ -19,15 +45,43 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Command and pool listeners feeding /api/metrics; pymongo only takes them at client creation
+mongo_metrics = metrics.MongoCommandMetrics()
+pool_metrics = metrics.PoolMetrics()
+# tz_aware: timestamps are stored as BSON datetimes and read back as UTC-aware datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[mongo_metrics, pool_metrics])
 db = client[os.environ['DB_NAME']]
 
+# Opt-in: store territory rings (full and LOD) as packed delta-varint binary instead of float arrays;
+# the GeoJSON `geometry` copy stays as floats for the 2dsphere index
+COMPACT_COORDINATES = os.environ.get('COMPACT_COORDINATES', 'false').lower() in ('1', 'true', 'yes')
+
+# In-memory R-tree over territory polygons for overlap checks
+territory_index = TerritoryIndex()
+# "territories" version and time of the last sync (see sync_territory_index)
+territory_index_synced = {"version": None, "at": None}
+
+# Rendered GET responses for hot read routes; write routes bump the versions they change.
+# RESPONSE_CACHE_SHARED keeps the versions in Mongo so every uvicorn worker sees every write;
+# workers then also replay each other's territory writes into their overlap index.
+RESPONSE_CACHE_SHARED = os.environ.get('RESPONSE_CACHE_SHARED', 'false').lower() in ('1', 'true', 'yes')
+response_cache = response_caching.ResponseCache(
+    response_caching.MongoVersions(db.cache_versions) if RESPONSE_CACHE_SHARED else response_caching.LocalVersions(),
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_MB', '32')) * 1024 * 1024,
+)
+
 # Create the main app without a prefix
 app = FastAPI(title="CAPTURE API", version="1.0.0")
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Per-route latency (TimingMiddleware) and event-loop lag, served with the Mongo metrics
+request_metrics = metrics.RequestMetrics()
+loop_monitor = metrics.EventLoopMonitor()
+loop_monitor_task: Optional[asyncio.Task] = None
+metrics_registry = metrics.Registry(request_metrics, mongo_metrics, pool_metrics, loop_monitor, response_cache)
+
 
 # ========================
 # Models
@@ -57,6 +111,17 @@ class UserPreferences(BaseModel):
     notifications_enabled: bool = True
     privacy: str = "public"  # public or private
 
+class UserPreferencesPatch(BaseModel):
+    """Any subset of UserPreferences; unknown keys are rejected"""
+    model_config = ConfigDict(extra="forbid")
+    
+    unit: Optional[str] = None
+    activity_type: Optional[str] = None
+    territory_color: Optional[TerritoryColorPreference] = None
+    theme: Optional[str] = None
+    notifications_enabled: Optional[bool] = None
+    privacy: Optional[str] = None
+
 class UserCreate(BaseModel):
     email: str
     display_name: str
@@ -76,10 +141,13 @@ class Coordinate(BaseModel):
     lng: float
     lat: float
 
+# A closed ring needs three distinct vertices plus the closing one
+MIN_RING_POINTS = 4
+
 class TerritoryCreate(BaseModel):
     user_id: str
     name: str
-    coordinates: List[List[float]]  # [[lng, lat], ...]
+    coordinates: List[Tuple[float, float]]  # [[lng, lat], ...]
     color: str
     distance: float  # in km
     duration: int  # in seconds
@@ -98,6 +166,31 @@ class Territory(BaseModel):
     is_sponsored: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class TerritoryPolyline(BaseModel):
+    """Territory with its ring sent as an encoded polyline (?encoding=polyline)"""
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str
+    user_id: str
+    name: str
+    polyline: str  # Google encoded polyline, lat/lng order
+    color: str
+    area: float
+    distance: float
+    duration: int
+    is_sponsored: bool = False
+    created_at: datetime
+
+# Live Run Models (WebSocket messages)
+class RunStart(BaseModel):
+    user_id: str
+    name: str
+    color: str
+
+class RunPointsBatch(BaseModel):
+    seq: int = Field(ge=0)  # increasing per batch; resent batches are ignored
+    points: List[Tuple[float, float, float]] = Field(max_length=1000)  # [lng, lat, timestamp_ms]
+
 # Brand Territory Model (for sponsored zones)
 class BrandTerritory(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -107,10 +200,80 @@ class BrandTerritory(BaseModel):
     brand: str
     color: str
     coordinates: List[List[float]]
-    area: float
+    area: float  # in sq km, computed at load
+    bounds: List[float]  # [west, south, east, north]
     is_sponsored: bool = True
 
 
+# ========================
+# Pagination / Streaming Helpers
+# ========================
+
+MAX_PAGE_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+# Datetimes as "...Z", matching how Pydantic serializes UTC datetimes
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+class FastJSONResponse(ORJSONResponse):
+    """orjson-encoded response for documents already shaped by a model projection
+    
+    Returning this from a route bypasses response_model re-validation, so only
+    use it for data read with `model_projection` of that model.
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
+
+async def ndjson_lines(cursor, transform=None):
+    """Encode documents from a Motor cursor as NDJSON, one line per document as it arrives"""
+    async for doc in cursor:
+        if transform:
+            doc = transform(doc)
+        yield orjson.dumps(doc, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match already names `etag`"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+async def cached_response(request: Request, route: str, depends: Tuple[str, ...], build, key: tuple = ()) -> Response:
+    """Serve `build()` through the response cache, keyed by path, query string and `key`"""
+    request_key = (request.url.path, tuple(sorted(request.query_params.multi_items())), *key)
+    entry = await response_cache.get_or_build(route, request_key, depends, build)
+    return entry.to_response(not_modified=entry.status_code == 200 and etag_matches(request, entry.etag))
+
+def model_projection(model) -> dict:
+    """Mongo projection returning exactly the fields of a response model"""
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+def encode_time_cursor(doc: dict) -> str:
+    """Opaque cursor for newest-first pages: the last row's (created_at, id)"""
+    created_at = doc["created_at"]
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = f"{created_at}|{doc['id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def time_cursor_query(cursor: str) -> dict:
+    """Filter for rows strictly after `cursor` in (created_at desc, id desc) order"""
+    try:
+        created_at, last_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+        created_at = datetime.fromisoformat(created_at)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Rows sharing a timestamp are split by id, so pages never skip or repeat
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": last_id}},
+    ]}
+
+
 # ========================
 # Routes
 # ========================
@@ -123,6 +286,11 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Request, MongoDB and event-loop metrics in Prometheus text format"""
+    return Response(content=metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
+
 # Status routes (existing)
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
@@ -130,20 +298,29 @@ async def create_status_check(input: StatusCheckCreate):
     status_obj = StatusCheck(**status_dict)
     
     doc = status_obj.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
     
     _ = await db.status_checks.insert_one(doc)
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find({}, {"_id": 0}).to_list(1000)
+async def get_status_checks(
+    request: Request,
+    after: Optional[str] = Query(None, description="Cursor: id of the last item on the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+):
+    query = {"id": {"$gt": after}} if after else {}
+    cursor = db.status_checks.find(query, model_projection(StatusCheck)).sort("id", 1)
+    
+    if wants_ndjson(request):
+        if limit:
+            cursor = cursor.limit(limit)
+        return StreamingResponse(ndjson_lines(cursor), media_type=NDJSON_MEDIA_TYPE)
     
-    for check in status_checks:
-        if isinstance(check['timestamp'], str):
-            check['timestamp'] = datetime.fromisoformat(check['timestamp'])
+    page_size = limit or MAX_PAGE_SIZE
+    status_checks = await cursor.limit(page_size).to_list(page_size)
     
-    return status_checks
+    headers = {"X-Next-Cursor": status_checks[-1]["id"]} if len(status_checks) == page_size else {}
+    return FastJSONResponse(status_checks, headers=headers)
 
 
 # ========================
@@ -153,11 +330,6 @@ async def get_status_checks():
 @api_router.post("/users", response_model=User)
 async def create_user(input: UserCreate):
     """Create a new user"""
-    # Check if user already exists
-    existing = await db.users.find_one({"email": input.email})
-    if existing:
-        raise HTTPException(status_code=400, detail="User with this email already exists")
-    
     user_obj = User(
         email=input.email,
         display_name=input.display_name,
@@ -165,9 +337,13 @@ async def create_user(input: UserCreate):
     )
     
     doc = user_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.users.insert_one(doc)
+    # The unique email index rejects duplicates atomically (no find-then-insert race)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User with this email already exists")
+    await response_cache.bump("users")
     return user_obj
 
 @api_router.get("/users/{user_id}", response_model=User)
@@ -177,9 +353,6 @@ async def get_user(user_id: str):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if isinstance(user['created_at'], str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
-    
     return user
 
 @api_router.put("/users/{user_id}/preferences")
@@ -192,61 +365,89 @@ async def update_user_preferences(user_id: str, preferences: UserPreferences):
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await response_cache.bump("users", f"users:{user_id}")
     
     return {"success": True, "message": "Preferences updated successfully", "preferences": preferences.model_dump()}
 
 @api_router.get("/users/{user_id}/preferences")
-async def get_user_preferences(user_id: str):
+async def get_user_preferences(user_id: str, request: Request):
     """Get user preferences"""
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "preferences": 1})
-    
-    if not user:
-        # Return default preferences if user not found
-        return {"success": True, "preferences": UserPreferences().model_dump()}
+    async def build():
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "preferences": 1})
+        
+        if not user:
+            # Return default preferences if user not found
+            return FastJSONResponse({"success": True, "preferences": UserPreferences().model_dump()})
+        
+        return FastJSONResponse({"success": True, "preferences": user.get("preferences", UserPreferences().model_dump())})
     
-    return {"success": True, "preferences": user.get("preferences", UserPreferences().model_dump())}
+    return await cached_response(request, "get_user_preferences", (f"users:{user_id}",), build)
 
 @api_router.patch("/users/{user_id}/preferences")
-async def patch_user_preferences(user_id: str, updates: dict):
+async def patch_user_preferences(user_id: str, updates: UserPreferencesPatch):
     """Partially update user preferences (only update provided fields)"""
-    # Get current preferences
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    changes = updates.model_dump(exclude_unset=True, exclude_none=True)
+    defaults = UserPreferences().model_dump()
     
-    if not user:
-        # Create user with preferences if doesn't exist
-        new_user = User(
-            id=user_id,
-            email=f"{user_id}@capture.app",
-            display_name="Runner",
-            preferences=UserPreferences(**updates)
-        )
-        doc = new_user.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
-        await db.users.insert_one(doc)
-        return {"success": True, "message": "User created with preferences", "preferences": new_user.preferences.model_dump()}
+    # Placeholder profile for a user first seen here; untouched preferences get defaults
+    new_user = User(id=user_id, email=f"{user_id}@capture.app", display_name="Runner").model_dump()
+    on_insert = {key: value for key, value in new_user.items() if key != "preferences"}
+    on_insert.update({f"preferences.{key}": value for key, value in defaults.items() if key not in changes})
     
-    # Merge existing preferences with updates
-    current_prefs = user.get("preferences", {})
-    merged_prefs = {**current_prefs, **updates}
+    # Single atomic write: dotted $set touches only the patched keys, so concurrent patches don't clobber each other
+    async def upsert():
+        return await db.users.find_one_and_update(
+            {"id": user_id},
+            {
+                "$set": {f"preferences.{key}": value for key, value in changes.items()},
+                "$setOnInsert": on_insert,
+            },
+            projection={"_id": 0, "preferences": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
     
-    result = await db.users.update_one(
-        {"id": user_id},
-        {"$set": {"preferences": merged_prefs}}
-    )
+    try:
+        user = await upsert()
+    except DuplicateKeyError:
+        # A concurrent first PATCH inserted this user (unique id/email); now the filter matches it
+        user = await upsert()
+    await response_cache.bump("users", f"users:{user_id}")
     
-    return {"success": True, "message": "Preferences updated", "preferences": merged_prefs}
+    return {"success": True, "message": "Preferences updated", "preferences": {**defaults, **user.get("preferences", {})}}
 
 
 # ========================
 # Territory Routes
 # ========================
 
+def build_territory_doc(territory: Territory) -> dict:
+    """Storage document for a territory: geometry, grid cells, LOD rings and (optionally) packed ring"""
+    doc = territory.model_dump()
+    geometry = territory_geometry(territory.coordinates)
+    if geometry:
+        doc['geometry'] = geometry
+        # Rasterized once here; claims and deletes apply the stored cells
+        doc['grid_cells'] = control_grid.pack_cells(control_grid.covered_cells(geometry))
+        doc['outside_area'] = coverage.outside_area(geometry, territory.area)
+    # Simplified rings for zoom 14-18; the full ring stays for scoring and zoom 19
+    lod = build_lod_rings(territory.coordinates)
+    if lod:
+        doc['lod'] = lod
+    if COMPACT_COORDINATES:
+        doc['coordinates_packed'] = pack_coordinates(doc.pop('coordinates'))
+        if lod:
+            doc['lod'] = pack_lod_rings(lod)
+    return doc
+
 @api_router.post("/territories", response_model=Territory)
 async def create_territory(input: TerritoryCreate):
     """Create a new territory from a completed run"""
-    # Calculate area (simplified - in real app, use turf.js on backend or accept from frontend)
-    # This is a placeholder - actual area should be calculated from coordinates
-    area = 0.0001  # Default small area
+    if len(input.coordinates) < MIN_RING_POINTS:
+        raise HTTPException(status_code=400, detail=f"Territory ring needs at least {MIN_RING_POINTS} coordinates")
+    
+    # Geodesic area in sq km (same spherical model as turf.area on the client)
+    area = round(ring_area(input.coordinates), 8)
     
     territory = Territory(
         user_id=input.user_id,
@@ -258,178 +459,777 @@ async def create_territory(input: TerritoryCreate):
         duration=input.duration,
     )
     
-    doc = territory.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    
-    await db.territories.insert_one(doc)
+    await save_territory(territory)
     return territory
 
+async def save_territory(territory: Territory):
+    """Insert a territory and update the overlap index, tile cache and leaderboard"""
+    doc = await asyncio.to_thread(build_territory_doc, territory)
+    await db.territories.insert_one(doc)
+    territory_index.add(doc)
+    await asyncio.gather(
+        leaderboard.record_territory_created(db, doc),
+        record_territory_cells(doc, {doc['user_id']: 1}),
+        record_index_changes([doc['id']]),
+    )
+    await response_cache.bump("territories", "leaderboard_stats", *territory_regions(doc.get('geometry')))
+
+async def record_territory_cells(territory: dict, deltas: Dict[str, int]):
+    """Add (+1) or remove (-1) a territory's grid cells for each owner in the control map and coverage"""
+    if 'grid_cells' in territory:
+        cells = control_grid.territory_cells(territory)
+    else:
+        # Stored before territories kept their cells; rasterize off the event loop
+        cells = await asyncio.to_thread(control_grid.territory_cells, territory)
+    outside = coverage.territory_outside_area(territory)
+    await asyncio.gather(
+        control_grid.apply(db, cells, deltas),
+        coverage.apply(db, cells, deltas, outside),
+    )
+    # Only after cell_control has changed, so a raster read before it is not cached
+    await response_cache.bump("cell_control")
+
+# Bulk Sync (offline-captured runs)
+MAX_BULK_TERRITORIES = 500
+DUPLICATE_KEY_ERROR = 11000
+
+class TerritoryBulkItem(TerritoryCreate):
+    idempotency_key: str = Field(min_length=1, max_length=128)  # client-generated, unique per user
+
+class TerritoryBulkRequest(BaseModel):
+    territories: List[TerritoryBulkItem] = Field(max_length=MAX_BULK_TERRITORIES)
+
+class TerritoryBulkResult(BaseModel):
+    idempotency_key: str
+    status: str  # created, duplicate or error
+    territory: Optional[Territory] = None
+    detail: Optional[str] = None
+
+@api_router.post("/territories/bulk", response_model=List[TerritoryBulkResult])
+async def create_territories_bulk(request: TerritoryBulkRequest):
+    """Create many territories in one unordered write; retries with the same keys are no-ops"""
+    items = request.territories
+    results: List[Optional[TerritoryBulkResult]] = [None] * len(items)
+    areas = territory_areas([item.coordinates for item in items])
+    
+    pending = []  # (result index, storage doc)
+    seen = {}  # (user_id, key) -> index of its first occurrence
+    repeats = []  # (index, first index) for keys repeated within this request
+    for i, (item, area) in enumerate(zip(items, areas)):
+        key = (item.user_id, item.idempotency_key)
+        if len(item.coordinates) < MIN_RING_POINTS:
+            results[i] = TerritoryBulkResult(idempotency_key=item.idempotency_key, status="error",
+                                             detail=f"Territory ring needs at least {MIN_RING_POINTS} coordinates")
+            continue
+        if key in seen:
+            repeats.append((i, seen[key]))
+            continue
+        seen[key] = i
+        territory = Territory(
+            user_id=item.user_id,
+            name=item.name,
+            coordinates=item.coordinates,
+            color=item.color,
+            area=area,
+            distance=item.distance,
+            duration=item.duration,
+        )
+        doc = await asyncio.to_thread(build_territory_doc, territory)
+        doc['idempotency_key'] = item.idempotency_key
+        pending.append((i, doc))
+        results[i] = TerritoryBulkResult(idempotency_key=item.idempotency_key, status="created", territory=territory)
+    
+    failed = {}
+    if pending:
+        try:
+            await db.territories.insert_many([doc for _, doc in pending], ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: err for err in e.details.get("writeErrors", [])}
+    
+    created = []
+    duplicates = {}
+    for position, (i, doc) in enumerate(pending):
+        err = failed.get(position)
+        if err is None:
+            created.append(doc)
+        elif err.get("code") == DUPLICATE_KEY_ERROR:
+            duplicates[(doc['user_id'], doc['idempotency_key'])] = i
+            results[i] = TerritoryBulkResult(idempotency_key=doc['idempotency_key'], status="duplicate")
+        else:
+            results[i] = TerritoryBulkResult(idempotency_key=doc['idempotency_key'], status="error",
+                                             detail=err.get("errmsg"))
+    
+    for doc in created:
+        territory_index.add(doc)
+    await asyncio.gather(
+        leaderboard.record_territories_created(db, created),
+        *(record_territory_cells(doc, {doc['user_id']: 1}) for doc in created),
+        record_index_changes([doc['id'] for doc in created]),
+    )
+    if created:
+        regions = {name for doc in created for name in territory_regions(doc.get('geometry'))}
+        await response_cache.bump("territories", "leaderboard_stats", *sorted(regions))
+    
+    # Retried keys: answer with the territory stored by the first attempt
+    if duplicates:
+        query = {"$or": [{"user_id": user_id, "idempotency_key": key} for user_id, key in duplicates]}
+        projection = {**TERRITORY_PROJECTION, "idempotency_key": 1}
+        async for existing in db.territories.find(query, projection):
+            i = duplicates[(existing['user_id'], existing.pop('idempotency_key'))]
+            results[i].territory = Territory(**expand_coordinates(existing))
+    
+    for i, first in repeats:
+        results[i] = TerritoryBulkResult(idempotency_key=items[i].idempotency_key, status="duplicate",
+                                         territory=results[first].territory)
+    
+    return results
+
+# Territory fields plus the packed ring used when COMPACT_COORDINATES is on
+TERRITORY_PROJECTION = {**model_projection(Territory), "coordinates_packed": 1}
+
+# Upper bound for near= queries; the game area is a few km across
+MAX_NEAR_RADIUS_M = 50_000
+
+# Territories read with a LOD projection are completed this many at a time
+LOD_FILL_BATCH = 100
+
+async def fill_full_rings(docs: List[dict], zoom: Optional[int]) -> List[dict]:
+    """Apply the LOD ring for `zoom`, fetching finer rings only for documents without one"""
+    missing = [doc["id"] for doc in docs if not ring_for_zoom(doc, zoom)]
+    if missing:
+        projection = {"_id": 0, "id": 1, **fallback_projection(zoom)}
+        rings = {ring["id"]: ring async for ring in db.territories.find({"id": {"$in": missing}}, projection)}
+        for doc in docs:
+            doc.update(rings.get(doc["id"], {}))
+    return [apply_lod(doc, zoom) for doc in docs]
+
+async def lod_territories(cursor, zoom: Optional[int]):
+    """Territories from a cursor read with `lod_projection(..., zoom)`, carrying the ring to serve
+    
+    Documents with no ring at this zoom (it matched a finer level, the ring
+    was too small to simplify, or `build-lod` has not reached it) get their
+    finer rings and full ring from one follow-up query per batch.
+    """
+    if lod_key_for_zoom(zoom) is None:
+        async for doc in cursor:
+            yield doc
+        return
+    
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) == LOD_FILL_BATCH:
+            for filled in await fill_full_rings(batch, zoom):
+                yield filled
+            batch = []
+    for filled in await fill_full_rings(batch, zoom):
+        yield filled
+
 @api_router.get("/territories", response_model=List[Territory])
-async def get_territories(user_id: Optional[str] = None):
-    """Get all territories, optionally filtered by user"""
+async def get_territories(
+    request: Request,
+    user_id: Optional[str] = None,
+    bbox: Optional[str] = Query(None, description="Viewport as 'west,south,east,north'"),
+    near: Optional[str] = Query(None, description="Center point as 'lng,lat'"),
+    radius: float = Query(1000, gt=0, le=MAX_NEAR_RADIUS_M, description="Radius in meters for near="),
+    after: Optional[str] = Query(None, description="Cursor: id of the last territory on the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    encoding: str = Query("array", pattern="^(array|polyline|polyline6)$",
+                          description="Ring encoding: plain arrays or an encoded polyline"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description="Map zoom; returns the matching simplified ring"),
+):
+    """Get territories, optionally filtered by user and/or map viewport
+
+    Pages are ordered by id; when a page is full the next cursor is returned
+    in the X-Next-Cursor header. Send `Accept: application/x-ndjson` to stream
+    every matching territory instead. `encoding=polyline` (1e5) or `polyline6`
+    (1e6) replaces `coordinates` with a compact `polyline` string. `zoom`
+    swaps in the level-of-detail ring simplified for that zoom band.
+    """
     query = {}
     if user_id:
         query["user_id"] = user_id
+    if after:
+        query["id"] = {"$gt": after}
     
-    territories = await db.territories.find(query, {"_id": 0}).to_list(1000)
+    if bbox and near:
+        raise HTTPException(status_code=400, detail="Use either bbox or near, not both")
+    try:
+        if bbox:
+            query["geometry"] = {"$geoIntersects": {"$geometry": bbox_geometry(*parse_bbox(bbox))}}
+        elif near:
+            query["geometry"] = {"$nearSphere": {
+                "$geometry": {"type": "Point", "coordinates": list(parse_point(near))},
+                "$maxDistance": radius,
+            }}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    for t in territories:
-        if isinstance(t['created_at'], str):
-            t['created_at'] = datetime.fromisoformat(t['created_at'])
+    cursor = db.territories.find(query, lod_projection(TERRITORY_PROJECTION, zoom)).sort("id", 1)
+    if encoding in POLYLINE_PRECISIONS:
+        transform = lambda t: encode_coordinates(t, encoding)
+    else:
+        transform = expand_coordinates
+    
+    if wants_ndjson(request):
+        if limit:
+            cursor = cursor.limit(limit)
+        return StreamingResponse(ndjson_lines(lod_territories(cursor, zoom), transform), media_type=NDJSON_MEDIA_TYPE)
+    
+    async def build():
+        page_size = limit or MAX_PAGE_SIZE
+        territories = [t async for t in lod_territories(cursor.limit(page_size), zoom)]
+        
+        for t in territories:
+            transform(t)
+        
+        # Rows already match Territory/TerritoryPolyline via the projection; skip re-validation
+        headers = {"X-Next-Cursor": territories[-1]["id"]} if len(territories) == page_size else {}
+        return FastJSONResponse(territories, headers=headers)
     
-    return territories
+    return await cached_response(request, "get_territories", ("territories",), build)
 
 @api_router.get("/territories/{territory_id}", response_model=Territory)
 async def get_territory(territory_id: str):
     """Get a specific territory"""
-    territory = await db.territories.find_one({"id": territory_id}, {"_id": 0})
+    territory = await db.territories.find_one({"id": territory_id}, TERRITORY_PROJECTION)
     if not territory:
         raise HTTPException(status_code=404, detail="Territory not found")
-    
-    if isinstance(territory['created_at'], str):
-        territory['created_at'] = datetime.fromisoformat(territory['created_at'])
+    expand_coordinates(territory)
     
     return territory
 
 @api_router.delete("/territories/{territory_id}")
 async def delete_territory(territory_id: str):
     """Delete a territory"""
-    result = await db.territories.delete_one({"id": territory_id})
-    if result.deleted_count == 0:
+    deleted = await db.territories.find_one_and_delete(
+        {"id": territory_id},
+        {"_id": 0, "user_id": 1, "area": 1, "distance": 1, "geometry": 1, "grid_cells": 1, "outside_area": 1},
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Territory not found")
+    territory_index.remove(territory_id)
+    await asyncio.gather(
+        leaderboard.record_territory_deleted(db, deleted),
+        record_territory_cells(deleted, {deleted['user_id']: -1}),
+        record_index_changes([territory_id]),
+    )
+    await response_cache.bump("territories", "leaderboard_stats", *territory_regions(deleted.get("geometry")))
     
     return {"message": "Territory deleted successfully"}
 
 
+# Activity Feeds (newest first)
+ACTIVITY_PAGE_SIZE = 50
+MAX_ACTIVITY_PAGE_SIZE = 200
+ACTIVITY_SORT = [("created_at", -1), ("id", -1)]
+
+async def activity_page(
+    query: dict,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    cursor: Optional[str],
+    limit: int,
+) -> FastJSONResponse:
+    """One newest-first page of territories matching `query` within [start, end)
+
+    Each page is a bounded walk of a (..., created_at, id) index from the
+    cursor position, so cost does not grow with the size of the history.
+    """
+    created_at = {}
+    if start:
+        created_at["$gte"] = start
+    if end:
+        created_at["$lt"] = end
+    if created_at:
+        query["created_at"] = created_at
+    if cursor:
+        query = {"$and": [query, time_cursor_query(cursor)]}
+    
+    territories = await db.territories.find(query, TERRITORY_PROJECTION).sort(ACTIVITY_SORT).limit(limit).to_list(limit)
+    for t in territories:
+        expand_coordinates(t)
+    
+    headers = {"X-Next-Cursor": encode_time_cursor(territories[-1])} if len(territories) == limit else {}
+    return FastJSONResponse(territories, headers=headers)
+
+@api_router.get("/users/{user_id}/activity", response_model=List[Territory])
+async def get_user_activity(
+    user_id: str,
+    start: Optional[datetime] = Query(None, alias="from", description="Only captures at or after this time"),
+    end: Optional[datetime] = Query(None, alias="to", description="Only captures before this time"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    limit: int = Query(ACTIVITY_PAGE_SIZE, ge=1, le=MAX_ACTIVITY_PAGE_SIZE),
+):
+    """A user's captured territories, newest first"""
+    return await activity_page({"user_id": user_id}, start, end, cursor, limit)
+
+@api_router.get("/activity", response_model=List[Territory])
+async def get_recent_activity(
+    start: Optional[datetime] = Query(None, alias="from", description="Only captures at or after this time"),
+    end: Optional[datetime] = Query(None, alias="to", description="Only captures before this time"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    limit: int = Query(ACTIVITY_PAGE_SIZE, ge=1, le=MAX_ACTIVITY_PAGE_SIZE),
+):
+    """Recent captures across all users, newest first"""
+    return await activity_page({}, start, end, cursor, limit)
+
+
+# Overlap Detection (Over-capture candidates)
+TERRITORY_INDEX_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "name": 1, "color": 1, "area": 1,
+                              "is_sponsored": 1, "coordinates": 1, "coordinates_packed": 1, "geometry": 1}
+
+# Changes are re-read from this far before the last sync, covering clock skew between workers
+INDEX_SYNC_OVERLAP = timedelta(seconds=30)
+# Matches the territory_changes TTL index; a worker further behind reloads everything
+INDEX_CHANGE_TTL = timedelta(hours=1)
+
+async def record_index_changes(territory_ids: List[str]):
+    """Log territory writes for the other workers' overlap indexes (shared versions only)"""
+    if RESPONSE_CACHE_SHARED and territory_ids:
+        now = datetime.now(timezone.utc)
+        await db.territory_changes.insert_many(
+            [{"territory_id": territory_id, "changed_at": now} for territory_id in territory_ids], ordered=False
+        )
+
+async def sync_territory_index():
+    """Replay territory writes made by other workers into this worker's index
+    
+    Writes log their ids before bumping "territories", so a moved version
+    means the log has what changed since the last sync.
+    """
+    if not RESPONSE_CACHE_SHARED:
+        return
+    (version,) = await response_cache.versions.get(("territories",))
+    if version == territory_index_synced["version"]:
+        return
+    
+    started = datetime.now(timezone.utc)
+    synced_at = territory_index_synced["at"]
+    if synced_at is None or started - synced_at > INDEX_CHANGE_TTL - INDEX_SYNC_OVERLAP:
+        await load_territory_index()
+        return
+    
+    changes = {"changed_at": {"$gte": synced_at - INDEX_SYNC_OVERLAP}}
+    ids = await db.territory_changes.distinct("territory_id", changes)
+    found = {doc["id"]: doc async for doc in db.territories.find({"id": {"$in": ids}}, TERRITORY_INDEX_PROJECTION)}
+    for territory_id in ids:
+        if territory_id in found:
+            territory_index.add(expand_coordinates(found[territory_id]))
+        else:
+            territory_index.remove(territory_id)
+    territory_index_synced.update(version=version, at=started)
+
+class OverlapRequest(BaseModel):
+    coordinates: List[Tuple[float, float]]  # [[lng, lat], ...]
+    exclude_user_id: Optional[str] = None
+
+class TerritoryOverlap(BaseModel):
+    id: str
+    user_id: Optional[str] = None
+    name: Optional[str] = None
+    color: Optional[str] = None
+    area: float
+    is_sponsored: bool = False
+    overlap_area: float  # in sq km
+
+@api_router.post("/territories/overlaps", response_model=List[TerritoryOverlap])
+async def find_territory_overlaps(request: OverlapRequest):
+    """Find territories (including brand zones) that a candidate polygon overlaps"""
+    await sync_territory_index()
+    return territory_index.overlaps(request.coordinates, exclude_user_id=request.exclude_user_id)
+
+
 # Territory Claiming (Over-capture)
 class ClaimTerritoryRequest(BaseModel):
     new_owner_id: str
     new_color: str
+    # Optimistic precondition: only claim if the territory is still at this version
+    expected_version: Optional[int] = Field(None, ge=0)
+
+CLAIM_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "area": 1, "distance": 1, "geometry": 1, "version": 1,
+                    "grid_cells": 1, "outside_area": 1}
 
 @api_router.put("/territories/{territory_id}/claim")
 async def claim_territory(territory_id: str, request: ClaimTerritoryRequest):
     """Claim/over-capture an existing territory"""
-    # Find the territory
-    territory = await db.territories.find_one({"id": territory_id})
-    if not territory:
-        raise HTTPException(status_code=404, detail="Territory not found")
+    query = {"id": territory_id, "user_id": {"$ne": request.new_owner_id}}
+    if request.expected_version is not None:
+        # Territories created before versioning count as version 0
+        query["version"] = request.expected_version if request.expected_version else {"$in": [0, None]}
     
-    # Update the owner and color
-    result = await db.territories.update_one(
-        {"id": territory_id},
-        {"$set": {
+    # One atomic round trip; the pre-image tells us who actually lost the territory
+    claimed_at = datetime.now(timezone.utc)
+    territory = await db.territories.find_one_and_update(
+        query,
+        [{"$set": {
+            "previous_owner": "$user_id",
             "user_id": request.new_owner_id,
             "color": request.new_color,
-            "claimed_at": datetime.now(timezone.utc).isoformat(),
-            "previous_owner": territory.get("user_id")
-        }}
+            "claimed_at": claimed_at,
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+        }}],
+        projection=CLAIM_PROJECTION,
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=500, detail="Failed to claim territory")
+    if territory is None:
+        # Precondition failed: work out why (only on this path)
+        current = await db.territories.find_one({"id": territory_id}, {"_id": 0, "user_id": 1, "version": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Territory not found")
+        version = current.get("version") or 0
+        if current.get("user_id") == request.new_owner_id and request.expected_version in (None, version):
+            return {"success": True, "message": "Territory already owned by this user", "version": version}
+        raise HTTPException(status_code=409, detail={
+            "message": "Territory was claimed by someone else first",
+            "owner_id": current.get("user_id"),
+            "version": version,
+        })
     
-    return {"success": True, "message": "Territory claimed successfully"}
+    previous_owner = territory.get("user_id")
+    version = (territory.get("version") or 0) + 1
+    territory_index.update_meta(territory_id, user_id=request.new_owner_id, color=request.new_color)
+    await asyncio.gather(
+        db.claim_history.insert_one({
+            "territory_id": territory_id,
+            "version": version,
+            "previous_owner": previous_owner,
+            "new_owner": request.new_owner_id,
+            "claimed_at": claimed_at,
+        }),
+        leaderboard.record_territory_claimed(db, territory, previous_owner, request.new_owner_id),
+        record_territory_cells(territory, {previous_owner: -1, request.new_owner_id: 1}),
+        record_index_changes([territory_id]),
+    )
+    await response_cache.bump("territories", "leaderboard_stats", *territory_regions(territory.get("geometry")))
+    
+    return {
+        "success": True,
+        "message": "Territory claimed successfully",
+        "version": version,
+        "previous_owner": previous_owner,
+    }
 
 
 # ========================
 # Image Proxy Route (for CORS)
 # ========================
 
+# Upstream hosts the proxy may fetch from; tests point this at a local stand-in
+IMAGE_PROXY_ALLOWED_HOSTS = os.environ.get(
+    'IMAGE_PROXY_ALLOWED_HOSTS',
+    'static.prod-images.emergentagent.com,customer-assets.emergentagent.com,images.unsplash.com',
+).split(',')
+
+image_proxy = ImageProxy(
+    ImageCache(
+        Path(os.environ.get('IMAGE_PROXY_CACHE_DIR', Path(tempfile.gettempdir()) / 'capture-image-cache')),
+        max_bytes=int(os.environ.get('IMAGE_PROXY_CACHE_MB', '256')) * 1024 * 1024,
+    ),
+    fresh_for=int(os.environ.get('IMAGE_PROXY_FRESH_SECONDS', '3600')),
+)
+
 @api_router.get("/proxy-image")
-async def proxy_image(url: str):
+async def proxy_image(url: str, request: Request):
     """Proxy external images to avoid CORS issues for canvas drawing"""
     if not url:
         raise HTTPException(status_code=400, detail="URL parameter required")
     
     # Validate URL is from allowed domains
-    allowed_domains = [
-        "static.prod-images.emergentagent.com",
-        "customer-assets.emergentagent.com",
-        "images.unsplash.com",
-    ]
-    
-    from urllib.parse import urlparse
     parsed = urlparse(url)
-    if parsed.netloc not in allowed_domains:
+    if parsed.scheme not in ("http", "https") or parsed.netloc not in IMAGE_PROXY_ALLOWED_HOSTS:
         raise HTTPException(status_code=400, detail="Domain not allowed")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=10.0)
-            response.raise_for_status()
-            
-            content_type = response.headers.get("content-type", "image/png")
-            
-            return StreamingResponse(
-                iter([response.content]),
-                media_type=content_type,
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Cache-Control": "public, max-age=86400",
-                }
-            )
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=502, detail=f"Failed to fetch image: {str(e)}")
+        meta = await image_proxy.fetch(url)
+    except ImageProxyError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": "public, max-age=86400",
+        "ETag": meta["etag"],
+    }
+    if etag_matches(request, meta["etag"]):
+        return Response(status_code=304, headers=headers)
+    
+    # An open handle survives eviction unlinking the file before the body is sent
+    try:
+        meta, body = await image_proxy.open_body(url, meta)
+    except ImageProxyError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    headers["ETag"] = meta["etag"]
+    headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+    return StreamingResponse(iter_body(body), media_type=meta["content_type"], headers=headers)
 
 
 # ========================
 # Brand Territories Routes
 # ========================
 
+# Sponsored zones come from a JSON file that is watched and hot-reloaded
+brand_zones = BrandZoneStore(
+    Path(os.environ.get('BRAND_TERRITORIES_FILE', ROOT_DIR / 'data' / 'brand_territories.json')),
+    BrandTerritory,
+)
+
+def reindex_brand_zones(old: List[dict], new: List[dict]):
+    for zone in old:
+        territory_index.remove(zone["id"])
+    for zone in new:
+        territory_index.add(zone)
+
+brand_zones.on_change(reindex_brand_zones)
+brand_zones_watcher: Optional[asyncio.Task] = None
+
 @api_router.get("/brand-territories", response_model=List[BrandTerritory])
-async def get_brand_territories():
-    """Get all brand/sponsored territories (hardcoded for now)"""
-    # Hardcoded MuscleBlaze territories in Bangalore
-    brand_territories = [
-        BrandTerritory(
-            id="brand_muscleblaze_1",
-            name="MuscleBlaze Zone - Indiranagar",
-            brand="MuscleBlaze",
-            color="#FFD700",
-            coordinates=[
-                [77.6390, 12.9780],
-                [77.6420, 12.9810],
-                [77.6450, 12.9790],
-                [77.6440, 12.9750],
-                [77.6400, 12.9740],
-                [77.6390, 12.9780],
-            ],
-            area=0.15,
-        ),
-        BrandTerritory(
-            id="brand_muscleblaze_2",
-            name="MuscleBlaze Zone - Koramangala",
-            brand="MuscleBlaze",
-            color="#FFD700",
-            coordinates=[
-                [77.6150, 12.9340],
-                [77.6190, 12.9370],
-                [77.6230, 12.9350],
-                [77.6220, 12.9310],
-                [77.6170, 12.9300],
-                [77.6150, 12.9340],
-            ],
-            area=0.18,
-        ),
-        BrandTerritory(
-            id="brand_muscleblaze_3",
-            name="MuscleBlaze Zone - HSR Layout",
-            brand="MuscleBlaze",
-            color="#FFD700",
-            coordinates=[
-                [77.6400, 12.9120],
-                [77.6440, 12.9150],
-                [77.6480, 12.9130],
-                [77.6470, 12.9090],
-                [77.6420, 12.9080],
-                [77.6400, 12.9120],
-            ],
-            area=0.16,
-        ),
-    ]
-    return brand_territories
+async def get_brand_territories(request: Request):
+    """Get all brand/sponsored territories"""
+    # Serialized once per reload; revalidating clients get a 304
+    headers = {"ETag": brand_zones.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, brand_zones.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=brand_zones.body, media_type="application/json", headers=headers)
+
+
+# ========================
+# Live Run Routes
+# ========================
+
+async def finish_run(run_id: str, metrics: RunMetrics) -> Territory:
+    """Promote a streamed run into a territory using the trace already stored"""
+    if metrics.point_count < runs.MIN_TERRITORY_POINTS:
+        raise HTTPException(status_code=400, detail="Run needs at least 3 points to capture territory")
+    
+    run = await runs.claim_finish(db, run_id, territory_id=str(uuid.uuid4()))
+    if run is None:
+        # Already finished: a retry after a dropped reply returns the same territory
+        run = await db.runs.find_one({"id": run_id}, {"_id": 0})
+        if run is None:
+            raise HTTPException(status_code=404, detail="Run not found")
+        existing = await db.territories.find_one({"id": run.get("territory_id")}, TERRITORY_PROJECTION)
+        if existing:
+            return Territory(**expand_coordinates(existing))
+    
+    coordinates = runs.closed_ring(run["points"])
+    stored = RunMetrics.from_doc(run["metrics"])
+    territory = Territory(
+        id=run["territory_id"],
+        user_id=run["user_id"],
+        name=run["name"],
+        coordinates=coordinates,
+        color=run["color"],
+        area=round(ring_area(coordinates), 8),
+        distance=round(stored.distance, 5),
+        duration=stored.duration,
+    )
+    try:
+        await save_territory(territory)
+    except DuplicateKeyError:
+        # A concurrent finish (or a retry racing this one) stored the reserved id first
+        existing = await db.territories.find_one({"id": territory.id}, TERRITORY_PROJECTION)
+        return Territory(**expand_coordinates(existing))
+    return territory
+
+@api_router.websocket("/runs/{run_id}/stream")
+async def stream_run(websocket: WebSocket, run_id: str):
+    """Live GPS ingestion for one run
+    
+    Client messages: {"type": "start", user_id, name, color}, then any number of
+    {"type": "points", seq, points: [[lng, lat, timestamp_ms], ...]} and
+    {"type": "pause"}, then {"type": "finish"}. Every message is answered with
+    the run's current metrics, or {"type": "error", status, detail}.
+    """
+    await websocket.accept()
+    metrics = None
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                kind = message.get("type") if isinstance(message, dict) else None
+                if kind == "start":
+                    start = RunStart(**message)
+                    run = await runs.start_run(db, run_id, start.user_id, start.name, start.color)
+                    if run["user_id"] != start.user_id:
+                        raise HTTPException(status_code=403, detail="Run belongs to another user")
+                    metrics = RunMetrics.from_doc(run["metrics"])
+                    await websocket.send_json({
+                        "type": "run",
+                        "status": run["status"],
+                        "last_seq": run["last_seq"],
+                        "territory_id": run.get("territory_id"),
+                        **metrics.summary(),
+                    })
+                elif metrics is None:
+                    raise HTTPException(status_code=400, detail="Send a start message first")
+                elif kind == "points":
+                    batch = RunPointsBatch(**message)
+                    updated = await runs.append_points(db, run_id, metrics, batch.seq, batch.points)
+                    if updated is not None:
+                        metrics = updated
+                    await websocket.send_json({
+                        "type": "ack",
+                        "seq": batch.seq,
+                        "duplicate": updated is None,
+                        **metrics.summary(),
+                    })
+                elif kind == "pause":
+                    await runs.pause_run(db, run_id, metrics)
+                    await websocket.send_json({"type": "paused", **metrics.summary()})
+                elif kind == "finish":
+                    territory = await finish_run(run_id, metrics)
+                    await websocket.send_json({"type": "territory", "territory": territory.model_dump(mode="json")})
+                    await websocket.close()
+                    return
+                else:
+                    raise HTTPException(status_code=400, detail=f"Unknown message type: {kind}")
+            except ValidationError as e:
+                detail = e.errors(include_url=False, include_context=False)
+                await websocket.send_json({"type": "error", "status": 422, "detail": detail})
+            except json.JSONDecodeError:
+                await websocket.send_json({"type": "error", "status": 400, "detail": "Messages must be JSON"})
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+    except WebSocketDisconnect:
+        # Everything acknowledged so far is already stored; the client reconnects and resumes
+        pass
+
+
+# ========================
+# Vector Tile Routes
+# ========================
+
+# Below this zoom a tile spans most of the city; serve it empty instead of every polygon
+MIN_TILE_ZOOM = 10
+
+def territory_regions(geometry: Optional[dict]) -> List[str]:
+    """Tile cache versions a write to this territory geometry must bump"""
+    return bounds_regions(shape(geometry).bounds) if geometry else []
+
+async def build_vector_tile(z: int, x: int, y: int) -> bytes:
+    """Clip territories and brand zones intersecting a tile into an MVT"""
+    query = {"geometry": {"$geoIntersects": {"$geometry": bbox_geometry(*tile_bounds(z, x, y))}}}
+    projection = {"_id": 0, "id": 1, "user_id": 1, "name": 1, "color": 1, "area": 1,
+                  "coordinates": 1, "coordinates_packed": 1}
+    
+    territories = []
+    async for doc in lod_territories(db.territories.find(query, lod_projection(projection, z)), z):
+        expand_coordinates(doc)
+        geometry = territory_geometry(doc.get("coordinates") or [])
+        if geometry:
+            territories.append((shape(geometry), {
+                "id": doc["id"],
+                "user_id": doc.get("user_id"),
+                "name": doc.get("name"),
+                "color": doc.get("color"),
+                "area": doc.get("area"),
+            }))
+    
+    brands = []
+    for brand in brand_zones.zones:
+        geometry = territory_geometry(brand["coordinates"])
+        if geometry:
+            brands.append((shape(geometry), {
+                "id": brand["id"],
+                "name": brand["name"],
+                "brand": brand["brand"],
+                "color": brand["color"],
+                "area": brand["area"],
+            }))
+    
+    return encode_tile({"territories": territories, "brands": brands}, z, x, y)
+
+@api_router.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_vector_tile(z: int, x: int, y: int, request: Request):
+    """Mapbox Vector Tile with `territories` and `brands` layers"""
+    if not (0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    async def build():
+        data = await build_vector_tile(z, x, y) if z >= MIN_TILE_ZOOM else b""
+        return Response(content=data, media_type=MVT_MEDIA_TYPE, headers={"Cache-Control": "no-cache"})
+    
+    # Every territory write bumps "territories"; finer tiles only follow writes in their region
+    depends = tuple(tile_regions(z, x, y)) if z >= REGION_ZOOM else ("territories",)
+    # Brand zones are reloaded from a file in each worker, so their revision is part of the key
+    return await cached_response(request, "get_vector_tile", depends, build, key=(brand_zones.etag,))
 
 
+# ========================
+# Control Map Routes
+# ========================
+
+@api_router.get("/control")
+async def get_control_map(
+    bbox: Optional[str] = Query(None, description="Viewport as 'west,south,east,north'; defaults to the game area"),
+    level: int = Query(5, ge=0, le=control_grid.MAX_CONTROL_LEVEL, description="Grid level: 2^level cells per side"),
+):
+    """Dominant owner and coverage of each grid cell in the viewport
+
+    Read from the `cell_control` table that territory writes keep current;
+    cells nobody holds are omitted.
+    """
+    try:
+        bounds = parse_bbox(bbox) if bbox else control_grid.BOUNDS
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    cells = []
+    cell_range = control_grid.cell_range(level, bounds)
+    if cell_range:
+        x0, y0, x1, y1 = cell_range
+        query = {"level": level, "x": {"$gte": x0, "$lte": x1}, "y": {"$gte": y0, "$lte": y1}}
+        async for doc in db.cell_control.find(query, {"_id": 0}):
+            cell = control_grid.control_cell(doc)
+            if cell:
+                cells.append(cell)
+    
+    return FastJSONResponse({
+        "level": level,
+        "cell_size": list(control_grid.cell_span(level)),
+        "cells": cells,
+    })
+
+
+# ========================
+# Heatmap Routes
+# ========================
+
+@api_router.get("/heatmap")
+async def get_heatmap(
+    request: Request,
+    bbox: Optional[str] = Query(None, description="Viewport as 'west,south,east,north'; defaults to the game area"),
+    z: int = Query(14, ge=0, le=MAX_TILE_ZOOM, description="Map zoom the raster is drawn at"),
+    format: str = Query("png", description="'png' or 'uint16' (raw little-endian counts)"),
+):
+    """Density raster of captured ground, binned from the control map
+
+    Pixel values count base grid cells covered, once per territory. Size
+    and bounds are in the X-Heatmap-* headers; rows run north to south.
+    """
+    if format not in heatmap.FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'png' or 'uint16'")
+    try:
+        bounds = parse_bbox(bbox) if bbox else control_grid.BOUNDS
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    async def build():
+        raster = await heatmap.build(db, bounds, z)
+        data = await asyncio.to_thread(heatmap.encode, raster, format)
+        headers = {
+            "Cache-Control": "no-cache",
+            "X-Heatmap-Width": str(raster.width),
+            "X-Heatmap-Height": str(raster.height),
+            "X-Heatmap-Bounds": ",".join(repr(v) for v in raster.bounds),
+            "X-Heatmap-Max": str(int(raster.counts.max()) if raster.counts.size else 0),
+        }
+        media_type = heatmap.PNG_MEDIA_TYPE if format == "png" else heatmap.UINT16_MEDIA_TYPE
+        return Response(content=data, media_type=media_type, headers=headers)
+    
+    return await cached_response(request, "get_heatmap", ("cell_control",), build)
+
 # ========================
 # Profile Picture Routes
 # ========================
@@ -438,6 +1238,20 @@ class ProfilePictureResponse(BaseModel):
     success: bool
     url: str
     message: str
+    thumbnails: Dict[str, str] = Field(default_factory=dict)  # size -> URL
+
+# Raw picture URLs carry the blob digest in `v`, so a matching request can be cached forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PROFILE_PICTURE_VERSION_LENGTH = 16
+
+def profile_picture_url(user_id: str, profile: dict, size: Optional[int] = None) -> str:
+    """Versioned URL of the raw picture or one of its thumbnails"""
+    sha = profile["thumbnails"][str(size)] if size else profile["original"]
+    query = f"size={size}&" if size else ""
+    return f"/api/profile-picture/{user_id}/raw?{query}v={sha[:PROFILE_PICTURE_VERSION_LENGTH]}"
+
+def profile_picture_urls(user_id: str, profile: dict) -> Dict[str, str]:
+    return {str(size): profile_picture_url(user_id, profile, size) for size in profile_images.THUMBNAIL_SIZES}
 
 @api_router.post("/profile-picture/{user_id}", response_model=ProfilePictureResponse)
 async def upload_profile_picture(user_id: str, file: UploadFile = File(...)):
@@ -447,57 +1261,116 @@ async def upload_profile_picture(user_id: str, file: UploadFile = File(...)):
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Invalid file type. Only JPEG, PNG, WebP, and GIF are allowed.")
     
-    # Read and encode file
     contents = await file.read()
     
     # Check file size (max 5MB)
     if len(contents) > 5 * 1024 * 1024:
         raise HTTPException(status_code=400, detail="File too large. Maximum size is 5MB.")
     
-    # Encode as base64 for storage
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    data_url = f"data:{file.content_type};base64,{base64_image}"
+    # Decoding and resizing is CPU-bound; keep it off the event loop
+    try:
+        thumbnails = await run_in_threadpool(profile_images.make_thumbnails, contents)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Store in MongoDB
-    result = await db.profile_pictures.update_one(
+    # Raw bytes in GridFS, keyed by SHA-256
+    profile = {
+        "user_id": user_id,
+        "original": await profile_images.store_blob(db, contents, file.content_type),
+        "thumbnails": {
+            str(size): await profile_images.store_blob(db, data, profile_images.THUMBNAIL_FORMAT)
+            for size, data in thumbnails.items()
+        },
+        "content_type": file.content_type,
+        "filename": file.filename,
+        "size": len(contents),
+        "updated_at": datetime.now(timezone.utc)
+    }
+    previous = await db.profile_pictures.find_one_and_update(
         {"user_id": user_id},
-        {"$set": {
-            "user_id": user_id,
-            "image_data": data_url,
-            "content_type": file.content_type,
-            "filename": file.filename,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }},
+        {"$set": profile, "$unset": {"image_data": ""}},
+        projection={"_id": 0, "original": 1, "thumbnails": 1},
         upsert=True
     )
+    await profile_images.release_blobs(
+        db, set(profile_images.blob_ids(previous)) - set(profile_images.blob_ids(profile))
+    )
+    await response_cache.bump("profile_pictures")
     
     return ProfilePictureResponse(
         success=True,
-        url=data_url,
-        message="Profile picture uploaded successfully"
+        url=profile_picture_url(user_id, profile, size=256),
+        message="Profile picture uploaded successfully",
+        thumbnails=profile_picture_urls(user_id, profile)
     )
 
 @api_router.get("/profile-picture/{user_id}")
 async def get_profile_picture(user_id: str):
-    """Get a user's profile picture"""
+    """Get a user's profile picture URLs"""
     profile = await db.profile_pictures.find_one({"user_id": user_id}, {"_id": 0})
     
     if not profile:
         return {"success": False, "url": None, "message": "No profile picture found"}
     
+    if not profile.get("original"):
+        # Pre-GridFS upload still stored as a data URL (see manage.py migrate-profile-pictures)
+        return {
+            "success": True,
+            "url": profile.get("image_data"),
+            "message": "Profile picture retrieved"
+        }
+    
     return {
         "success": True,
-        "url": profile.get("image_data"),
+        "url": profile_picture_url(user_id, profile, size=256),
+        "thumbnails": profile_picture_urls(user_id, profile),
         "message": "Profile picture retrieved"
     }
 
+@api_router.get("/profile-picture/{user_id}/raw")
+async def get_profile_picture_raw(
+    user_id: str,
+    request: Request,
+    size: Optional[int] = Query(None, description="Thumbnail edge in px (64 or 256); omit for the original"),
+    v: Optional[str] = Query(None, description="Digest prefix from a picture URL; enables immutable caching"),
+):
+    """Stream a user's profile picture bytes"""
+    if size is not None and size not in profile_images.THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail="size must be one of 64, 256")
+    
+    profile = await db.profile_pictures.find_one(
+        {"user_id": user_id}, {"_id": 0, "original": 1, "thumbnails": 1, "content_type": 1}
+    )
+    if not profile or not profile.get("original"):
+        raise HTTPException(status_code=404, detail="Profile picture not found")
+    
+    sha = profile["thumbnails"][str(size)] if size else profile["original"]
+    etag = profile_images.blob_etag(sha)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if v and sha.startswith(v) else "public, no-cache",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    grid_out = await profile_images.open_blob(db, sha)
+    if grid_out is None:
+        raise HTTPException(status_code=404, detail="Profile picture not found")
+    headers["Content-Length"] = str(grid_out.length)
+    media_type = profile_images.THUMBNAIL_FORMAT if size else profile.get("content_type")
+    return StreamingResponse(profile_images.iter_blob(grid_out), media_type=media_type, headers=headers)
+
 @api_router.delete("/profile-picture/{user_id}")
 async def delete_profile_picture(user_id: str):
     """Delete a user's profile picture"""
-    result = await db.profile_pictures.delete_one({"user_id": user_id})
+    deleted = await db.profile_pictures.find_one_and_delete(
+        {"user_id": user_id}, {"_id": 0, "original": 1, "thumbnails": 1}
+    )
     
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Profile picture not found")
+    await profile_images.release_blobs(db, profile_images.blob_ids(deleted))
+    await response_cache.bump("profile_pictures")
     
     return {"success": True, "message": "Profile picture deleted"}
 
@@ -506,40 +1379,74 @@ async def delete_profile_picture(user_id: str):
 # Leaderboard Routes
 # ========================
 
+MAX_LEADERBOARD_LIMIT = 500
+
+# Everything a leaderboard row is built from
+LEADERBOARD_SOURCES = ("leaderboard_stats", "users", "profile_pictures")
+
 @api_router.get("/leaderboard")
-async def get_leaderboard(limit: int = 10):
+async def get_leaderboard(request: Request, limit: int = Query(10, ge=1, le=MAX_LEADERBOARD_LIMIT)):
     """Get top users by territory count"""
-    # Aggregate user stats from territories
+    return await cached_response(request, "get_leaderboard", LEADERBOARD_SOURCES, lambda: build_leaderboard(limit))
+
+async def build_leaderboard(limit: int) -> Response:
+    # Read the materialized stats (maintained on territory writes) and join user data
     pipeline = [
-        {"$group": {
-            "_id": "$user_id",
-            "territory_count": {"$sum": 1},
-            "total_area": {"$sum": "$area"},
-            "total_distance": {"$sum": "$distance"},
-        }},
+        {"$match": {"territory_count": {"$gt": 0}}},
         {"$sort": {"territory_count": -1}},
-        {"$limit": limit}
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "as": "user",
+        }},
+        # Drops rows whose user no longer exists
+        {"$unwind": "$user"},
+        {"$lookup": {
+            "from": "profile_pictures",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "as": "picture",
+        }},
+        {"$project": {
+            "user_id": 1,
+            "territory_count": 1,
+            "total_area": 1,
+            "covered_cells": 1,
+            "outside_area": 1,
+            "total_distance": 1,
+            "points": 1,
+            "user.display_name": 1,
+            "user.preferences.territory_color": 1,
+            "picture.original": 1,
+            "picture.thumbnails": 1,
+        }},
     ]
     
-    results = await db.territories.aggregate(pipeline).to_list(limit)
+    results = await db.leaderboard_stats.aggregate(pipeline).to_list(limit)
     
-    # Enrich with user data
     leaderboard = []
     for i, result in enumerate(results):
-        user = await db.users.find_one({"id": result["_id"]}, {"_id": 0})
-        if user:
-            leaderboard.append({
-                "rank": i + 1,
-                "user_id": result["_id"],
-                "display_name": user.get("display_name", "Unknown"),
-                "color": user.get("preferences", {}).get("territory_color", "#EF4444"),
-                "territories": result["territory_count"],
-                "total_area": round(result["total_area"], 4),
-                "total_distance": round(result["total_distance"], 2),
-                "points": result["territory_count"] * 100,
-            })
-    
-    return leaderboard
+        user = result["user"]
+        picture = result["picture"][0] if result.get("picture") else None
+        leaderboard.append({
+            "rank": i + 1,
+            "user_id": result["user_id"],
+            "display_name": user.get("display_name", "Unknown"),
+            "color": user.get("preferences", {}).get("territory_color", "#EF4444"),
+            "territories": result["territory_count"],
+            # Distinct ground; stats not yet backfilled by rebuild-coverage fall back to the sum
+            "total_area": round(coverage.total_area(result) if "covered_cells" in result
+                                else result["total_area"], 4),
+            "total_distance": round(result["total_distance"], 2),
+            "points": result["points"],
+            # 64px thumbnail link instead of embedding the image
+            "avatar_url": profile_picture_url(result["user_id"], picture, size=64)
+                          if picture and picture.get("original") else None,
+        })
+    
+    return FastJSONResponse(leaderboard)
 
 
 # Include the router in the main app
@@ -551,7 +1458,10 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Heatmap-Width", "X-Heatmap-Height", "X-Heatmap-Bounds", "X-Heatmap-Max"],
 )
+# Added last so it is outermost and times the whole request
+app.add_middleware(metrics.TimingMiddleware, metrics=request_metrics)
 
 # Configure logging
 logging.basicConfig(
@@ -560,6 +1470,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await indexes.ensure_indexes(db)
+
+@app.on_event("startup")
+async def load_brand_zones():
+    global brand_zones_watcher
+    brand_zones.load()
+    brand_zones_watcher = asyncio.create_task(brand_zones.watch())
+    logger.info("Loaded %d brand zones from %s", len(brand_zones.zones), brand_zones.path)
+
+@app.on_event("startup")
+async def load_territory_index():
+    started = datetime.now(timezone.utc)
+    (version,) = await response_cache.versions.get(("territories",))
+    docs = [expand_coordinates(doc) async for doc in db.territories.find({}, TERRITORY_INDEX_PROJECTION)]
+    docs.extend(brand_zones.zones)
+    territory_index.load(docs)
+    territory_index_synced.update(version=version, at=started)
+    logger.info("Territory index loaded with %d polygons", len(territory_index))
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    global loop_monitor_task
+    loop_monitor_task = asyncio.create_task(loop_monitor.run())
+
+@app.on_event("startup")
+async def start_image_proxy():
+    # One pooled upstream client for the life of the app
+    await image_proxy.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def close_image_proxy():
+    await image_proxy.close()
+
+@app.on_event("shutdown")
+async def stop_brand_zones_watcher():
+    if brand_zones_watcher is not None:
+        brand_zones_watcher.cancel()
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    if loop_monitor_task is not None:
+        loop_monitor_task.cancel()
@@ -0,0 +1,204 @@
+"""Track simplification and per-zoom level-of-detail (LOD) rings."""
+import math
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from geometry import ring_to_array
+
+
+# The map runs at zoom 14-19; 19 always gets the full-fidelity ring
+LOD_ZOOMS = (14, 15, 16, 17, 18)
+FULL_DETAIL_ZOOM = 19
+
+# Fields holding the full-fidelity ring, plain or packed
+FULL_RING_FIELDS = ("coordinates", "coordinates_packed")
+
+# Web Mercator ground resolution at the equator for 256px tiles, zoom 0
+METERS_PER_PIXEL_Z0 = 156543.03392
+METERS_PER_DEGREE_LAT = 110_540.0
+METERS_PER_DEGREE_LNG = 111_320.0
+
+# Vertices closer than this many pixels to the simplified line are dropped
+PIXEL_TOLERANCE = 1.0
+
+
+def tolerance_for_zoom(zoom: int, lat: float) -> float:
+    """Simplification tolerance in meters for one screen pixel at `zoom`"""
+    return PIXEL_TOLERANCE * METERS_PER_PIXEL_Z0 * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def _to_local_meters(points: np.ndarray) -> np.ndarray:
+    """Equirectangular projection around the ring's mean latitude"""
+    lat0 = math.radians(float(points[:, 1].mean()))
+    return np.column_stack((
+        points[:, 0] * METERS_PER_DEGREE_LNG * math.cos(lat0),
+        points[:, 1] * METERS_PER_DEGREE_LAT,
+    ))
+
+
+def _segment_distances(xy: np.ndarray, start: int, end: int) -> np.ndarray:
+    """Distances of xy[start+1:end] to the segment xy[start]-xy[end]"""
+    return _point_segment_distances(xy[start + 1:end], xy[start], xy[end])
+
+
+def _point_segment_distances(p: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise distance from points p to segments a-b (a, b broadcast against p)"""
+    ab = b - a
+    ap = p - a
+    length_sq = np.einsum("...i,...i->...", ab, ab)
+    safe = np.where(length_sq == 0.0, 1.0, length_sq)
+    t = np.clip(np.einsum("...i,...i->...", ap, ab) / safe, 0.0, 1.0)
+    t = np.where(length_sq == 0.0, 0.0, t)
+    diff = ap - t[..., None] * ab
+    return np.hypot(diff[..., 0], diff[..., 1])
+
+
+def douglas_peucker_mask(xy: np.ndarray, tolerance: float) -> np.ndarray:
+    """Keep-mask for Douglas-Peucker over an open polyline
+
+    Runs breadth-first: each pass splits every unfinished span at once, so the
+    number of numpy passes follows the recursion depth, not the vertex count.
+    """
+    n = len(xy)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    settled = np.zeros(n, dtype=bool)  # span starting here is within tolerance
+
+    while True:
+        kept = np.flatnonzero(keep)
+        starts, ends = kept[:-1], kept[1:]
+        active = ~settled[starts] & (ends - starts >= 2)
+        if not active.any():
+            return keep
+        starts, ends = starts[active], ends[active]
+
+        inner = ends - starts - 1
+        offsets = np.concatenate(([0], np.cumsum(inner)[:-1]))
+        span = np.repeat(np.arange(len(starts)), inner)
+        index = starts[span] + 1 + (np.arange(len(span)) - offsets[span])
+
+        distances = _point_segment_distances(xy[index], xy[starts[span]], xy[ends[span]])
+        span_max = np.maximum.reduceat(distances, offsets)
+
+        # First vertex reaching each span's maximum
+        at_max = np.flatnonzero(distances == span_max[span])
+        first = at_max[np.unique(span[at_max], return_index=True)[1]]
+
+        split = span_max > tolerance
+        keep[index[first[split]]] = True
+        settled[starts[~split]] = True
+
+
+def _simplify_open_ring(points: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """Simplify an open ring (no closing vertex); returns an open ring of >= 3 vertices"""
+    if len(points) <= 4:
+        return points
+
+    xy = _to_local_meters(points)
+    # Split the ring at the vertex farthest from the start so both halves are open lines
+    far = int(np.argmax(np.hypot(*(xy - xy[0]).T)))
+    closed = np.vstack((xy, xy[:1]))
+    keep = np.zeros(len(closed), dtype=bool)
+    keep[:far + 1] |= douglas_peucker_mask(closed[:far + 1], tolerance_m)
+    keep[far:] |= douglas_peucker_mask(closed[far:], tolerance_m)
+
+    if keep[:-1].sum() < 3:
+        # Collapsed below a triangle: keep the most significant vertex of each half
+        for lo, hi in ((0, far), (far, len(closed) - 1)):
+            if hi - lo >= 2:
+                keep[lo + 1 + int(np.argmax(_segment_distances(closed, lo, hi)))] = True
+
+    return points[keep[:-1]]
+
+
+def _open(points: np.ndarray) -> np.ndarray:
+    if len(points) > 1 and np.array_equal(points[0], points[-1]):
+        return points[:-1]
+    return points
+
+
+def _close(points: np.ndarray) -> List[List[float]]:
+    if len(points) == 0:
+        return []
+    return np.round(np.vstack((points, points[:1])), 6).tolist()
+
+
+def simplify_ring(coordinates: Sequence[Sequence[float]], tolerance_m: float) -> List[List[float]]:
+    """Simplify a closed [[lng, lat], ...] ring, keeping it a valid polygon ring"""
+    return _close(_simplify_open_ring(_open(ring_to_array(coordinates)), tolerance_m))
+
+
+def build_lod_rings(coordinates: Sequence[Sequence[float]]) -> Dict[str, List[List[float]]]:
+    """Simplified rings keyed by zoom, skipping levels that would not drop vertices
+
+    Levels are built finest-first, each from the previous result, so the
+    coarse levels only walk the already-thinned ring. A level identical to
+    the next finer one is not stored; `apply_lod` serves the finer ring.
+    """
+    points = _open(ring_to_array(coordinates))
+    if len(points) < 4:
+        return {}
+    lat = float(points[:, 1].mean())
+
+    lod = {}
+    current = points
+    for zoom in reversed(LOD_ZOOMS):
+        simplified = _simplify_open_ring(current, tolerance_for_zoom(zoom, lat))
+        # Each level only removes vertices from the last, so equal length means an identical ring
+        if len(simplified) < len(current):
+            lod[str(zoom)] = _close(simplified)
+        current = simplified
+    return lod
+
+
+def lod_key_for_zoom(zoom: Optional[int]) -> Optional[str]:
+    """LOD key to serve at `zoom`, or None for the full-fidelity ring"""
+    if zoom is None or zoom >= FULL_DETAIL_ZOOM:
+        return None
+    return str(max(zoom, LOD_ZOOMS[0]))
+
+
+def lod_projection(projection: dict, zoom: Optional[int]) -> dict:
+    """`projection` reading only the LOD ring for `zoom` instead of the full ring"""
+    key = lod_key_for_zoom(zoom)
+    if key is None:
+        return projection
+    fields = {field: value for field, value in projection.items() if field not in FULL_RING_FIELDS}
+    return {**fields, f"lod.{key}": 1}
+
+
+def fallback_projection(zoom: Optional[int]) -> dict:
+    """Fields for a territory with no ring at `zoom`: the finer LOD rings and the full ring"""
+    key = lod_key_for_zoom(zoom)
+    finer = range(int(key) + 1, FULL_DETAIL_ZOOM) if key is not None else ()
+    return {**{field: 1 for field in FULL_RING_FIELDS}, **{f"lod.{z}": 1 for z in finer}}
+
+
+def ring_for_zoom(doc: dict, zoom: Optional[int]) -> Optional[List[List[float]]]:
+    """The simplified ring stored for `zoom`, if any"""
+    key = lod_key_for_zoom(zoom)
+    if key is None:
+        return None
+    return (doc.get("lod") or {}).get(key)
+
+
+def apply_lod(doc: dict, zoom: Optional[int]) -> dict:
+    """Swap a territory document's ring for its LOD ring at `zoom`, in place
+
+    Without one, the nearest finer ring read by `fallback_projection` is
+    used (the level was identical to it), then the full ring. Packed rings
+    go to `coordinates_packed`, like a packed full ring.
+    """
+    key = lod_key_for_zoom(zoom)
+    lod = doc.pop("lod", None) or {}
+    ring = None
+    if key is not None:
+        ring = next((lod[str(z)] for z in range(int(key), FULL_DETAIL_ZOOM) if lod.get(str(z))), None)
+    if ring:
+        doc.pop("coordinates", None)
+        doc.pop("coordinates_packed", None)
+        doc["coordinates" if isinstance(ring, list) else "coordinates_packed"] = ring
+    return doc
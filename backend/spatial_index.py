@@ -0,0 +1,187 @@
+"""In-memory spatial index for territory overlap queries."""
+import math
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from geometry import shape_area, territory_geometry
+
+
+class STRTree:
+    """Static Sort-Tile-Recursive packed R-tree over bounding boxes
+
+    Boxes are (minx, miny, maxx, maxy) rows. Leaves are STR-ordered and each
+    upper level groups `node_capacity` consecutive nodes, so a node's children
+    are always a contiguous slice of the level below.
+    """
+
+    def __init__(self, bboxes: np.ndarray, node_capacity: int = 16):
+        self.node_capacity = node_capacity
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.size = len(bboxes)
+        self.order = self._str_order(bboxes, node_capacity)
+
+        # levels[0] holds item boxes in packed order, levels[-1] is the root level
+        self.levels = [bboxes[self.order]]
+        while len(self.levels[-1]) > node_capacity:
+            children = self.levels[-1]
+            starts = np.arange(0, len(children), node_capacity)
+            parents = np.empty((len(starts), 4), dtype=np.float64)
+            parents[:, 0] = np.minimum.reduceat(children[:, 0], starts)
+            parents[:, 1] = np.minimum.reduceat(children[:, 1], starts)
+            parents[:, 2] = np.maximum.reduceat(children[:, 2], starts)
+            parents[:, 3] = np.maximum.reduceat(children[:, 3], starts)
+            self.levels.append(parents)
+
+    @staticmethod
+    def _str_order(bboxes: np.ndarray, capacity: int) -> np.ndarray:
+        n = len(bboxes)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        cx = (bboxes[:, 0] + bboxes[:, 2]) / 2
+        cy = (bboxes[:, 1] + bboxes[:, 3]) / 2
+
+        leaf_count = math.ceil(n / capacity)
+        slice_count = math.ceil(math.sqrt(leaf_count))
+        slice_size = slice_count * capacity
+
+        by_x = np.argsort(cx, kind="stable")
+        slice_ids = np.arange(n) // slice_size
+        within = np.lexsort((cy[by_x], slice_ids))
+        return by_x[within]
+
+    def query(self, bbox: Sequence[float]) -> np.ndarray:
+        """Indices (into the original boxes) whose bbox intersects `bbox`"""
+        if self.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        minx, miny, maxx, maxy = bbox
+
+        candidates = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth][candidates]
+            hit = (
+                (boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx)
+                & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)
+            )
+            candidates = candidates[hit]
+            if depth == 0 or len(candidates) == 0:
+                break
+            # Expand matching nodes into their contiguous child ranges
+            child_count = len(self.levels[depth - 1])
+            offsets = np.arange(self.node_capacity)
+            children = (candidates[:, None] * self.node_capacity + offsets).ravel()
+            candidates = children[children < child_count]
+
+        return self.order[candidates]
+
+
+class TerritoryIndex:
+    """Territory polygons keyed by id, with an STR tree for bbox filtering
+
+    Writes land in a small pending set that is scanned linearly; the packed
+    tree is rebuilt from memory once enough writes accumulate.
+    """
+
+    REBUILD_THRESHOLD = 256
+
+    def __init__(self):
+        self._entries: Dict[str, dict] = {}
+        self._tree: Optional[STRTree] = None
+        self._tree_ids: List[str] = []
+        self._pending: set = set()
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, doc: dict, rebuild: bool = True):
+        """Index (or re-index) a territory document"""
+        geojson = doc.get("geometry") or territory_geometry(doc.get("coordinates") or [])
+        if not geojson:
+            self.remove(doc["id"])
+            return
+        polygon = shape(geojson)
+        shapely.prepare(polygon)
+
+        if doc["id"] in self._entries:
+            self._stale += 1
+        self._entries[doc["id"]] = {
+            "polygon": polygon,
+            "bbox": polygon.bounds,
+            "meta": {
+                "id": doc["id"],
+                "user_id": doc.get("user_id"),
+                "name": doc.get("name"),
+                "color": doc.get("color"),
+                "area": doc.get("area", 0.0),
+                "is_sponsored": doc.get("is_sponsored", False),
+            },
+        }
+        self._pending.add(doc["id"])
+        if rebuild:
+            self._maybe_rebuild()
+
+    def update_meta(self, territory_id: str, **fields):
+        """Update owner/color metadata without touching the geometry"""
+        entry = self._entries.get(territory_id)
+        if entry:
+            entry["meta"].update(fields)
+
+    def remove(self, territory_id: str):
+        if self._entries.pop(territory_id, None) is not None:
+            self._pending.discard(territory_id)
+            self._stale += 1
+            self._maybe_rebuild()
+
+    def load(self, docs: Iterable[dict]):
+        """Replace the index contents with `docs` and pack the tree"""
+        self._entries.clear()
+        for doc in docs:
+            self.add(doc, rebuild=False)
+        self.rebuild()
+
+    def rebuild(self):
+        self._tree_ids = list(self._entries)
+        bboxes = np.array([self._entries[i]["bbox"] for i in self._tree_ids], dtype=np.float64)
+        self._tree = STRTree(bboxes)
+        self._pending.clear()
+        self._stale = 0
+
+    def _maybe_rebuild(self):
+        if len(self._pending) + self._stale > self.REBUILD_THRESHOLD:
+            self.rebuild()
+
+    def candidates(self, bbox: Sequence[float]) -> List[str]:
+        """Ids whose bbox intersects `bbox` (tree hits plus pending writes)"""
+        ids = set()
+        if self._tree is not None:
+            ids.update(self._tree_ids[i] for i in self._tree.query(bbox))
+        minx, miny, maxx, maxy = bbox
+        for territory_id in self._pending:
+            bx = self._entries[territory_id]["bbox"]
+            if bx[0] <= maxx and bx[2] >= minx and bx[1] <= maxy and bx[3] >= miny:
+                ids.add(territory_id)
+        return [i for i in ids if i in self._entries]
+
+    def overlaps(self, coordinates: Sequence[Sequence[float]], exclude_user_id: Optional[str] = None) -> List[dict]:
+        """Territories overlapping a candidate ring, with overlap area in sq km"""
+        geojson = territory_geometry(coordinates)
+        if not geojson:
+            return []
+        candidate = shape(geojson)
+
+        results = []
+        for territory_id in self.candidates(candidate.bounds):
+            entry = self._entries[territory_id]
+            if exclude_user_id and entry["meta"]["user_id"] == exclude_user_id:
+                continue
+            if not entry["polygon"].intersects(candidate):
+                continue
+            overlap_area = shape_area(entry["polygon"].intersection(candidate))
+            if overlap_area > 0:
+                results.append({**entry["meta"], "overlap_area": round(overlap_area, 8)})
+
+        results.sort(key=lambda r: r["overlap_area"], reverse=True)
+        return results
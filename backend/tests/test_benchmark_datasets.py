@@ -0,0 +1,29 @@
+"""
+Synthetic benchmark data tests
+"""
+from benchmarks.datasets import BANNERGHATTA_BOUNDS, territory_batches
+
+
+class TestSyntheticTerritories:
+    """Generated running loops are valid, in bounds and reproducible"""
+
+    def test_loops_are_closed_and_in_bounds(self):
+        """Test every loop is a closed ring inside the game area with a plausible area"""
+        west, south, east, north = BANNERGHATTA_BOUNDS
+        docs = [doc for batch in territory_batches(200, 20, batch_size=64) for doc in batch]
+        assert len(docs) == 200
+        for doc in docs:
+            ring = doc["coordinates"]
+            assert ring[0] == ring[-1]
+            assert all(west <= lng <= east and south <= lat <= north for lng, lat in ring)
+            assert 0.005 < doc["area"] < 1.5
+            assert doc["geometry"]["type"] == "Polygon"
+        print("✅ 200 synthetic loops closed and inside Bannerghatta bounds")
+
+    def test_same_seed_same_data(self):
+        """Test a seed always produces the same territories"""
+        first = next(territory_batches(20, 5, seed=3))
+        second = next(territory_batches(20, 5, seed=3))
+        assert [d["coordinates"] for d in first] == [d["coordinates"] for d in second]
+        assert [d["user_id"] for d in first] == [d["user_id"] for d in second]
+        print("✅ Synthetic data is reproducible")
@@ -6,6 +6,9 @@ import pytest
 import requests
 import os
 import base64
+import json
+import uuid
+from websockets.sync.client import connect
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://polygame.preview.emergentagent.com')
 
@@ -22,6 +25,24 @@ class TestHealthEndpoint:
         print("✅ Health check passed")
 
 
+class TestMetricsEndpoint:
+    """Prometheus metrics endpoint tests"""
+
+    def test_metrics_exposition(self):
+        """Test /api/metrics reports route latency by template plus Mongo and loop metrics"""
+        requests.get(f"{BASE_URL}/api/territories/TEST_metrics_missing")
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert 'route="/api/territories/{territory_id}",status="404"' in body
+        assert "TEST_metrics_missing" not in body
+        for name in ("capture_mongo_command_duration_seconds", "capture_mongo_pool_connections",
+                     "capture_event_loop_lag_seconds"):
+            assert f"# TYPE {name}" in body
+        print("✅ Metrics endpoint exposes route, Mongo and event-loop metrics")
+
+
 class TestUserEndpoints:
     """User CRUD endpoint tests"""
     
@@ -42,6 +63,17 @@ class TestUserEndpoints:
         else:
             print("✅ User already exists (expected)")
     
+    def test_create_user_duplicate_email_concurrent(self):
+        """Test concurrent signups with one email create exactly one user"""
+        from concurrent.futures import ThreadPoolExecutor
+        payload = {"email": f"TEST_race_{uuid.uuid4()}@capture.app", "display_name": "Race User"}
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(lambda _: requests.post(f"{BASE_URL}/api/users", json=payload), range(8)))
+        statuses = sorted(r.status_code for r in responses)
+        assert statuses.count(200) == 1
+        assert statuses.count(400) == 7
+        print("✅ Unique email index rejected 7 concurrent duplicates")
+    
     def test_get_user_not_found(self):
         """Test getting a non-existent user returns 404"""
         response = requests.get(f"{BASE_URL}/api/users/nonexistent_user_id")
@@ -78,7 +110,44 @@ class TestTerritoryEndpoints:
         assert data["user_id"] == payload["user_id"]
         print(f"✅ Territory created: {data['id']}")
         return data["id"]
-    
+
+    def test_create_territory_computes_area(self):
+        """Test territory area is computed server-side from coordinates"""
+        payload = {
+            "user_id": "TEST_user_area",
+            "name": "TEST_Territory_Area",
+            "coordinates": [[77.638, 12.975], [77.642, 12.975], [77.642, 12.972], [77.638, 12.972], [77.638, 12.975]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        response = requests.post(f"{BASE_URL}/api/territories", json=payload)
+        assert response.status_code == 200
+        data = response.json()
+        # ~0.004° x 0.003° box at 12.97°N is ~0.1449 sq km (matches turf.area)
+        assert abs(data["area"] - 0.1449) < 0.001
+        print(f"✅ Territory area computed: {data['area']} sq km")
+
+        requests.delete(f"{BASE_URL}/api/territories/{data['id']}")
+
+    def test_create_territory_rejects_bad_rings(self):
+        """Test vertices must be [lng, lat] and rings need at least 4 points"""
+        payload = {
+            "user_id": "TEST_user_bad_ring",
+            "name": "TEST_Territory_Bad_Ring",
+            "coordinates": [[77.638, 12.975, 910.0], [77.642, 12.975, 912.0], [77.642, 12.972, 915.0],
+                            [77.638, 12.972, 911.0], [77.638, 12.975, 910.0]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        assert requests.post(f"{BASE_URL}/api/territories", json=payload).status_code == 422
+        payload["coordinates"] = [[77.638], [77.642, 12.975], [77.642, 12.972], [77.638, 12.975]]
+        assert requests.post(f"{BASE_URL}/api/territories", json=payload).status_code == 422
+        payload["coordinates"] = [[77.638, 12.975], [77.642, 12.975], [77.638, 12.975]]
+        assert requests.post(f"{BASE_URL}/api/territories", json=payload).status_code == 400
+        print("✅ Malformed territory rings rejected")
+
     def test_get_territory_by_id(self):
         """Test getting a specific territory"""
         # First create a territory
@@ -126,6 +195,449 @@ class TestTerritoryEndpoints:
         assert get_response.status_code == 404
         print(f"✅ Territory deleted: {territory_id}")
 
+    def test_cached_list_follows_writes(self):
+        """Test the cached territory list revalidates with a 304 and changes after a write"""
+        user_id = f"TEST_cache_{uuid.uuid4()}"
+        params = {"user_id": user_id}
+        first = requests.get(f"{BASE_URL}/api/territories", params=params)
+        assert first.status_code == 200 and first.json() == []
+        etag = first.headers["ETag"]
+        assert requests.get(f"{BASE_URL}/api/territories", params=params,
+                            headers={"If-None-Match": etag}).status_code == 304
+
+        create = requests.post(f"{BASE_URL}/api/territories", json={
+            "user_id": user_id,
+            "name": "TEST_Territory_Cache",
+            "coordinates": [[77.638, 12.975], [77.642, 12.975], [77.642, 12.972], [77.638, 12.972], [77.638, 12.975]],
+            "color": "#22C55E",
+            "distance": 1.0,
+            "duration": 300
+        })
+        after = requests.get(f"{BASE_URL}/api/territories", params=params, headers={"If-None-Match": etag})
+        assert after.status_code == 200
+        assert [t["id"] for t in after.json()] == [create.json()["id"]]
+        requests.delete(f"{BASE_URL}/api/territories/{create.json()['id']}")
+        print("✅ Cached territory list invalidated by a write")
+
+
+class TestTerritoryViewportQueries:
+    """Territory bbox/near query tests"""
+
+    def test_bbox_and_near_queries(self):
+        """Test bbox and near+radius only return territories on screen"""
+        payload = {
+            "user_id": "TEST_user_viewport",
+            "name": "TEST_Territory_Viewport",
+            "coordinates": [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        create_response = requests.post(f"{BASE_URL}/api/territories", json=payload)
+        assert create_response.status_code == 200
+        territory_id = create_response.json()["id"]
+
+        inside = requests.get(f"{BASE_URL}/api/territories", params={"bbox": "77.57,12.87,77.63,12.92"})
+        assert inside.status_code == 200
+        assert territory_id in [t["id"] for t in inside.json()]
+
+        outside = requests.get(f"{BASE_URL}/api/territories", params={"bbox": "77.63,12.96,77.65,12.98"})
+        assert outside.status_code == 200
+        assert territory_id not in [t["id"] for t in outside.json()]
+
+        near = requests.get(f"{BASE_URL}/api/territories", params={"near": "77.6006,12.8988", "radius": 500})
+        assert near.status_code == 200
+        assert territory_id in [t["id"] for t in near.json()]
+        print("✅ Viewport queries return only on-screen territories")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+
+    def test_invalid_bbox(self):
+        """Test malformed bbox returns 400"""
+        response = requests.get(f"{BASE_URL}/api/territories", params={"bbox": "77.63,12.87,77.57"})
+        assert response.status_code == 400
+        print("✅ Invalid bbox returns 400")
+
+
+class TestTerritoryPagination:
+    """Cursor pagination and NDJSON streaming tests"""
+
+    def test_cursor_pagination(self):
+        """Test pages follow X-Next-Cursor without repeating territories"""
+        first = requests.get(f"{BASE_URL}/api/territories", params={"limit": 2})
+        assert first.status_code == 200
+        assert len(first.json()) <= 2
+        cursor = first.headers.get("X-Next-Cursor")
+        if cursor:
+            second = requests.get(f"{BASE_URL}/api/territories", params={"limit": 2, "after": cursor})
+            assert second.status_code == 200
+            first_ids = {t["id"] for t in first.json()}
+            assert not first_ids & {t["id"] for t in second.json()}
+            assert all(t["id"] > cursor for t in second.json())
+        print("✅ Cursor pagination works")
+
+    def test_ndjson_stream(self):
+        """Test Accept: application/x-ndjson streams one territory per line"""
+        import json
+        response = requests.get(
+            f"{BASE_URL}/api/territories",
+            params={"limit": 5},
+            headers={"Accept": "application/x-ndjson"},
+            stream=True,
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.iter_lines() if line]
+        assert len(rows) <= 5
+        for row in rows:
+            assert "id" in row and "coordinates" in row
+        print(f"✅ Streamed {len(rows)} territories as NDJSON")
+
+    def test_list_timestamps_match_detail(self):
+        """Test the fast list path serializes created_at like the single-territory route"""
+        response = requests.get(f"{BASE_URL}/api/territories", params={"limit": 1})
+        assert response.status_code == 200
+        for territory in response.json():
+            detail = requests.get(f"{BASE_URL}/api/territories/{territory['id']}").json()
+            assert territory["created_at"] == detail["created_at"]
+            assert territory["created_at"].endswith("Z")
+        print("✅ List and detail timestamps agree")
+
+
+class TestCoordinateEncoding:
+    """Compact coordinate encoding tests"""
+
+    def test_polyline_encoding(self):
+        """Test ?encoding=polyline replaces coordinate arrays with a polyline string"""
+        payload = {
+            "user_id": "TEST_user_polyline",
+            "name": "TEST_Territory_Polyline",
+            "coordinates": [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        territory_id = requests.post(f"{BASE_URL}/api/territories", json=payload).json()["id"]
+
+        plain = requests.get(f"{BASE_URL}/api/territories", params={"user_id": "TEST_user_polyline"})
+        assert plain.status_code == 200
+        assert plain.json()[0]["coordinates"] == payload["coordinates"]
+
+        encoded = requests.get(
+            f"{BASE_URL}/api/territories",
+            params={"user_id": "TEST_user_polyline", "encoding": "polyline"},
+        )
+        assert encoded.status_code == 200
+        row = encoded.json()[0]
+        assert "coordinates" not in row
+        # First point (12.899, 77.598) at 1e5 precision
+        assert row["polyline"].startswith("wivmAozrxM")
+        print(f"✅ Polyline encoding: {row['polyline']}")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+
+
+class TestTerritoryLevelOfDetail:
+    """Zoom-level simplified ring tests"""
+
+    def test_zoom_returns_simplified_ring(self):
+        """Test low zooms get fewer vertices and zoom 19 gets the full ring"""
+        import math
+        n = 400
+        ring = [[round(77.60 + 0.004 * math.cos(2 * math.pi * i / n), 6),
+                 round(12.90 + 0.004 * math.sin(2 * math.pi * i / n), 6)] for i in range(n)]
+        ring.append(ring[0])
+        payload = {
+            "user_id": "TEST_user_lod",
+            "name": "TEST_Territory_LOD",
+            "coordinates": ring,
+            "color": "#EF4444",
+            "distance": 2.5,
+            "duration": 900
+        }
+        territory_id = requests.post(f"{BASE_URL}/api/territories", json=payload).json()["id"]
+
+        def vertex_count(zoom):
+            response = requests.get(f"{BASE_URL}/api/territories", params={"user_id": "TEST_user_lod", "zoom": zoom})
+            assert response.status_code == 200
+            return len(response.json()[0]["coordinates"])
+
+        assert vertex_count(14) < vertex_count(18) < len(ring)
+        assert vertex_count(19) == len(ring)
+        print(f"✅ LOD rings: z14={vertex_count(14)} z18={vertex_count(18)} full={len(ring)}")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+
+
+class TestTerritoryOverlapEndpoint:
+    """Server-side overlap detection tests"""
+
+    def test_overlapping_territory_detected(self):
+        """Test a candidate polygon reports overlapping territories with overlap area"""
+        payload = {
+            "user_id": "TEST_overlap_owner",
+            "name": "TEST_Territory_Overlap",
+            "coordinates": [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        create_response = requests.post(f"{BASE_URL}/api/territories", json=payload)
+        assert create_response.status_code == 200
+        territory_id = create_response.json()["id"]
+
+        candidate = [[77.600, 12.898], [77.604, 12.898], [77.604, 12.895], [77.600, 12.895], [77.600, 12.898]]
+        response = requests.post(f"{BASE_URL}/api/territories/overlaps", json={"coordinates": candidate})
+        assert response.status_code == 200
+        overlaps = {o["id"]: o for o in response.json()}
+        assert territory_id in overlaps
+        assert 0 < overlaps[territory_id]["overlap_area"] < create_response.json()["area"]
+
+        excluded = requests.post(
+            f"{BASE_URL}/api/territories/overlaps",
+            json={"coordinates": candidate, "exclude_user_id": "TEST_overlap_owner"},
+        )
+        assert territory_id not in [o["id"] for o in excluded.json()]
+        print(f"✅ Overlap detected: {overlaps[territory_id]['overlap_area']} sq km")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+
+
+class TestActivityFeed:
+    """Newest-first activity feed tests"""
+
+    def test_user_activity_pages_newest_first(self):
+        """Test a user's activity pages follow the cursor without gaps or repeats"""
+        user_id = f"TEST_activity_{uuid.uuid4()}"
+        created = []
+        for i in range(5):
+            response = requests.post(f"{BASE_URL}/api/territories", json={
+                "user_id": user_id,
+                "name": f"TEST_Activity_{i}",
+                "coordinates": [[77.60, 12.90], [77.601, 12.90], [77.601, 12.899], [77.60, 12.90]],
+                "color": "#10B981",
+                "distance": 0.3,
+                "duration": 120,
+            })
+            assert response.status_code == 200
+            created.append(response.json()["id"])
+
+        seen = []
+        params = {"limit": 2}
+        while True:
+            response = requests.get(f"{BASE_URL}/api/users/{user_id}/activity", params=params)
+            assert response.status_code == 200
+            seen.extend(response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+            params["cursor"] = cursor
+
+        assert sorted(t["id"] for t in seen) == sorted(created)
+        keys = [(t["created_at"], t["id"]) for t in seen]
+        assert keys == sorted(keys, reverse=True)
+        print(f"✅ Paged {len(seen)} captures newest first")
+
+        for territory_id in created:
+            requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+
+    def test_recent_activity_and_bad_cursor(self):
+        """Test the global feed is newest first and rejects malformed cursors"""
+        response = requests.get(f"{BASE_URL}/api/activity", params={"limit": 10})
+        assert response.status_code == 200
+        stamps = [t["created_at"] for t in response.json()]
+        assert stamps == sorted(stamps, reverse=True)
+
+        bad = requests.get(f"{BASE_URL}/api/activity", params={"cursor": "not-a-cursor"})
+        assert bad.status_code == 400
+        print("✅ Recent captures feed works")
+
+
+class TestTerritoryBulkSync:
+    """Bulk territory sync tests"""
+
+    def test_bulk_create_is_idempotent(self):
+        """Test bulk upload creates territories once and reports retries as duplicates"""
+        key_prefix = f"TEST_bulk_{uuid.uuid4()}"
+        territories = [
+            {
+                "user_id": "TEST_bulk_user",
+                "name": f"TEST_Bulk_{i}",
+                "coordinates": [[77.59 + i * 0.002, 12.89], [77.591 + i * 0.002, 12.89], [77.591 + i * 0.002, 12.889], [77.59 + i * 0.002, 12.89]],
+                "color": "#3B82F6",
+                "distance": 0.4,
+                "duration": 240,
+                "idempotency_key": f"{key_prefix}_{i}",
+            }
+            for i in range(3)
+        ]
+        territories.append({**territories[0], "idempotency_key": f"{key_prefix}_bad", "coordinates": [[77.59, 12.89]]})
+
+        response = requests.post(f"{BASE_URL}/api/territories/bulk", json={"territories": territories})
+        assert response.status_code == 200
+        results = response.json()
+        assert [r["status"] for r in results] == ["created", "created", "created", "error"]
+
+        retry = requests.post(f"{BASE_URL}/api/territories/bulk", json={"territories": territories[:3]})
+        assert retry.status_code == 200
+        assert [r["status"] for r in retry.json()] == ["duplicate"] * 3
+        assert [r["territory"]["id"] for r in retry.json()] == [r["territory"]["id"] for r in results[:3]]
+        print(f"✅ Bulk sync created {len(results) - 1} territories, retry deduplicated")
+
+        for result in results[:3]:
+            requests.delete(f"{BASE_URL}/api/territories/{result['territory']['id']}")
+
+
+class TestLiveRunStream:
+    """WebSocket live-run ingestion tests"""
+
+    def test_stream_and_finish_run(self):
+        """Test streamed points update metrics, resent batches are ignored and finish creates a territory"""
+        run_id = f"TEST_run_{uuid.uuid4()}"
+        ws_url = BASE_URL.replace("https://", "wss://").replace("http://", "ws://")
+        ring = [[77.600, 12.899], [77.602, 12.899], [77.602, 12.897], [77.600, 12.897]]
+        t0 = 1_700_000_000_000
+
+        with connect(f"{ws_url}/api/runs/{run_id}/stream") as ws:
+            ws.send(json.dumps({"type": "start", "user_id": "TEST_runner", "name": "TEST_Live_Run", "color": "#EF4444"}))
+            assert json.loads(ws.recv())["status"] == "active"
+
+            batch = {"type": "points", "seq": 0, "points": [p + [t0 + i * 30_000] for i, p in enumerate(ring)]}
+            ws.send(json.dumps(batch))
+            ack = json.loads(ws.recv())
+            assert ack["points"] == 4
+            assert ack["distance"] > 0.4
+            assert ack["duration"] == 90
+
+            ws.send(json.dumps(batch))
+            assert json.loads(ws.recv())["duplicate"] is True
+
+            ws.send(json.dumps({"type": "finish"}))
+            territory = json.loads(ws.recv())["territory"]
+
+        assert territory["coordinates"][0] == territory["coordinates"][-1]
+        assert territory["area"] > 0
+        response = requests.get(f"{BASE_URL}/api/territories/{territory['id']}")
+        assert response.status_code == 200
+        print(f"✅ Live run promoted to territory {territory['id']}")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory['id']}")
+
+
+class TestVectorTiles:
+    """Mapbox Vector Tile endpoint tests"""
+
+    # z16 tile covering (77.6, 12.8975)
+    TILE = "16/46894/30399"
+
+    def test_tile_etag_revalidation(self):
+        """Test tiles carry an ETag, revalidate with 304 and change after a territory write"""
+        response = requests.get(f"{BASE_URL}/api/tiles/{self.TILE}.mvt")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/vnd.mapbox-vector-tile"
+        etag = response.headers["etag"]
+
+        cached = requests.get(f"{BASE_URL}/api/tiles/{self.TILE}.mvt", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+
+        payload = {
+            "user_id": "TEST_tile_owner",
+            "name": "TEST_Territory_Tile",
+            "coordinates": [[77.5995, 12.898], [77.6005, 12.898], [77.6005, 12.897], [77.5995, 12.897], [77.5995, 12.898]],
+            "color": "#FF6B00",
+            "distance": 0.5,
+            "duration": 300
+        }
+        create_response = requests.post(f"{BASE_URL}/api/territories", json=payload)
+        assert create_response.status_code == 200
+
+        refreshed = requests.get(f"{BASE_URL}/api/tiles/{self.TILE}.mvt", headers={"If-None-Match": etag})
+        assert refreshed.status_code == 200
+        assert refreshed.headers["etag"] != etag
+        assert len(refreshed.content) > 0
+        print(f"✅ Tile revalidated: {len(refreshed.content)} bytes")
+
+        requests.delete(f"{BASE_URL}/api/territories/{create_response.json()['id']}")
+
+    def test_tile_out_of_range(self):
+        """Test tile coordinates outside the zoom level return 404"""
+        response = requests.get(f"{BASE_URL}/api/tiles/3/9/1.mvt")
+        assert response.status_code == 404
+        print("✅ Out-of-range tile returns 404")
+
+
+class TestControlMap:
+    """Grid-cell control map tests"""
+
+    def test_control_follows_create_claim_delete(self):
+        """Test cell ownership updates on create, claim and delete"""
+        owner = f"TEST_control_{uuid.uuid4()}"
+        rival = f"TEST_control_rival_{uuid.uuid4()}"
+        create = requests.post(f"{BASE_URL}/api/territories", json={
+            "user_id": owner,
+            "name": "TEST_Control",
+            "coordinates": [[77.611, 12.911], [77.613, 12.911], [77.613, 12.9095], [77.611, 12.9095], [77.611, 12.911]],
+            "color": "#F97316",
+            "distance": 0.7,
+            "duration": 300,
+        })
+        assert create.status_code == 200
+        territory_id = create.json()["id"]
+        params = {"bbox": "77.6115,12.9098,77.6125,12.9105", "level": 7}
+
+        def owners():
+            response = requests.get(f"{BASE_URL}/api/control", params=params)
+            assert response.status_code == 200
+            return {cell["owner_id"] for cell in response.json()["cells"]}
+
+        assert owner in owners()
+        requests.put(f"{BASE_URL}/api/territories/{territory_id}/claim",
+                     json={"new_owner_id": rival, "new_color": "#000000"})
+        assert rival in owners() and owner not in owners()
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+        assert rival not in owners()
+        print("✅ Control map tracks create, claim and delete")
+
+
+class TestHeatmap:
+    """Activity heatmap tests"""
+
+    def test_heatmap_formats(self):
+        """Test the heatmap comes back as a PNG or a uint16 raster of the stated size"""
+        png = requests.get(f"{BASE_URL}/api/heatmap", params={"z": 14})
+        assert png.status_code == 200
+        assert png.headers["content-type"] == "image/png"
+        assert png.content.startswith(b"\x89PNG")
+
+        raw = requests.get(f"{BASE_URL}/api/heatmap", params={"z": 14, "format": "uint16"})
+        assert raw.status_code == 200
+        width, height = int(raw.headers["X-Heatmap-Width"]), int(raw.headers["X-Heatmap-Height"])
+        assert len(raw.content) == width * height * 2
+
+        assert requests.get(f"{BASE_URL}/api/heatmap", params={"format": "gif"}).status_code == 400
+        print(f"✅ Heatmap served as PNG and {width}x{height} uint16")
+
+    def test_heatmap_changes_after_write(self):
+        """Test a new territory invalidates the cached raster"""
+        params = {"bbox": "77.6215,12.8715,77.6245,12.8745", "z": 16, "format": "uint16"}
+        before = requests.get(f"{BASE_URL}/api/heatmap", params=params)
+        create = requests.post(f"{BASE_URL}/api/territories", json={
+            "user_id": f"TEST_heatmap_{uuid.uuid4()}",
+            "name": "TEST_Heatmap",
+            "coordinates": [[77.622, 12.874], [77.624, 12.874], [77.624, 12.872], [77.622, 12.872], [77.622, 12.874]],
+            "color": "#F97316",
+            "distance": 0.9,
+            "duration": 300,
+        })
+        assert create.status_code == 200
+
+        after = requests.get(f"{BASE_URL}/api/heatmap", params=params,
+                             headers={"If-None-Match": before.headers["ETag"]})
+        assert after.status_code == 200
+        assert int(after.headers["X-Heatmap-Max"]) > 0
+        requests.delete(f"{BASE_URL}/api/territories/{create.json()['id']}")
+        print("✅ Heatmap rebuilt after a territory write")
+
 
 class TestTerritoryClaimEndpoint:
     """Territory claim/over-capture endpoint tests"""
@@ -168,6 +680,69 @@ class TestTerritoryClaimEndpoint:
         # Clean up
         requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
     
+    def _create_claim_target(self, name):
+        payload = {
+            "user_id": "TEST_original_owner",
+            "name": name,
+            "coordinates": [[77.638, 12.975], [77.642, 12.975], [77.642, 12.972], [77.638, 12.972], [77.638, 12.975]],
+            "color": "#EF4444",
+            "distance": 1.5,
+            "duration": 600
+        }
+        create_response = requests.post(f"{BASE_URL}/api/territories", json=payload)
+        assert create_response.status_code == 200
+        return create_response.json()["id"]
+    
+    def test_reclaim_by_owner_is_noop(self):
+        """Test re-claiming a territory you already own succeeds without a version bump"""
+        territory_id = self._create_claim_target("TEST_Territory_Reclaim")
+        claim_payload = {"new_owner_id": "TEST_new_owner", "new_color": "#3B82F6"}
+        first = requests.put(f"{BASE_URL}/api/territories/{territory_id}/claim", json=claim_payload)
+        second = requests.put(f"{BASE_URL}/api/territories/{territory_id}/claim", json=claim_payload)
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert second.json()["version"] == first.json()["version"]
+        print("✅ No-op re-claim returns 200")
+        
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+    
+    def test_concurrent_claims_load(self):
+        """Load test: hundreds of concurrent claims on one territory stay consistent"""
+        from concurrent.futures import ThreadPoolExecutor
+        import time
+        territory_id = self._create_claim_target("TEST_Territory_Contended")
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+        
+        def claim(i, expected_version=None):
+            payload = {"new_owner_id": f"TEST_claimer_{i}", "new_color": "#22C55E"}
+            if expected_version is not None:
+                payload["expected_version"] = expected_version
+            started = time.perf_counter()
+            response = session.put(f"{BASE_URL}/api/territories/{territory_id}/claim", json=payload)
+            return response, time.perf_counter() - started
+        
+        # Unconditional claims from 300 runners: all succeed, each at a distinct version
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(claim, range(300)))
+        assert all(r.status_code == 200 for r, _ in results)
+        versions = sorted(r.json()["version"] for r, _ in results)
+        assert versions == list(range(1, 301))
+        latencies = sorted(elapsed for _, elapsed in results)
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+        assert p99 < 10 * max(p50, 0.05)
+        
+        # Conditional claims against one version: exactly one wins, the rest get 409
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            raced = list(pool.map(lambda i: claim(1000 + i, expected_version=300), range(100)))
+        statuses = [r.status_code for r, _ in raced]
+        assert statuses.count(200) == 1
+        assert statuses.count(409) == 99
+        print(f"✅ 300 concurrent claims consistent, p50={p50 * 1000:.0f}ms p99={p99 * 1000:.0f}ms")
+        
+        requests.delete(f"{BASE_URL}/api/territories/{territory_id}")
+    
     def test_claim_nonexistent_territory(self):
         """Test claiming a non-existent territory returns 404"""
         claim_payload = {
@@ -200,6 +775,29 @@ class TestBrandTerritoryEndpoints:
             assert territory["is_sponsored"] == True
         
         print(f"✅ Got {len(data)} brand territories")
+    
+    def test_brand_territories_from_config(self):
+        """Test all PRD brand zones are served with computed area and bounds"""
+        response = requests.get(f"{BASE_URL}/api/brand-territories")
+        assert response.status_code == 200
+        data = response.json()
+        brands = [territory["brand"] for territory in data]
+        assert brands.count("MuscleBlaze") == 3
+        assert brands.count("Super You") == 2
+        assert brands.count("The Whole Truth") == 2
+        for territory in data:
+            west, south, east, north = territory["bounds"]
+            assert west < east and south < north
+            assert territory["area"] > 0
+        print("✅ Brand zones loaded from config")
+    
+    def test_brand_territories_etag(self):
+        """Test repeat brand territory requests revalidate with 304"""
+        response = requests.get(f"{BASE_URL}/api/brand-territories")
+        etag = response.headers["etag"]
+        cached = requests.get(f"{BASE_URL}/api/brand-territories", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        print(f"✅ Brand territories revalidated with ETag {etag}")
 
 
 class TestImageProxyEndpoint:
@@ -278,6 +876,33 @@ class TestProfilePictureEndpoints:
         delete_response = requests.delete(f"{BASE_URL}/api/profile-picture/{user_id}")
         assert delete_response.status_code == 200
         print(f"✅ Profile picture deleted for {user_id}")
+    
+    def test_raw_thumbnail_etag(self):
+        """Test thumbnails are served as WebP bytes with ETag revalidation and long caching"""
+        user_id = "TEST_profile_raw_user"
+        png_data = base64.b64decode(
+            "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg=="
+        )
+        upload_response = requests.post(
+            f"{BASE_URL}/api/profile-picture/{user_id}", files={"file": ("test.png", png_data, "image/png")}
+        )
+        assert upload_response.status_code == 200
+        thumbnail_url = upload_response.json()["thumbnails"]["64"]
+        
+        response = requests.get(f"{BASE_URL}{thumbnail_url}")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        assert "immutable" in response.headers["cache-control"]
+        
+        revalidated = requests.get(f"{BASE_URL}{thumbnail_url}", headers={"If-None-Match": response.headers["etag"]})
+        assert revalidated.status_code == 304
+        
+        original = requests.get(f"{BASE_URL}/api/profile-picture/{user_id}/raw")
+        assert original.status_code == 200
+        assert original.content == png_data
+        print(f"✅ Raw profile picture served with ETag {response.headers['etag']}")
+        
+        requests.delete(f"{BASE_URL}/api/profile-picture/{user_id}")
 
 
 class TestUserPreferencesEndpoints:
@@ -473,6 +1098,29 @@ class TestUserPreferencesEndpoints:
         assert get_prefs["privacy"] == "private"
         assert get_prefs["territory_color"]["id"] == "purple"
         print("✅ All preferences persisted correctly")
+    
+    def test_patch_rejects_unknown_keys(self):
+        """Test PATCH validates keys and types against UserPreferences"""
+        user_id = "TEST_pref_invalid_user"
+        response = requests.patch(f"{BASE_URL}/api/users/{user_id}/preferences", json={"is_admin": True})
+        assert response.status_code == 422
+        response = requests.patch(f"{BASE_URL}/api/users/{user_id}/preferences", json={"notifications_enabled": "sometimes"})
+        assert response.status_code == 422
+        print("✅ Invalid preference patches rejected")
+    
+    def test_concurrent_patches_do_not_clobber(self):
+        """Test concurrent PATCHes of different keys both persist"""
+        from concurrent.futures import ThreadPoolExecutor
+        user_id = f"TEST_pref_race_{uuid.uuid4()}"
+        patches = [{"theme": "light"}, {"unit": "miles"}, {"privacy": "private"}, {"activity_type": "walk"}]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(
+                lambda p: requests.patch(f"{BASE_URL}/api/users/{user_id}/preferences", json=p), patches
+            ))
+        assert all(r.status_code == 200 for r in responses)
+        prefs = requests.get(f"{BASE_URL}/api/users/{user_id}/preferences").json()["preferences"]
+        assert (prefs["theme"], prefs["unit"], prefs["privacy"], prefs["activity_type"]) == ("light", "miles", "private", "walk")
+        print("✅ Concurrent preference patches all persisted")
 
 
 class TestLeaderboardEndpoint:
@@ -486,6 +1134,101 @@ class TestLeaderboardEndpoint:
         assert isinstance(data, list)
         print(f"✅ Got leaderboard with {len(data)} entries")
 
+    def test_leaderboard_limit_bounds(self):
+        """Test leaderboard limit is validated"""
+        response = requests.get(f"{BASE_URL}/api/leaderboard", params={"limit": 500})
+        assert response.status_code == 200
+        assert len(response.json()) <= 500
+        ranks = [row["rank"] for row in response.json()]
+        assert ranks == list(range(1, len(ranks) + 1))
+
+        for bad_limit in (0, 501):
+            response = requests.get(f"{BASE_URL}/api/leaderboard", params={"limit": bad_limit})
+            assert response.status_code == 422
+        print("✅ Leaderboard limit bounded")
+
+    def test_leaderboard_tracks_territory_writes(self):
+        """Test materialized leaderboard stats follow create and delete"""
+        import uuid
+        user = requests.post(f"{BASE_URL}/api/users", json={
+            "email": f"TEST_lb_{uuid.uuid4().hex[:8]}@capture.app",
+            "display_name": "TEST Leaderboard",
+        }).json()
+        payload = {
+            "user_id": user["id"],
+            "name": "TEST_Territory_Leaderboard",
+            "coordinates": [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]],
+            "color": "#EF4444",
+            "distance": 2.5,
+            "duration": 600
+        }
+        ids = [requests.post(f"{BASE_URL}/api/territories", json=payload).json()["id"] for _ in range(2)]
+
+        def entry():
+            rows = requests.get(f"{BASE_URL}/api/leaderboard", params={"limit": 500}).json()
+            return next((r for r in rows if r["user_id"] == user["id"]), None)
+
+        row = entry()
+        assert row is not None
+        assert row["territories"] == 2
+        assert row["points"] == 200
+        assert row["total_distance"] == 5.0
+
+        requests.delete(f"{BASE_URL}/api/territories/{ids[0]}")
+        assert entry()["territories"] == 1
+
+        requests.delete(f"{BASE_URL}/api/territories/{ids[1]}")
+        assert entry() is None
+        print("✅ Leaderboard stats follow territory writes")
+
+    def test_total_area_counts_distinct_ground(self):
+        """Test repeating the same loop does not add to total_area"""
+        user = requests.post(f"{BASE_URL}/api/users", json={
+            "email": f"TEST_cover_{uuid.uuid4().hex[:8]}@capture.app",
+            "display_name": "TEST Coverage",
+        }).json()
+        payload = {
+            "user_id": user["id"],
+            "name": "TEST_Territory_Coverage",
+            "coordinates": [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]],
+            "color": "#EF4444",
+            "distance": 2.5,
+            "duration": 600
+        }
+        created = [requests.post(f"{BASE_URL}/api/territories", json=payload).json() for _ in range(3)]
+
+        rows = requests.get(f"{BASE_URL}/api/leaderboard", params={"limit": 500}).json()
+        row = next(r for r in rows if r["user_id"] == user["id"])
+        assert row["territories"] == 3
+        # One loop's worth of ground, within grid rasterization error
+        assert abs(row["total_area"] - created[0]["area"]) < 0.02 * created[0]["area"]
+        print(f"✅ 3 identical loops count {row['total_area']} sq km once")
+
+        for territory in created:
+            requests.delete(f"{BASE_URL}/api/territories/{territory['id']}")
+
+    def test_total_area_outside_grid(self):
+        """Test a run outside the control grid still counts at its polygon area"""
+        user = requests.post(f"{BASE_URL}/api/users", json={
+            "email": f"TEST_outside_{uuid.uuid4().hex[:8]}@capture.app",
+            "display_name": "TEST Outside",
+        }).json()
+        territory = requests.post(f"{BASE_URL}/api/territories", json={
+            "user_id": user["id"],
+            "name": "TEST_Territory_Outside",
+            "coordinates": [[77.700, 12.950], [77.704, 12.950], [77.704, 12.946], [77.700, 12.946], [77.700, 12.950]],
+            "color": "#EF4444",
+            "distance": 2.5,
+            "duration": 600
+        }).json()
+
+        rows = requests.get(f"{BASE_URL}/api/leaderboard", params={"limit": 500}).json()
+        row = next(r for r in rows if r["user_id"] == user["id"])
+        assert abs(row["total_area"] - territory["area"]) < 1e-3
+        print(f"✅ Out-of-grid run counts {row['total_area']} sq km")
+
+        requests.delete(f"{BASE_URL}/api/territories/{territory['id']}")
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,58 @@
+"""
+Control grid rasterization tests
+"""
+import numpy as np
+
+from control_grid import (BASE_LEVEL, cell_span, covered_cells, level_counts, owner_id, owner_key,
+                          pack_cells, territory_cells)
+from geometry import ring_area, territory_geometry
+
+RING = [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]]
+
+
+class TestControlGrid:
+    """Rasterizing territories into grid cells"""
+
+    def test_covered_cells_match_area(self):
+        """Test the base cells a territory covers add up to its area"""
+        cells = covered_cells(territory_geometry(RING))
+        dx, dy = cell_span(BASE_LEVEL)
+        cell_km2 = ring_area([[0, 12.8975], [dx, 12.8975], [dx, 12.8975 + dy], [0, 12.8975 + dy]])
+        assert abs(len(cells) * cell_km2 - ring_area(RING)) / ring_area(RING) < 0.05
+        print(f"✅ {len(cells)} base cells cover the territory")
+
+    def test_levels_aggregate_base_cells(self):
+        """Test coarser levels hold the same number of base cells, in fewer cells"""
+        cells = covered_cells(territory_geometry(RING))
+        for level in (0, 4, 7):
+            counts = level_counts(cells, level)
+            assert sum(counts.values()) == len(cells)
+            assert max(counts.values()) <= 4 ** (BASE_LEVEL - level)
+        assert level_counts(cells, 0) == {(0, 0): len(cells)}
+        print("✅ Levels aggregate base cells")
+
+    def test_outside_bounds_is_ignored(self):
+        """Test ground outside the game area covers no cells"""
+        far = [[p[0] + 1, p[1]] for p in RING]
+        assert len(covered_cells(territory_geometry(far))) == 0
+        assert len(covered_cells(None)) == 0
+        print("✅ Territories outside the grid are ignored")
+
+    def test_stored_cells_round_trip(self):
+        """Test the cell list stored at ingest replays the same cells as rasterizing"""
+        geometry = territory_geometry(RING)
+        cells = covered_cells(geometry)
+        stored = territory_cells({"grid_cells": pack_cells(cells), "geometry": None})
+        assert np.array_equal(stored, cells)
+        assert np.array_equal(territory_cells({"geometry": geometry}), cells)
+        last = 2 ** BASE_LEVEL - 1
+        assert np.array_equal(territory_cells({"grid_cells": pack_cells(np.array([[last, last]]))}), [[last, last]])
+        print(f"✅ {len(cells)} stored cells round-trip in {len(pack_cells(cells))} bytes")
+
+    def test_owner_key_round_trip(self):
+        """Test user ids with dots and dollars survive as field names"""
+        for user in ("runner.one", "$weird%id", "plain"):
+            key = owner_key(user)
+            assert "." not in key and not key.startswith("$")
+            assert owner_id(key) == user
+        print("✅ Owner keys round-trip")
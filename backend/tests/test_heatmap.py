@@ -0,0 +1,46 @@
+"""
+Heatmap binning tests
+"""
+import numpy as np
+
+from control_grid import BOUNDS, covered_cells, level_counts
+from geometry import territory_geometry
+from heatmap import Raster, bin_cells, encode_uint16, raster_shape
+
+RING = [[77.598, 12.899], [77.602, 12.899], [77.602, 12.896], [77.598, 12.896], [77.598, 12.899]]
+
+
+def cell_arrays(level):
+    counts = level_counts(covered_cells(territory_geometry(RING)), level)
+    xs, ys = np.array(list(counts)).T
+    return xs, ys, np.array(list(counts.values()), dtype=np.float64)
+
+
+class TestHeatmap:
+    """Binning control cells into rasters"""
+
+    def test_binning_keeps_every_cell(self):
+        """Test every covered base cell lands in the raster at any zoom"""
+        total = len(covered_cells(territory_geometry(RING)))
+        for z in (10, 14, 18):
+            width, height, level = raster_shape(BOUNDS, z)
+            counts = bin_cells(*cell_arrays(level), level, BOUNDS, width, height)
+            assert counts.shape == (height, width)
+            assert counts.sum() == total
+        print(f"✅ {total} base cells binned at every zoom")
+
+    def test_rows_run_north_to_south(self):
+        """Test row 0 is the north edge of the bbox"""
+        west, south, east, north = BOUNDS
+        width, height, level = raster_shape(BOUNDS, 12)
+        counts = bin_cells(*cell_arrays(level), level, (west, south, east, north), width, height)
+        rows = np.nonzero(counts.sum(axis=1))[0]
+        # RING sits in the upper half of the game area
+        assert rows.max() < height / 2
+        print("✅ Raster rows run north to south")
+
+    def test_uint16_saturates(self):
+        """Test counts past 65535 are clipped instead of wrapping"""
+        raster = Raster(np.array([[70000.0, 3.0]]), BOUNDS, 7)
+        assert np.frombuffer(encode_uint16(raster), "<u2").tolist() == [65535, 3]
+        print("✅ uint16 counts saturate")
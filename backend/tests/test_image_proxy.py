@@ -0,0 +1,142 @@
+"""
+Image proxy cache tests against a local stand-in upstream
+"""
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from image_proxy import ImageCache, ImageProxy, ImageProxyError, iter_body
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 2048
+UPSTREAM_ETAG = '"logo-v1"'
+
+
+class StandInUpstream(BaseHTTPRequestHandler):
+    """Serves one image with an ETag; counts full and conditional hits"""
+    hits = {"full": 0, "not_modified": 0}
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        if self.path == "/missing.png":
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == UPSTREAM_ETAG:
+            self.hits["not_modified"] += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.hits["full"] += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(IMAGE)))
+        self.send_header("ETag", UPSTREAM_ETAG)
+        self.end_headers()
+        self.wfile.write(IMAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    StandInUpstream.hits = {"full": 0, "not_modified": 0}
+    StandInUpstream.delay = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInUpstream)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def run_with_proxy(cache_dir, coroutine_fn, **options):
+    async def runner():
+        proxy = ImageProxy(ImageCache(cache_dir, max_bytes=options.pop("max_bytes", 1024 * 1024)), **options)
+        await proxy.start()
+        try:
+            return await coroutine_fn(proxy)
+        finally:
+            await proxy.close()
+    return asyncio.run(runner())
+
+
+class TestImageProxyCache:
+    """Pooled, caching, coalescing image proxy tests"""
+
+    def test_cache_hit_skips_upstream(self, upstream, tmp_path):
+        """Test a fresh cached image is served from disk without an upstream request"""
+        async def scenario(proxy):
+            first = await proxy.fetch(f"{upstream}/logo.png")
+            second = await proxy.fetch(f"{upstream}/logo.png")
+            return first, second
+
+        first, second = run_with_proxy(tmp_path, scenario)
+        assert first["etag"] == second["etag"]
+        assert (tmp_path / f"{first['key']}.body").read_bytes() == IMAGE
+        assert StandInUpstream.hits["full"] == 1
+        print("✅ Cached image served without refetching")
+
+    def test_concurrent_fetches_coalesce(self, upstream, tmp_path):
+        """Test concurrent requests for one URL share a single upstream fetch"""
+        StandInUpstream.delay = 0.2
+
+        async def scenario(proxy):
+            return await asyncio.gather(*(proxy.fetch(f"{upstream}/logo.png") for _ in range(10)))
+
+        results = run_with_proxy(tmp_path, scenario)
+        assert len({r["etag"] for r in results}) == 1
+        assert StandInUpstream.hits["full"] == 1
+        print("✅ 10 concurrent fetches coalesced into 1 upstream request")
+
+    def test_stale_entry_revalidates(self, upstream, tmp_path):
+        """Test a stale entry is revalidated with If-None-Match and kept on 304"""
+        async def scenario(proxy):
+            first = await proxy.fetch(f"{upstream}/logo.png")
+            second = await proxy.fetch(f"{upstream}/logo.png")
+            return first, second
+
+        first, second = run_with_proxy(tmp_path, scenario, fresh_for=0)
+        assert StandInUpstream.hits == {"full": 1, "not_modified": 1}
+        assert second["etag"] == first["etag"]
+        print("✅ Stale image revalidated with a conditional request")
+
+    def test_lru_eviction_bounds_disk_use(self, upstream, tmp_path):
+        """Test the cache evicts least recently used images past its byte budget"""
+        async def scenario(proxy):
+            for name in ("a", "b", "c"):
+                await proxy.fetch(f"{upstream}/{name}.png")
+            return proxy.cache
+
+        cache = run_with_proxy(tmp_path, scenario, max_bytes=len(IMAGE) * 2)
+        assert len(cache) == 2
+        assert cache.total_bytes <= len(IMAGE) * 2
+        assert len(list(tmp_path.glob("*.body"))) == 2
+        print("✅ Disk cache stays within its byte budget")
+
+    def test_eviction_while_serving(self, upstream, tmp_path):
+        """Test a body evicted after fetch is refetched, and an open body survives eviction"""
+        async def scenario(proxy):
+            url = f"{upstream}/logo.png"
+            meta = await proxy.fetch(url)
+            proxy.cache._drop(meta["key"])
+            meta, refetched = await proxy.open_body(url, meta)
+            proxy.cache._drop(meta["key"])
+            return b"".join(iter_body(refetched))
+
+        assert run_with_proxy(tmp_path, scenario) == IMAGE
+        assert StandInUpstream.hits["full"] == 2
+        print("✅ Evicted image refetched and open body still served")
+
+    def test_upstream_error(self, upstream, tmp_path):
+        """Test an upstream error with nothing cached raises ImageProxyError"""
+        async def scenario(proxy):
+            with pytest.raises(ImageProxyError):
+                await proxy.fetch(f"{upstream}/missing.png")
+
+        run_with_proxy(tmp_path, scenario)
+        assert list(tmp_path.glob("*.tmp")) == []
+        print("✅ Upstream 404 surfaces as a proxy error")
@@ -0,0 +1,93 @@
+"""
+Versioned response cache tests
+"""
+import asyncio
+
+from starlette.responses import Response
+
+from response_cache import LocalVersions, ResponseCache
+
+
+class CountingBuilder:
+    """Builds numbered JSON responses and counts how often it ran"""
+
+    def __init__(self, delay: float = 0, status_code: int = 200):
+        self.calls = 0
+        self.delay = delay
+        self.status_code = status_code
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return Response(content=b'{"build":%d}' % self.calls, status_code=self.status_code,
+                        media_type="application/json")
+
+
+class TestResponseCache:
+    """Read-through caching, invalidation and coalescing"""
+
+    def test_hit_until_bumped(self):
+        """Test a response is reused until a collection it depends on is bumped"""
+        async def scenario():
+            cache, build = ResponseCache(), CountingBuilder()
+            first = await cache.get_or_build("route", ("/a",), ("territories",), build)
+            second = await cache.get_or_build("route", ("/a",), ("territories",), build)
+            await cache.bump("users")
+            third = await cache.get_or_build("route", ("/a",), ("territories",), build)
+            await cache.bump("territories")
+            fourth = await cache.get_or_build("route", ("/a",), ("territories",), build)
+            return [first, second, third, fourth], build.calls
+
+        entries, calls = asyncio.run(scenario())
+        assert calls == 2
+        assert entries[0].body == entries[1].body == entries[2].body == b'{"build":1}'
+        assert entries[3].body == b'{"build":2}'
+        print("✅ Cached until the dependency is bumped")
+
+    def test_concurrent_misses_coalesce(self):
+        """Test identical concurrent misses share one build"""
+        async def scenario():
+            cache, build = ResponseCache(), CountingBuilder(delay=0.05)
+            await asyncio.gather(*(cache.get_or_build("route", ("/a",), ("t",), build) for _ in range(20)))
+            return build.calls
+
+        assert asyncio.run(scenario()) == 1
+        print("✅ 20 concurrent misses coalesced into 1 build")
+
+    def test_errors_are_not_cached(self):
+        """Test non-200 responses are returned but rebuilt next time"""
+        async def scenario():
+            cache, build = ResponseCache(), CountingBuilder(status_code=404)
+            first = await cache.get_or_build("route", ("/a",), ("t",), build)
+            await cache.get_or_build("route", ("/a",), ("t",), build)
+            return first.status_code, build.calls, len(cache)
+
+        assert asyncio.run(scenario()) == (404, 2, 0)
+        print("✅ Error responses are not cached")
+
+    def test_eviction_bounds_bytes(self):
+        """Test the least recently used responses are evicted past max_bytes"""
+        async def scenario():
+            cache, build = ResponseCache(max_bytes=40), CountingBuilder()
+            for i in range(5):
+                await cache.get_or_build("route", (i,), ("t",), build)
+            return cache
+
+        cache = asyncio.run(scenario())
+        assert cache.size <= 40
+        assert len(cache) == 3
+        print(f"✅ {len(cache)} responses kept within {cache.max_bytes} bytes")
+
+    def test_shared_versions_invalidate_other_workers(self):
+        """Test a bump through one worker's cache invalidates another sharing the versions"""
+        async def scenario():
+            shared = LocalVersions()
+            worker_a, worker_b = ResponseCache(shared), ResponseCache(shared)
+            build = CountingBuilder()
+            await worker_b.get_or_build("route", ("/a",), ("t",), build)
+            await worker_a.bump("t")
+            entry = await worker_b.get_or_build("route", ("/a",), ("t",), build)
+            return entry.body, build.calls
+
+        assert asyncio.run(scenario()) == (b'{"build":2}', 2)
+        print("✅ Shared versions keep workers coherent")
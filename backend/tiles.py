@@ -0,0 +1,229 @@
+"""Mapbox Vector Tile (MVT 2.1) encoding and the regions that invalidate cached tiles."""
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+from coordinate_codec import encode_varints, zigzag
+
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+EXTENT = 4096
+BUFFER = 64  # tile units of geometry kept outside the tile edge to hide seams
+MAX_TILE_ZOOM = 22
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH = 2
+
+# Geometry commands
+_MOVE_TO = 1
+_LINE_TO = 2
+_CLOSE_PATH = 7
+_POLYGON = 3
+
+
+# ========================
+# Tile math
+# ========================
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(west, south, east, north) of a Web Mercator tile in degrees"""
+    n = 2 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def tile_range(z: int, bounds: Sequence[float], pad: float = 0.0) -> Tuple[int, int, int, int]:
+    """Inclusive (x0, y0, x1, y1) tile range covering lng/lat bounds at zoom z
+
+    `pad` widens the range by a fraction of a tile on every side.
+    """
+    west, south, east, north = bounds
+    x0, y0 = _tile_xy(z, west, north)
+    x1, y1 = _tile_xy(z, east, south)
+    n = 2 ** z - 1
+    clamp = lambda v: max(0, min(n, int(math.floor(v))))
+    return clamp(x0 - pad), clamp(y0 - pad), clamp(x1 + pad), clamp(y1 + pad)
+
+
+def _tile_xy(z, lng, lat):
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lng + 180.0) / 360.0 * n
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+    return x, y
+
+
+def _to_tile_units(coords: np.ndarray, z: int, x: int, y: int) -> np.ndarray:
+    """Project [lng, lat] rows to integer tile coordinates (y down)"""
+    n = 2 ** z
+    lat = np.radians(np.clip(coords[:, 1], -85.0511, 85.0511))
+    px = ((coords[:, 0] + 180.0) / 360.0 * n - x) * EXTENT
+    py = ((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n - y) * EXTENT
+    return np.rint(np.column_stack((px, py))).astype(np.int64)
+
+
+# ========================
+# Protobuf encoding
+# ========================
+
+def _varint(value: int) -> bytes:
+    return encode_varints(np.array([value]))
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _length_delimited(field: int, payload: bytes) -> bytes:
+    return _key(field, _LENGTH) + _varint(len(payload)) + payload
+
+
+def _encode_value(value) -> bytes:
+    if isinstance(value, bool):
+        return _key(7, _VARINT) + _varint(int(value))
+    if isinstance(value, int):
+        return _key(6, _VARINT) + encode_varints(zigzag([value]))
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + np.float64(value).tobytes()
+    return _length_delimited(1, str(value).encode("utf-8"))
+
+
+def _ring_commands(ring: np.ndarray, cursor: np.ndarray) -> np.ndarray:
+    """MoveTo/LineTo/ClosePath commands for one open ring, relative to cursor"""
+    deltas = np.diff(np.vstack((cursor, ring)), axis=0)
+    params = zigzag(deltas).reshape(-1)
+    return np.concatenate((
+        [_MOVE_TO | (1 << 3)], params[:2],
+        [_LINE_TO | ((len(ring) - 1) << 3)], params[2:],
+        [_CLOSE_PATH | (1 << 3)],
+    )).astype(np.uint64)
+
+
+def _signed_area(ring: np.ndarray) -> float:
+    x, y = ring[:, 0].astype(np.float64), ring[:, 1].astype(np.float64)
+    return float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+
+def _clean_ring(ring: np.ndarray) -> Optional[np.ndarray]:
+    """Drop the closing vertex and repeated points; None if the ring degenerates"""
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        ring = ring[:-1]
+    if len(ring) == 0:
+        return None
+    keep = np.ones(len(ring), dtype=bool)
+    keep[1:] = np.any(ring[1:] != ring[:-1], axis=1)
+    ring = ring[keep]
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        ring = ring[:-1]
+    if len(ring) < 3 or _signed_area(ring) == 0:
+        return None
+    return ring
+
+
+def encode_polygon_geometry(polygons, z: int, x: int, y: int) -> Optional[np.ndarray]:
+    """Command stream for clipped shapely polygons in lng/lat"""
+    cursor = np.zeros((1, 2), dtype=np.int64)
+    commands = []
+    for polygon in polygons:
+        rings = [polygon.exterior, *polygon.interiors]
+        for i, ring in enumerate(rings):
+            tile_ring = _clean_ring(_to_tile_units(np.asarray(ring.coords), z, x, y))
+            if tile_ring is None:
+                if i == 0:
+                    break  # exterior collapsed; skip its holes too
+                continue
+            # MVT: exterior rings have positive area in tile space, holes negative
+            if (_signed_area(tile_ring) > 0) != (i == 0):
+                tile_ring = tile_ring[::-1]
+            commands.append(_ring_commands(tile_ring, cursor))
+            cursor = tile_ring[-1:]
+    if not commands:
+        return None
+    return np.concatenate(commands)
+
+
+def encode_layer(name: str, features: Iterable[Tuple[np.ndarray, Dict]]) -> bytes:
+    """Encode one layer from (geometry commands, properties) pairs"""
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, object], int] = {}
+    body = [_key(15, _VARINT) + _varint(2), _length_delimited(1, name.encode("utf-8"))]
+
+    for commands, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = (
+            _length_delimited(2, encode_varints(np.array(tags, dtype=np.uint64)))
+            + _key(3, _VARINT) + _varint(_POLYGON)
+            + _length_delimited(4, encode_varints(commands))
+        )
+        body.append(_length_delimited(2, feature))
+
+    body.extend(_length_delimited(3, key.encode("utf-8")) for key in keys)
+    body.extend(_length_delimited(4, _encode_value(value)) for (_, value) in values)
+    body.append(_key(5, _VARINT) + _varint(EXTENT))
+    return b"".join(body)
+
+
+def encode_tile(layers: Dict[str, List[Tuple[object, Dict]]], z: int, x: int, y: int) -> bytes:
+    """Clip, quantize and encode {layer name: [(shapely geometry, properties)]}"""
+    west, south, east, north = tile_bounds(z, x, y)
+    pad_x = (east - west) * BUFFER / EXTENT
+    pad_y = (north - south) * BUFFER / EXTENT
+    clip_box = (west - pad_x, south - pad_y, east + pad_x, north + pad_y)
+    tile_box = box(*clip_box)
+
+    out = []
+    for name, items in layers.items():
+        features = []
+        for geom, properties in items:
+            if not geom.intersects(tile_box):
+                continue
+            clipped = shapely.clip_by_rect(geom, *clip_box)
+            polygons = [p for p in shapely.get_parts(clipped) if p.geom_type == "Polygon" and not p.is_empty]
+            commands = encode_polygon_geometry(polygons, z, x, y)
+            if commands is not None:
+                features.append((commands, properties))
+        if features:
+            out.append(_length_delimited(3, encode_layer(name, features)))
+    return b"".join(out)
+
+
+# ========================
+# Cache invalidation regions
+# ========================
+
+# Territory writes invalidate tiles by region: the tiles at this zoom (~2.4 km) their bounds touch
+REGION_ZOOM = 14
+
+
+def _region_names(x0: int, y0: int, x1: int, y1: int) -> List[str]:
+    return [f"tiles:{x}/{y}" for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def bounds_regions(bounds: Sequence[float]) -> List[str]:
+    """Version names of the regions a territory with lng/lat bounds touches"""
+    return _region_names(*tile_range(REGION_ZOOM, bounds))
+
+
+def tile_regions(z: int, x: int, y: int) -> List[str]:
+    """Version names of the regions tile (z, x, y) and its buffer overlap; z >= REGION_ZOOM"""
+    scale = 2 ** (z - REGION_ZOOM)
+    pad = BUFFER / EXTENT
+    last = 2 ** REGION_ZOOM - 1
+    clamp = lambda v: max(0, min(last, v))
+    return _region_names(
+        clamp(math.floor((x - pad) / scale)), clamp(math.floor((y - pad) / scale)),
+        clamp(math.ceil((x + 1 + pad) / scale) - 1), clamp(math.ceil((y + 1 + pad) / scale) - 1),
+    )
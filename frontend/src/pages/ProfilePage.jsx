@@ -31,6 +31,9 @@ import { toast } from 'sonner';
 
 const API_BASE = process.env.REACT_APP_BACKEND_URL || '';
 
+// Picture URLs from the API are paths on the backend; older uploads are data URLs
+const resolvePictureUrl = (url) => (url.startsWith('/') ? `${API_BASE}${url}` : url);
+
 const ProfilePage = () => {
   const navigate = useNavigate();
   const { user, logout } = useAuth();
@@ -81,8 +84,9 @@ const ProfilePage = () => {
           const response = await fetch(`${API_BASE}/api/profile-picture/${user.id}`);
           const data = await response.json();
           if (data.success && data.url) {
-            setProfilePicture(data.url);
-            localStorage.setItem('capture_profile_picture', data.url);
+            const url = resolvePictureUrl(data.url);
+            setProfilePicture(url);
+            localStorage.setItem('capture_profile_picture', url);
           }
         } catch (error) {
           console.error('Error loading profile picture:', error);
@@ -161,8 +165,9 @@ const ProfilePage = () => {
       const data = await response.json();
 
       if (data.success) {
-        setProfilePicture(data.url);
-        localStorage.setItem('capture_profile_picture', data.url);
+        const url = resolvePictureUrl(data.url);
+        setProfilePicture(url);
+        localStorage.setItem('capture_profile_picture', url);
         toast.success('Profile picture updated!');
       } else {
         throw new Error(data.detail || 'Upload failed');